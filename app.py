@@ -1,19 +1,42 @@
-import base64
-import datetime
+import functools
 import io  # For handling images in memory
+import collections
+import json
+import math
 import os
+import threading
 import time
+import uuid
+import zipfile
+from concurrent.futures import Future, wait as wait_futures
+from dataclasses import dataclass, field
 
 import requests
 from PIL import Image, ImageOps
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, send_file
-from rembg import remove
-from werkzeug.utils import secure_filename  # For safe filenames
+from flask import Flask, Response, g, request, jsonify, send_file, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
 
-from services import nsfw_detector
+from services import compositing, ingest, metrics, nsfw_detector
+from services.background_cache import BackgroundCache
+from services.background_removal import BackgroundRemover
+from services.cache import MemoryLRUCache
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError
+from services.compositing import make_layer, prepare_background, render_variants, resize_logo
+from services.cpu_pool import CpuPool, CpuPoolBusyError, RenderParams
 from services.fusion_brain import FusionBrainAPI
 from services.giga import GigaChatClient, GigaChatAPIError
+from services.logo_cache import LogoCache
+from services.prompt_cache import PromptCache
+from services.model_registry import ModelRegistry
+from services.image_encoding import EncodedImage, ImageEncoder
+from services.jobs import FINISHED_STATUSES, JOB_DONE, JOB_FAILED, JobManager, JobQueueFullError
+
+try:
+    import psutil
+    PROCESS_START_TIME = psutil.Process().create_time()  # включает запуск интерпретатора и импорты
+except ImportError:
+    PROCESS_START_TIME = time.time()
 
 # Load environment variables
 load_dotenv()
@@ -24,101 +47,262 @@ API_KEY = os.environ.get('FUSION_API_KEY')
 SECRET_KEY = os.environ.get('FUSION_SECRET_KEY')
 TARGET_WIDTH = int(os.environ.get('TARGET_WIDTH', 1032))
 TARGET_HEIGHT = int(os.environ.get('TARGET_HEIGHT', 648))
-UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 PLACEHOLDERS_FOLDER = 'placeholders'  # Добавляем папку для шаблонов
+# Заглушки фона по стилю генерации (для предпросмотра, пока фон ещё не сгенерирован,
+# и вместо генерации, пока FusionBrain недоступен)
+PLACEHOLDER_BY_STYLE = {
+    'DEFAULT': 'default.png',
+    'KANDINSKY': 'kandinsky.png',
+    'UHD': 'uhd.png',
+    'ANIME': 'anime.png',
+}
 CARD_TEMPLATE_PATH = os.path.join(os.environ.get('CARD_TEMPLATE_PATH', 'placeholders'), 'card-vanished.png')
 
+# FusionBrain connection pool and pipeline ID cache
+FUSION_POOL_SIZE = int(os.environ.get('FUSION_POOL_SIZE', 20))
+FUSION_PIPELINE_TTL = float(os.environ.get('FUSION_PIPELINE_TTL', 3600))
+
+# Async upstream clients (asgi.py): connections per client in the shared httpx pool
+ASYNC_HTTP_POOL_SIZE = int(os.environ.get('ASYNC_HTTP_POOL_SIZE', 100))
+
+# FusionBrain status polling (shared scheduler for all pending generations)
+FUSION_POLL_MIN_DELAY = float(os.environ.get('FUSION_POLL_MIN_DELAY', 1.0))
+FUSION_POLL_MAX_DELAY = float(os.environ.get('FUSION_POLL_MAX_DELAY', 10.0))
+FUSION_POLL_TIMEOUT = float(os.environ.get('FUSION_POLL_TIMEOUT', 100.0))
+
+# FusionBrain circuit breaker: при частых ошибках, таймаутах или медленных ответах запросы к API
+# на время прекращаются, и /generate-card сразу отдаёт заглушку стиля (ответ помечается X-Degraded)
+FUSION_BREAKER_ENABLED = os.environ.get('FUSION_BREAKER_ENABLED', 'True').lower() == 'true'
+FUSION_BREAKER_FAILURE_RATE = float(os.environ.get('FUSION_BREAKER_FAILURE_RATE', 0.5))  # доля неудач в окне
+FUSION_BREAKER_MIN_CALLS = int(os.environ.get('FUSION_BREAKER_MIN_CALLS', 5))  # меньше вызовов в окне — не судим
+FUSION_BREAKER_WINDOW = float(os.environ.get('FUSION_BREAKER_WINDOW', 60))  # s
+FUSION_BREAKER_SLOW_CALL = float(os.environ.get('FUSION_BREAKER_SLOW_CALL', 10))  # s, более медленный запрос = неудача
+FUSION_BREAKER_OPEN_SECONDS = float(os.environ.get('FUSION_BREAKER_OPEN_SECONDS', 30))  # s до пробного запроса
+FUSION_FALLBACK = os.environ.get('FUSION_FALLBACK', 'placeholder').lower()  # placeholder / error (сразу 503)
+
+# Model loading: 'background' (warm up in a thread, /readyz reports when done),
+# 'eager' (load before serving) or 'lazy' (load on first use)
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', 'background').lower()
+MODEL_RETRY_SECONDS = float(os.environ.get('MODEL_RETRY_SECONDS', 30))  # s до повтора неудачной загрузки, удваивается
+
+# NSFW detector micro-batching
+NSFW_BATCH_SIZE = int(os.environ.get('NSFW_BATCH_SIZE', 8))
+NSFW_BATCH_WAIT_MS = float(os.environ.get('NSFW_BATCH_WAIT_MS', 10))
+NSFW_QUEUE_SIZE = int(os.environ.get('NSFW_QUEUE_SIZE', 256))
+NSFW_INPUT_SIZE = int(os.environ.get('NSFW_INPUT_SIZE', 224))  # px, вход модели; изображения уменьшаются до него
+NSFW_BACKEND = os.environ.get('NSFW_BACKEND', 'transformers').lower()  # transformers / onnx
+NSFW_ONNX_DIR = os.environ.get('NSFW_ONNX_DIR', os.path.join('cache', 'nsfw_onnx'))  # экспорт при первой загрузке
+NSFW_ONNX_QUANTIZE = os.environ.get('NSFW_ONNX_QUANTIZE', 'True').lower() == 'true'  # int8 веса
+NSFW_ONNX_THREADS = int(os.environ.get('NSFW_ONNX_THREADS', 0))  # 0 = по числу ядер
+
+# Logo background removal (rembg)
+REMBG_MODEL = os.environ.get('REMBG_MODEL', 'u2net')  # u2net / u2netp / isnet / silueta
+REMBG_POOL_SIZE = int(os.environ.get('REMBG_POOL_SIZE', 0))  # 0 = по числу ядер
+REMBG_MAX_SIDE = int(os.environ.get('REMBG_MAX_SIDE', 1024))  # px, большие логотипы уменьшаются
+
+# Cache of processed logos (keyed by SHA-256 of the upload)
+LOGO_CACHE_MEMORY_MB = int(os.environ.get('LOGO_CACHE_MEMORY_MB', 64))
+LOGO_CACHE_DIR = os.environ.get('LOGO_CACHE_DIR', os.path.join('cache', 'logos'))  # пусто = без дискового уровня
+LOGO_CACHE_DISK_MB = int(os.environ.get('LOGO_CACHE_DISK_MB', 512))
+
+# Generated background cache (prompt, style, size, pipeline) -> image
+BACKGROUND_CACHE_DIR = os.environ.get('BACKGROUND_CACHE_DIR', os.path.join('cache', 'backgrounds'))  # пусто = без кэша
+BACKGROUND_CACHE_DISK_MB = int(os.environ.get('BACKGROUND_CACHE_DISK_MB', 1024))
+
+# Output encoding (format is negotiated per request via `format` or the Accept header)
+OUTPUT_DEFAULT_FORMAT = os.environ.get('OUTPUT_DEFAULT_FORMAT', 'png')
+OUTPUT_PNG_COMPRESS_LEVEL = int(os.environ.get('OUTPUT_PNG_COMPRESS_LEVEL', 6))
+OUTPUT_PNG_OPTIMIZE = os.environ.get('OUTPUT_PNG_OPTIMIZE', 'False').lower() == 'true'
+OUTPUT_WEBP_QUALITY = int(os.environ.get('OUTPUT_WEBP_QUALITY', 85))
+OUTPUT_WEBP_METHOD = int(os.environ.get('OUTPUT_WEBP_METHOD', 4))  # 0 - быстрее, 6 - компактнее
+OUTPUT_JPEG_QUALITY = int(os.environ.get('OUTPUT_JPEG_QUALITY', 90))
+OUTPUT_JPEG_OPTIMIZE = os.environ.get('OUTPUT_JPEG_OPTIMIZE', 'False').lower() == 'true'
+
+# Background job executor for /generate-card/jobs (jobs live in process memory: one worker or sticky routing)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 16))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 500))
+JOB_TTL = int(os.environ.get('JOB_TTL', 600))  # seconds to keep finished jobs
+
+# Interactive preview (/preview): уменьшенный рендер по слоям, закэшированным на сессию
+PREVIEW_SCALE = float(os.environ.get('PREVIEW_SCALE', 0.25))  # доля от TARGET_WIDTH x TARGET_HEIGHT
+PREVIEW_TTL = float(os.environ.get('PREVIEW_TTL', 600))  # s с последнего обращения
+PREVIEW_CACHE_MB = int(os.environ.get('PREVIEW_CACHE_MB', 64))
+PREVIEW_JPEG_QUALITY = int(os.environ.get('PREVIEW_JPEG_QUALITY', 70))
+
+# CPU-bound image stages (rembg, autocontrast, resize, encode) in a process pool
+CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', 0))  # 0 = в потоках запросов, без пула
+CPU_POOL_MAX_PENDING = int(os.environ.get('CPU_POOL_MAX_PENDING', 0))  # 0 = 2 x число процессов/ядер
+CPU_POOL_QUEUE_TIMEOUT = float(os.environ.get('CPU_POOL_QUEUE_TIMEOUT', 5))  # s ожидания слота, затем 503
+
+# Batch rendering limits (/generate-card/batch)
+BATCH_MAX_BACKGROUNDS = int(os.environ.get('BATCH_MAX_BACKGROUNDS', 10))
+BATCH_MAX_SPECS = int(os.environ.get('BATCH_MAX_SPECS', 50))
+
+# Metrics: /metrics (Prometheus; с gunicorn задайте PROMETHEUS_MULTIPROC_DIR) и заголовок Server-Timing
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'False').lower() == 'true'
+
+# Upload limits: больший файл или изображение отклоняется (413) до декодирования; 0 = без ограничения
+UPLOAD_MAX_MB = float(os.environ.get('UPLOAD_MAX_MB', 20))  # на один файл
+UPLOAD_MAX_MEGAPIXELS = float(os.environ.get('UPLOAD_MAX_MEGAPIXELS', 24))  # после уменьшенного декодирования JPEG
+REQUEST_MAX_MB = float(os.environ.get('REQUEST_MAX_MB', 64))  # тело запроса целиком (MAX_CONTENT_LENGTH)
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * 1024 * 1024)
+UPLOAD_MAX_PIXELS = int(UPLOAD_MAX_MEGAPIXELS * 1_000_000)
+MAX_CONTENT_LENGTH = int(REQUEST_MAX_MB * 1024 * 1024) or None
+
 GIGA_CLIENT_ID = os.environ.get('GIGA_CLIENT_ID')
 GIGA_CLIENT_SECRET = os.environ.get('GIGA_CLIENT_SECRET')
 GIGA_SCOPE = os.environ.get("GIGACHAT_SCOPE", "GIGACHAT_API_PERS")
 GIGA_VERIFY_SSL = os.environ.get("GIGA_VERIFY_SSL", "False").lower() != "false"
+# Файл, через который воркеры делят токен GigaChat (пусто = у каждого воркера свой токен)
+GIGA_TOKEN_CACHE = os.environ.get('GIGA_TOKEN_CACHE', os.path.join('cache', 'giga_token.json'))
+GIGA_TOKEN_REFRESH_MARGIN = float(os.environ.get('GIGA_TOKEN_REFRESH_MARGIN', 300))  # s до истечения
 
 # System prompt for improving prompts
 SYSTEM_PROMPT_IMPROVER = os.environ.get('PROMPT_SYSTEM', """Роль: AI-улучшатель промптов для генерации изображений""")
+PROMPT_MODEL = os.environ.get('PROMPT_MODEL', 'GigaChat')
+
+# Improved prompt cache
+PROMPT_CACHE_TTL = float(os.environ.get('PROMPT_CACHE_TTL', 7 * 24 * 3600))  # s
+PROMPT_CACHE_MEMORY_MB = int(os.environ.get('PROMPT_CACHE_MEMORY_MB', 16))
+PROMPT_CACHE_DIR = os.environ.get('PROMPT_CACHE_DIR', os.path.join('cache', 'prompts'))  # пусто = без дискового уровня
+PROMPT_CACHE_DISK_MB = int(os.environ.get('PROMPT_CACHE_DISK_MB', 64))
 
-# Create folders if they don't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+OUTPUT_ENCODER_SETTINGS = dict(
+    default_format=OUTPUT_DEFAULT_FORMAT,
+    png_compress_level=OUTPUT_PNG_COMPRESS_LEVEL,
+    png_optimize=OUTPUT_PNG_OPTIMIZE,
+    webp_quality=OUTPUT_WEBP_QUALITY,
+    webp_method=OUTPUT_WEBP_METHOD,
+    jpeg_quality=OUTPUT_JPEG_QUALITY,
+    jpeg_optimize=OUTPUT_JPEG_OPTIMIZE,
+)
+
+# Пул процессов создаётся первым: процессы форкаются до запуска фоновых потоков приложения
+cpu_pool = CpuPool(
+    workers=CPU_POOL_WORKERS,
+    max_pending=CPU_POOL_MAX_PENDING or None,
+    queue_timeout=CPU_POOL_QUEUE_TIMEOUT,
+    rembg_model=REMBG_MODEL,
+    rembg_max_side=REMBG_MAX_SIDE,
+    template_path=CARD_TEMPLATE_PATH,
+    encoder_settings=OUTPUT_ENCODER_SETTINGS,
+)
+if __name__ != '__mp_main__':  # при spawn (Windows) модуль импортируется в процессах пула
+    cpu_pool.start()
 
 # Инициализируем клиенты один раз при старте приложения
 try:
-    giga_client = GigaChatClient(GIGA_CLIENT_ID, GIGA_CLIENT_SECRET, scope=GIGA_SCOPE, verify_ssl=GIGA_VERIFY_SSL)
+    giga_client = GigaChatClient(GIGA_CLIENT_ID, GIGA_CLIENT_SECRET, scope=GIGA_SCOPE, verify_ssl=GIGA_VERIFY_SSL,
+                                 token_cache_path=GIGA_TOKEN_CACHE or None,
+                                 token_refresh_margin=GIGA_TOKEN_REFRESH_MARGIN)
+    giga_client.prefetch_token()  # OAuth запрос не попадает в первый /improve-prompt
 except ValueError as e:
     print(f"Ошибка инициализации GigaChatClient: {e}")
     giga_client = None  # Устанавливаем в None, чтобы обработать это в роуте
 
+# Общий для синхронного и асинхронного (asgi.py) клиентов FusionBrain в этом процессе
+fusion_breaker = CircuitBreaker('fusionbrain', failure_rate=FUSION_BREAKER_FAILURE_RATE,
+                                min_calls=FUSION_BREAKER_MIN_CALLS, window=FUSION_BREAKER_WINDOW,
+                                slow_call_seconds=FUSION_BREAKER_SLOW_CALL, open_seconds=FUSION_BREAKER_OPEN_SECONDS,
+                                enabled=FUSION_BREAKER_ENABLED)
+
 try:
-    fusion_api_client = FusionBrainAPI(API_URL, API_KEY, SECRET_KEY)
+    fusion_api_client = FusionBrainAPI(API_URL, API_KEY, SECRET_KEY, poll_min_delay=FUSION_POLL_MIN_DELAY,
+                                       poll_max_delay=FUSION_POLL_MAX_DELAY, poll_timeout=FUSION_POLL_TIMEOUT,
+                                       pool_size=FUSION_POOL_SIZE, pipeline_ttl=FUSION_PIPELINE_TTL,
+                                       breaker=fusion_breaker)
 except Exception as e:
     print(f"!!! ОШИБКА инициализации FusionBrainAPI: {e}")
     fusion_api_client = None
 
-nsfw_check_client = nsfw_detector.NsfwDetector()
+# Тяжёлые модели создаются лениво через реестр, чтобы импорт приложения был быстрым
+model_registry = ModelRegistry(started_at=PROCESS_START_TIME, retry_seconds=MODEL_RETRY_SECONDS)
+model_registry.register('nsfw', lambda: nsfw_detector.NsfwDetector(
+    batch_size=NSFW_BATCH_SIZE, max_wait_ms=NSFW_BATCH_WAIT_MS, queue_size=NSFW_QUEUE_SIZE, backend=NSFW_BACKEND,
+    onnx_dir=NSFW_ONNX_DIR, onnx_quantize=NSFW_ONNX_QUANTIZE, onnx_threads=NSFW_ONNX_THREADS))
+
+
+def _create_background_remover():
+    if cpu_pool.enabled:
+        cpu_pool.warm_up_rembg()  # модель загружается в процессах пула, remove() выполняется там же
+        return cpu_pool
+    return BackgroundRemover(REMBG_MODEL, pool_size=REMBG_POOL_SIZE or None, max_side=REMBG_MAX_SIDE)
+
+
+model_registry.register('rembg', _create_background_remover)
+
+# Каталог дискового кэша разделяем по модели rembg и REMBG_MAX_SIDE: результат зависит от обоих.
+# Память кэша живёт в одном процессе с неизменной конфигурацией, ключу эти параметры не нужны
+logo_cache = LogoCache(
+    LOGO_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_dir=os.path.join(LOGO_CACHE_DIR, f"{REMBG_MODEL}-{REMBG_MAX_SIDE or 'full'}") if LOGO_CACHE_DIR else None,
+    disk_bytes=LOGO_CACHE_DISK_MB * 1024 * 1024,
+)
+
+# Одинаковые генерации присоединяются к уже идущей задаче даже без дискового кэша
+background_cache = BackgroundCache(
+    disk_dir=BACKGROUND_CACHE_DIR or None,
+    disk_bytes=BACKGROUND_CACHE_DISK_MB * 1024 * 1024,
+)
+
+prompt_cache = PromptCache(
+    SYSTEM_PROMPT_IMPROVER, PROMPT_MODEL,
+    ttl=PROMPT_CACHE_TTL,
+    memory_bytes=PROMPT_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_dir=PROMPT_CACHE_DIR or None,
+    disk_bytes=PROMPT_CACHE_DISK_MB * 1024 * 1024,
+)
+metrics.register_caches({'prompts': prompt_cache, 'logos': logo_cache, 'backgrounds': background_cache})
+
+# Слои предпросмотра живут в памяти воркера; при промахе клиент создаёт сессию заново
+preview_sessions = MemoryLRUCache(PREVIEW_CACHE_MB * 1024 * 1024, ttl=PREVIEW_TTL)
+
+image_encoder = ImageEncoder(**OUTPUT_ENCODER_SETTINGS)
+
+job_manager = JobManager(max_workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, ttl=JOB_TTL)
 
 # --- Pre-load Card Template ---
-CARD_TEMPLATE_IMAGE = None
-try:
-    if not os.path.exists(CARD_TEMPLATE_PATH):
-        print(f"!!! ОШИБКА: Файл шаблона карты не найден по пути: {CARD_TEMPLATE_PATH}")
-        # Можно либо прервать выполнение, либо продолжить без шаблона,
-        # но лучше сообщить об ошибке. Для простоты пока оставляем None.
-    else:
-        print(f"Загрузка шаблона карты из: {CARD_TEMPLATE_PATH}")
-        template_img = Image.open(CARD_TEMPLATE_PATH).convert("RGBA")
-        # Сразу изменим размер шаблона под целевой размер карты для эффективности
-        if template_img.size != (TARGET_WIDTH, TARGET_HEIGHT):
-            print(f"Изменение размера шаблона карты с {template_img.size} до {TARGET_WIDTH}x{TARGET_HEIGHT}")
-            CARD_TEMPLATE_IMAGE = template_img.resize((TARGET_WIDTH, TARGET_HEIGHT), Image.Resampling.LANCZOS)
-        else:
-            CARD_TEMPLATE_IMAGE = template_img
-        print("Шаблон карты успешно загружен и подготовлен.")
+def get_card_template(width: int, height: int) -> Image.Image | None:
+    """Шаблон карты нужного размера (см. compositing.get_card_template). Общий, не изменять."""
+    return compositing.get_card_template(CARD_TEMPLATE_PATH, width, height)
 
-except Exception as e:
-    print(f"!!! КРИТИЧЕСКАЯ ОШИБКА при загрузке/обработке шаблона карты: {e}")
+
+# Сразу подготовим шаблон под целевой размер карты
+CARD_TEMPLATE_IMAGE = get_card_template(TARGET_WIDTH, TARGET_HEIGHT)
+if CARD_TEMPLATE_IMAGE is not None:
+    compositing.get_card_template_layer(CARD_TEMPLATE_PATH, TARGET_WIDTH, TARGET_HEIGHT)
+    print("Шаблон карты успешно загружен и подготовлен.")
+
+# --- Model Warm-up & Cold Start ---
+if MODEL_WARMUP == 'eager':
+    model_registry.warm_up(background=False)
+elif MODEL_WARMUP == 'background':
+    model_registry.warm_up()
+
+APP_INIT_SECONDS = time.time() - PROCESS_START_TIME
+print(f"Холодный старт: приложение инициализировано за {APP_INIT_SECONDS:.2f} s (models: {MODEL_WARMUP})")
 
 
 # --- Image Composition Function (Minor refactoring for clarity) ---
-def overlay_logo(background_base64, logo_bytes, logo_x_rel, logo_y_rel, logo_scale, card_width, card_height):
-    """Overlays logo (already processed by rembg) onto background (as base64)."""
-    try:
-        # ... (код декодирования background, ретуши, проверки размера фона остается прежним) ...
-        bg_image_data = base64.b64decode(background_base64)
-        background = Image.open(io.BytesIO(bg_image_data)).convert("RGBA")
-        background = ImageOps.autocontrast(background.convert("RGB"), cutoff=0.5).convert("RGBA")
-        if background.size != (card_width, card_height):
-            print(
-                f"Warning: Background size {background.size} differs from target {card_width}x{card_height}. Resizing.")
-            background = background.resize((card_width, card_height), Image.Resampling.LANCZOS)
-
-        # ... (код открытия логотипа, расчета размера и позиции остается прежним) ...
-        logo = Image.open(io.BytesIO(logo_bytes)).convert("RGBA")
-        base_max_logo_w = card_width * 0.25
-        aspect_ratio = logo.height / logo.width
-        target_logo_w = int(base_max_logo_w * logo_scale)
-        target_logo_h = int(target_logo_w * aspect_ratio)
-        target_logo_w = max(target_logo_w, 5)
-        target_logo_h = max(target_logo_h, 5)
-        logo = logo.resize((target_logo_w, target_logo_h), Image.Resampling.LANCZOS)
-        logo_w, logo_h = logo.size
-        center_x_px = logo_x_rel * card_width
-        center_y_px = logo_y_rel * card_height
-        paste_x = int(center_x_px - (logo_w / 2))
-        paste_y = int(center_y_px - (logo_h / 2))
-        paste_x = max(0, min(paste_x, card_width - logo_w))
-        paste_y = max(0, min(paste_y, card_height - logo_h))
-        paste_position = (paste_x, paste_y)
-        print(f"Calculated paste position (top-left): {paste_position}")
-
-        # Paste logo
-        background.paste(logo, paste_position, logo)
-        print("Логотип наложен на фон.")  # Убедимся, что логотип наложен
-
-        # Save final image (только фон + лого) to buffer
-        final_image_buffer = io.BytesIO()
-        background.save(final_image_buffer, format='PNG')
-        final_image_buffer.seek(0)
-
-        return final_image_buffer  # Возвращаем буфер БЕЗ шаблона карты
+def apply_card_template(design: Image.Image) -> Image.Image:
+    """Накладывает подготовленный шаблон карты поверх дизайна (фон + лого)."""
+    return compositing.apply_card_template(design, CARD_TEMPLATE_PATH)
 
+
+def overlay_logo(background: Image.Image, logo: Image.Image, logo_x_rel, logo_y_rel, logo_scale,
+                 card_width, card_height, with_template: bool = False, output_format: str = 'png',
+                 quality: int | None = None) -> io.BytesIO:
+    """
+    Overlays logo onto background and returns an encoded image buffer (PNG by default).
+    with_template=True возвращает готовую карту с шаблоном, иначе только дизайн (фон + лого).
+    """
+    try:
+        variant = 'card' if with_template else 'design'
+        image = render_variants(prepare_background(background, card_width, card_height),
+                                resize_logo(logo, logo_scale, card_width), logo_x_rel, logo_y_rel,
+                                (variant,), CARD_TEMPLATE_PATH)[variant]
+        encoded = image_encoder.encode(image, output_format, quality=quality)
+        return io.BytesIO(encoded.data)
     except Exception as e:
         print(f"Error during image composition: {e}")
         raise
@@ -126,6 +310,28 @@ def overlay_logo(background_base64, logo_bytes, logo_x_rel, logo_y_rel, logo_sca
 
 # --- Flask App ---
 app = Flask(__name__, static_folder='.', static_url_path='')
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"error": f"Запрос слишком большой (максимум {REQUEST_MAX_MB:g} МБ)."}), 413
+
+
+@app.before_request
+def start_server_timing():
+    if SERVER_TIMING:
+        g.request_started = time.perf_counter()
+        g.timing_token = metrics.start_request_timing()
+
+
+@app.after_request
+def add_server_timing(response):
+    token = g.pop('timing_token', None)
+    if token is not None:
+        value = metrics.finish_request_timing(token, time.perf_counter() - g.request_started)
+        response.headers['Server-Timing'] = value
+    return response
 
 
 @app.route('/')
@@ -133,30 +339,89 @@ def index():
     return app.send_static_file('index.html')
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz_endpoint():
+    """Liveness: процесс жив и обрабатывает запросы."""
+    return jsonify({"status": "ok"})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz_endpoint():
+    """Readiness: модели загружены, воркер можно включать в балансировку."""
+    # в lazy режиме модели грузятся по первому запросу, но неудачная загрузка снимает готовность
+    ready = model_registry.is_ready() or (MODEL_WARMUP == 'lazy' and not model_registry.has_failures())
+    if not ready:
+        model_registry.retry_failed()  # повтор неудачной загрузки в фоне, пока балансировщик опрашивает
+    ready_at = model_registry.ready_at
+    body = {
+        "ready": ready,
+        "models": model_registry.status(),
+        "cold_start": {
+            "init_seconds": round(APP_INIT_SECONDS, 3),
+            "models_ready_seconds": round(ready_at - PROCESS_START_TIME, 3) if ready_at else None,
+        },
+        # на готовность не влияет: без FusionBrain карты собираются с заглушкой фона
+        "upstreams": {"fusionbrain": fusion_breaker.stats()},
+    }
+    return jsonify(body), 200 if ready else 503
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats_endpoint():
+    """Счётчики попаданий/промахов кэшей приложения (в пределах текущего воркера)."""
+    return jsonify({
+        "prompts": prompt_cache.stats(),
+        "logos": logo_cache.stats(),
+        "backgrounds": background_cache.stats(),
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики Prometheus: гистограммы этапов генерации, ответы внешних API, попадания в кэши."""
+    if not metrics.available():
+        return jsonify({"error": "Метрики недоступны: prometheus_client не установлен."}), 503
+    body, content_type = metrics.render_latest()
+    return Response(body, content_type=content_type)
+
+
+def _request_prompt() -> str | None:
+    """Поле prompt из JSON тела запроса; None, если тело не объект или prompt не строка."""
+    data = request.get_json(silent=True)
+    user_prompt = data.get('prompt') if isinstance(data, dict) else None
+    return user_prompt if isinstance(user_prompt, str) else None
+
+
 @app.route('/improve-prompt', methods=['POST'])
 def improve_prompt_endpoint():
+    user_prompt = _request_prompt()
+    if not user_prompt:
+        return jsonify({"error": "Промпт не может быть пустым."}), 400
+    cache_key = prompt_cache.key_for(user_prompt)
+    cached_prompt = prompt_cache.get(cache_key) if cache_key else None
+    if cached_prompt:
+        print(f"Prompt cache hit: '{user_prompt}'")
+        return jsonify({"improved_prompt": cached_prompt, "cached": True})
+
     if not giga_client:
         return jsonify({"error": "Сервис улучшения промптов временно недоступен (ошибка конфигурации)."}), 503
 
     try:
-        data = request.get_json()
-        user_prompt = data.get('prompt')
-
-        if not user_prompt:
-            return jsonify({"error": "Промпт не может быть пустым."}), 400
-
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT_IMPROVER},
             {"role": "user", "content": user_prompt}
         ]
 
         print(f"Отправка промпта '{user_prompt}' в GigaChat для улучшения...")
-        response = giga_client.chat(messages, model="GigaChat")  # Используем GigaChat-Pro или другую подходящую модель
+        with metrics.stage_timer('gigachat'):
+            response = giga_client.chat(messages, model=PROMPT_MODEL)
 
         if response and "choices" in response and response["choices"]:
             improved_prompt = response["choices"][0].get("message", {}).get("content")
             if improved_prompt:
                 print(f"GigaChat вернул улучшенный промпт: {improved_prompt}")
+                if cache_key:
+                    prompt_cache.put(cache_key, improved_prompt.strip())
                 return jsonify({"improved_prompt": improved_prompt.strip()})
             else:
                 print("GigaChat API вернул ответ без контента.")
@@ -176,165 +441,928 @@ def improve_prompt_endpoint():
         return jsonify({"error": "Внутренняя ошибка сервера при улучшении промпта."}), 500
 
 
-@app.route('/generate-card', methods=['POST'])
-def generate_card_endpoint():
+@app.route('/improve-prompt/stream', methods=['POST'])
+def improve_prompt_stream_endpoint():
+    """
+    Потоковое улучшение промпта (Server-Sent Events): фрагменты текста отправляются
+    событиями 'token' по мере генерации, итоговый промпт — событием 'done'.
+    Ошибки до начала потока возвращаются обычным JSON с кодом ответа, как в /improve-prompt.
+    Промпт из кэша отдаётся сразу одним событием 'done'.
+    """
+    user_prompt = _request_prompt()
+    if not user_prompt:
+        return jsonify({"error": "Промпт не может быть пустым."}), 400
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    cache_key = prompt_cache.key_for(user_prompt)
+    cached_prompt = prompt_cache.get(cache_key) if cache_key else None
+    if cached_prompt:
+        print(f"Prompt cache hit: '{user_prompt}'")
+        return Response(sse('done', {"improved_prompt": cached_prompt, "cached": True}),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    if not giga_client:
+        return jsonify({"error": "Сервис улучшения промптов временно недоступен (ошибка конфигурации)."}), 503
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT_IMPROVER},
+        {"role": "user", "content": user_prompt}
+    ]
+
+    print(f"Отправка промпта '{user_prompt}' в GigaChat для потокового улучшения...")
     start_time = time.time()
-    print("\n--- Received request for card generation ---")
+    try:
+        chunks = giga_client.chat_stream(messages, model=PROMPT_MODEL)
+    except GigaChatAPIError as e:
+        print(f"Ошибка GigaChat API при улучшении промпта: {e}")
+        return jsonify({"error": f"Ошибка сервиса улучшения промптов: {e.message}"}), e.status_code
+    except requests.exceptions.RequestException as e:
+        print(f"Сетевая ошибка при обращении к GigaChat: {e}")
+        return jsonify({"error": "Сетевая ошибка при обращении к сервису улучшения промптов."}), 504
+
+    def stream():
+        parts = []
+        try:
+            for content in chunks:
+                if not parts:
+                    print(f"GigaChat: первый фрагмент через {time.time() - start_time:.2f} s")
+                parts.append(content)
+                yield sse('token', {"content": content})
+        except Exception as e:
+            print(f"Ошибка потока GigaChat при улучшении промпта: {e}")
+            yield sse('error', {"error": "Поток ответа сервиса улучшения промптов прерван."})
+            return
+        finally:
+            chunks.close()  # закрывает соединение с GigaChat, в том числе если клиент отключился
+        improved_prompt = ''.join(parts).strip()
+        if not improved_prompt:
+            print("GigaChat API вернул поток без контента.")
+            yield sse('error', {"error": "Не удалось получить улучшенный промпт от GigaChat."})
+            return
+        print(f"GigaChat вернул улучшенный промпт за {time.time() - start_time:.2f} s: {improved_prompt}")
+        metrics.observe_stage('gigachat', time.time() - start_time)
+        if cache_key:
+            prompt_cache.put(cache_key, improved_prompt)
+        yield sse('done', {"improved_prompt": improved_prompt})
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- Card Generation Pipeline ---
+class CardGenerationError(Exception):
+    """Ошибка этапа генерации карты, которую нужно вернуть клиенту в виде JSON."""
+    def __init__(self, message, status_code=500, nsfw_detected=False):
+        self.message = message
+        self.status_code = status_code
+        self.nsfw_detected = nsfw_detected
+        super().__init__(message)
+
+    def to_dict(self):
+        body = {"error": self.message}
+        if self.nsfw_detected:
+            body["nsfw_detected"] = True  # СПЕЦИАЛЬНЫЙ ФЛАГ ДЛЯ FRONTEND
+        return body
+
+
+@dataclass
+class CardRequest:
+    """
+    Параметры генерации карты. Файлы читаются из формы целиком,
+    чтобы запрос можно было обработать вне контекста Flask (в фоновой задаче).
+    """
+    mode: str  # 'generate' or 'upload'
+    logo_filename: str
+    logo_bytes: bytes
+    logo_x_rel: float  # 0.0-1.0
+    logo_y_rel: float  # 0.0-1.0
+    logo_scale: float  # e.g. 0.2-1.0
+    prompt: str | None = None
+    style: str | None = None
+    background_bytes: bytes | None = None
+    output: str = 'design'  # 'design' (фон + лого), 'card' (с шаблоном карты) или 'both'
+    output_format: str = 'png'  # выбирается по параметру format или заголовку Accept
+    quality: int | None = None  # WebP/JPEG, 1-100
+    compress_level: int | None = None  # PNG, 0-9
+    fresh: bool = False  # генерировать фон заново, не используя кэш
+    degraded: bool = False  # вместо генерации использована заглушка (FusionBrain недоступен)
+
 
-    # --- Common Data ---
-    if 'logo' not in request.files:
-        return jsonify({"error": "Логотип не был загружен."}), 400
-    logo_file = request.files['logo']
+def _get_model(name: str):
+    """Возвращает модель из реестра (загружая при первом обращении) или 503, если она недоступна."""
+    model = model_registry.get(name)
+    if model is None:
+        raise CardGenerationError("Сервис обработки изображений временно недоступен.", 503)
+    return model
 
+
+CARD_OUTPUTS = ('design', 'card', 'both')
+
+
+LOGO_SCALE_RANGE = (0.2, 1.0)  # как у ползунка размера логотипа в интерфейсе
+
+
+def logo_placement(logo_x_rel: float, logo_y_rel: float, logo_scale: float) -> tuple[float, float, float]:
+    """
+    Проверяет позицию (доли ширины и высоты) и масштаб логотипа: inf/nan -> CardGenerationError(400),
+    значения вне диапазона прижимаются к границам (x, y — 0-1, масштаб — LOGO_SCALE_RANGE).
+    """
+    if not all(math.isfinite(value) for value in (logo_x_rel, logo_y_rel, logo_scale)):
+        raise CardGenerationError("Некорректные значения для позиции или размера логотипа.", 400)
+    return (min(max(logo_x_rel, 0.0), 1.0), min(max(logo_y_rel, 0.0), 1.0),
+            min(max(logo_scale, LOGO_SCALE_RANGE[0]), LOGO_SCALE_RANGE[1]))
+
+
+def read_logo_placement(values, x_key: str, y_key: str, scale_key: str) -> tuple[float, float, float]:
+    """Позиция и масштаб логотипа из формы или query; нечисловые значения -> CardGenerationError(400)."""
     try:
-        logo_x_rel = request.form.get('logoX', default=0.5, type=float)  # Expecting 0.0-1.0
-        logo_y_rel = request.form.get('logoY', default=0.5, type=float)  # Expecting 0.0-1.0
-        logo_scale = request.form.get('logoScale', default=0.5, type=float)  # Expecting e.g. 0.2-1.0
-        print(f"Received Position/Scale: X={logo_x_rel:.3f}, Y={logo_y_rel:.3f}, Scale={logo_scale:.3f}")
+        # без type=float: Flask молча подставил бы default вместо некорректного значения
+        return logo_placement(float(values.get(x_key, 0.5)), float(values.get(y_key, 0.5)),
+                              float(values.get(scale_key, 0.5)))
     except ValueError:
-        return jsonify({"error": "Некорректные значения для позиции или размера логотипа."}), 400
+        raise CardGenerationError("Некорректные значения для позиции или размера логотипа.", 400)
 
-    mode = request.form.get('mode')  # 'generate' or 'upload'
+
+def parse_encoding_options(values, accept: str | None = None) -> tuple[str, int | None, int | None]:
+    """Формат (format или Accept), quality (WebP/JPEG) и compressLevel (PNG) результата."""
+    try:
+        output_format = image_encoder.negotiate(accept, values.get('format'))
+        quality = values.get('quality', type=int)
+        compress_level = values.get('compressLevel', type=int)
+    except ValueError as e:
+        raise CardGenerationError(f"Некорректные параметры кодирования изображения: {e}", 400)
+    if quality is not None and not 1 <= quality <= 100:
+        raise CardGenerationError("Параметр quality должен быть от 1 до 100.", 400)
+    if compress_level is not None and not 0 <= compress_level <= 9:
+        raise CardGenerationError("Параметр compressLevel должен быть от 0 до 9.", 400)
+    return output_format, quality, compress_level
+
+
+def parse_card_request(req) -> CardRequest:
+    """Проверяет форму запроса и собирает CardRequest. Ошибки валидации -> CardGenerationError(400)."""
+    if 'logo' not in req.files:
+        raise CardGenerationError("Логотип не был загружен.", 400)
+    logo_file = req.files['logo']
+
+    logo_x_rel, logo_y_rel, logo_scale = read_logo_placement(req.form, 'logoX', 'logoY', 'logoScale')
+    print(f"Received Position/Scale: X={logo_x_rel:.3f}, Y={logo_y_rel:.3f}, Scale={logo_scale:.3f}")
+
+    mode = req.form.get('mode')  # 'generate' or 'upload'
 
     print(f"Received Data: Mode='{mode}', Logo='{logo_file.filename}'")
 
     if not mode or mode not in ['generate', 'upload']:
-        return jsonify({"error": "Некорректный режим работы."}), 400
+        raise CardGenerationError("Некорректный режим работы.", 400)
     if logo_file.filename == '':
-        return jsonify({"error": "Не выбран файл логотипа."}), 400
+        raise CardGenerationError("Не выбран файл логотипа.", 400)
+
+    output = req.form.get('output', 'design')
+    if output not in CARD_OUTPUTS:
+        raise CardGenerationError("Некорректный формат результата.", 400)
 
-    # --- Process Logo (Save & Remove Background) ---
-    logo_path = None  # Initialize logo_path
-    processed_logo_bytes = None
+    output_format, quality, compress_level = parse_encoding_options(req.values, req.headers.get('Accept'))
+
+    card_request = CardRequest(
+        mode=mode,
+        logo_filename=logo_file.filename,
+        logo_bytes=read_upload(logo_file, LOGO_DECODE_SIZE),
+        logo_x_rel=logo_x_rel,
+        logo_y_rel=logo_y_rel,
+        logo_scale=logo_scale,
+        output=output,
+        output_format=output_format,
+        quality=quality,
+        compress_level=compress_level,
+    )
+
+    if mode == 'generate':
+        card_request.prompt = req.form.get('prompt')
+        card_request.style = req.form.get('style')
+        card_request.fresh = req.values.get('fresh', 'false').lower() in ('1', 'true', 'yes')
+        print(f"Generate Mode: Prompt='{card_request.prompt}', Style='{card_request.style}'")
+        if not card_request.prompt:  # Style can be DEFAULT
+            raise CardGenerationError("Необходимо ввести промпт для генерации.", 400)
+
+    if mode == 'upload':
+        bg_file = req.files.get('background')
+        if bg_file is None or bg_file.filename == '':
+            raise CardGenerationError("Не выбран файл фона.", 400)
+        card_request.background_bytes = read_upload(bg_file, (TARGET_WIDTH, TARGET_HEIGHT))
+
+    return card_request
+
+
+# Этапы конвейера обмениваются декодированными изображениями в памяти:
+#   _process_logo:       CardRequest.logo_bytes -> Image (RGBA, без фона)
+#   _start_background:   CardRequest -> Future[bytes | Image] (base64 из FusionBrain декодируется один раз, в кэше фонов)
+#   _resolve_background: Future -> Image
+#   _compose_card:       Image (логотип) + Image (фон) -> EncodedImage (PNG/WebP/JPEG)
+# Временных файлов и повторного кодирования в base64 нет.
+# Логотип нужен не больше, чем его обрабатывает rembg (REMBG_MAX_SIDE)
+LOGO_DECODE_SIZE = (REMBG_MAX_SIDE, REMBG_MAX_SIDE) if REMBG_MAX_SIDE else None
+
+
+def read_upload(file, target_size: tuple | None = None) -> bytes:
+    """
+    Читает файл формы не больше UPLOAD_MAX_BYTES и проверяет заголовок изображения:
+    слишком большие файлы и изображения отклоняются до декодирования (CardGenerationError 413).
+    """
     try:
-        filename = secure_filename(f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{logo_file.filename}")
-        logo_path = os.path.join(UPLOAD_FOLDER, filename)
-        logo_file.save(logo_path)
-        print(f"Logo saved temporarily to: {logo_path}")
+        data = ingest.read_upload(file, UPLOAD_MAX_BYTES)
+        ingest.open_image(data, UPLOAD_MAX_PIXELS, target_size)
+    except ingest.UploadRejectedError as e:
+        print(f"Upload '{file.filename}' rejected: {e.message}")
+        raise CardGenerationError(e.message, e.status_code)
+    return data
+
+
+def _decode_image(data: bytes, target_size: tuple | None = None) -> Image.Image:
+    """
+    Декодирует изображение из байтов (один раз на весь конвейер). С target_size JPEG
+    декодируется сразу в уменьшенном размере, но не меньше target_size (services.ingest).
+    """
+    with metrics.stage_timer('decode'):
+        return ingest.decode_image(data, UPLOAD_MAX_PIXELS, target_size)
+
+
+def _nsfw_input(image: Image.Image) -> Image.Image:
+    """Уменьшенная RGB копия для детектора NSFW (его модель всё равно работает с NSFW_INPUT_SIZE)."""
+    return ingest.model_input(image, NSFW_INPUT_SIZE)
+
 
+@functools.lru_cache(maxsize=2 * len(PLACEHOLDER_BY_STYLE))
+def _load_placeholder(filename: str, width: int, height: int) -> Image.Image:
+    with Image.open(os.path.join(PLACEHOLDERS_FOLDER, filename)) as placeholder:
+        return ImageOps.fit(placeholder.convert('RGB'), (width, height), Image.Resampling.LANCZOS)
+
+
+def get_placeholder_background(style: str | None, width: int, height: int) -> Image.Image:
+    """Заглушка фона для стиля генерации, кадрированная под width x height (RGB). Общая, не изменять."""
+    filename = PLACEHOLDER_BY_STYLE.get((style or 'DEFAULT').upper(), PLACEHOLDER_BY_STYLE['DEFAULT'])
+    return _load_placeholder(filename, width, height)
+
+
+def _fallback_background(card_request: CardRequest, error: CircuitOpenError) -> Image.Image:
+    """
+    FusionBrain недоступен (circuit breaker открыт): вместо ожидания таймаутов сразу
+    отдаём заглушку выбранного стиля и помечаем результат как degraded.
+    С FUSION_FALLBACK=error запрос сразу завершается 503.
+    """
+    print(f"Background generation skipped: {error}")
+    if FUSION_FALLBACK != 'placeholder':
+        raise CardGenerationError("Генерация фона временно недоступна, попробуйте позже.", 503)
+    metrics.record_fallback('fusionbrain')
+    card_request.degraded = True
+    return get_placeholder_background(card_request.style, TARGET_WIDTH, TARGET_HEIGHT)
+
+
+def _process_logo(card_request: CardRequest, stage) -> Image.Image:
+    """
+    Проверяет логотип на NSFW и удаляет фон. Возвращает RGBA изображение логотипа.
+    Результат кэшируется по SHA-256 загруженного файла, повторная загрузка не запускает модели.
+    """
+    logo_key = logo_cache.key_for(card_request.logo_bytes)
+    cached_logo = logo_cache.get(logo_key)
+    if cached_logo:
+        print(f"Logo cache hit: {logo_key[:12]}")
+        if cached_logo.is_nsfw:
+            print('!!! NSFW LOGO DETECTED (cached) - BLOCKING !!!')
+            raise CardGenerationError("Обнаружено недопустимое содержимое в логотипе.", 400, nsfw_detected=True)
+        return cached_logo.logo
+
+    try:
         # --- NSFW check for logo ---
+        stage('nsfw')
         try:
-            with open(logo_path, 'rb') as f:
-                raw = f.read()
-            img_logo = Image.open(io.BytesIO(raw))
-            if img_logo.mode != 'RGB':
-                img_logo = img_logo.convert('RGB')
+            logo_image = _decode_image(card_request.logo_bytes, LOGO_DECODE_SIZE)
+            img_logo = _nsfw_input(logo_image)
         except Exception as e:
-            if logo_path and os.path.exists(logo_path):
-                os.remove(logo_path)
-            return jsonify({"error": f"Ошибка подготовки логотипа для проверки NSFW: {e}"}), 500
+            raise CardGenerationError(f"Ошибка подготовки логотипа для проверки NSFW: {e}", 500)
 
-        is_logo_nsfw = nsfw_check_client.is_nsfw(img_logo)
-        temp_logo_path_to_remove = logo_path
-        logo_path = None  # Сбрасываем, чтобы finally не удалял его снова
+        with metrics.stage_timer('nsfw'):
+            is_logo_nsfw = _get_model('nsfw').is_nsfw(img_logo)
         if is_logo_nsfw is None:
-            if temp_logo_path_to_remove and os.path.exists(temp_logo_path_to_remove):
-                os.remove(temp_logo_path_to_remove)
-            return jsonify({"error": "Не удалось проверить логотип на недопустимое содержание."}), 500
+            raise CardGenerationError("Не удалось проверить логотип на недопустимое содержание.", 500)
         if is_logo_nsfw:
             print('!!! NSFW LOGO DETECTED - BLOCKING !!!')
-            if temp_logo_path_to_remove and os.path.exists(temp_logo_path_to_remove):
-                os.remove(temp_logo_path_to_remove)
-            # ВОЗВРАЩАЕМ СПЕЦИАЛЬНЫЙ ФЛАГ ДЛЯ FRONTEND
-            return jsonify({"error": "Обнаружено недопустимое содержимое в логотипе.", "nsfw_detected": True}), 400
-
-        with open(temp_logo_path_to_remove, 'rb') as f_in:
-            input_bytes = f_in.read()
-        processed_logo_bytes = remove(input_bytes)  # Remove background
+            logo_cache.put(logo_key, is_nsfw=True)
+            raise CardGenerationError("Обнаружено недопустимое содержимое в логотипе.", 400, nsfw_detected=True)
+
+        stage('remove_background')
+        with metrics.stage_timer('rembg'):
+            processed_logo = _get_model('rembg').remove(logo_image)  # Remove background (PIL in -> PIL out)
         print("Logo background removed.")
-        if temp_logo_path_to_remove and os.path.exists(temp_logo_path_to_remove):
-            os.remove(temp_logo_path_to_remove)
-            print(f"Temporary original logo cleaned up: {temp_logo_path_to_remove}")
+        logo_cache.put(logo_key, is_nsfw=False, logo=processed_logo)
+        return processed_logo
 
+    except CardGenerationError:
+        raise
+    except CpuPoolBusyError as e:
+        print(f"Logo processing rejected: {e}")
+        raise CardGenerationError("Сервер перегружен, попробуйте позже.", 503)
     except Exception as e:
         print(f"Error processing logo: {e}")
-        # Убедимся, что временный файл удален в случае любой другой ошибки
-        if 'temp_logo_path_to_remove' in locals() and temp_logo_path_to_remove and os.path.exists(
-                temp_logo_path_to_remove):
-            os.remove(temp_logo_path_to_remove)
-        return jsonify({"error": f"Ошибка обработки логотипа: {e}"}), 500
-
-    # --- Get Background (Generate or Upload) ---
-    background_base64 = None
-    try:
-        if mode == 'generate':
-            prompt = request.form.get('prompt')
-            style = request.form.get('style')
-            print(f"Generate Mode: Prompt='{prompt}', Style='{style}'")
-            if not prompt:  # Style can be DEFAULT
-                return jsonify({"error": "Необходимо ввести промпт для генерации."}), 400
+        raise CardGenerationError(f"Ошибка обработки логотипа: {e}", 500)
+
 
+def _start_background(card_request: CardRequest, stage) -> Future:
+    """
+    Запускает получение фона и возвращает Future с фоном.
+    Для генерации это Future кэша фонов с байтами изображения: готовый фон из кэша,
+    уже идущая генерация с тем же промптом или новая задача в общем планировщике
+    опроса FusionBrain (поток не ждёт). Для загруженного фона — уже завершённый
+    Future с декодированным изображением после проверки NSFW. Пока FusionBrain
+    недоступен, фон из кэша отдаётся как обычно, а вместо новой генерации — заглушка.
+    """
+    try:
+        if card_request.mode == 'generate':
+            stage('generate')
             api = fusion_api_client
-            pipeline_id = api.get_pipeline()
-            uuid = api.generate(prompt, pipeline_id, TARGET_WIDTH, TARGET_HEIGHT, style)
-            background_base64 = api.check_generation(uuid)
-            if not background_base64:
-                # api.check_generation should have printed the error
-                return jsonify({"error": "Не удалось сгенерировать фоновое изображение."}), 500
-            print("Background generated successfully.")
-
-        if mode == 'upload':
-            bg_file = request.files['background']
-            if bg_file.filename == '':
-                return jsonify({"error": "Не выбран файл фона."}), 400
-
-            raw_bg = bg_file.read()
-            bg_file.seek(0)
+
+            def start_generation():
+                with metrics.stage_timer('fusion_submit'):
+                    uuid = api.generate(card_request.prompt, pipeline_id, TARGET_WIDTH, TARGET_HEIGHT,
+                                        card_request.style)
+                return api.poll_generation(uuid, timeout=FUSION_POLL_TIMEOUT)
 
             try:
-                img_bg = Image.open(io.BytesIO(raw_bg))
-                if img_bg.mode != 'RGB':
-                    img_bg = img_bg.convert('RGB')
-            except Exception as e:
-                return jsonify({"error": f"Ошибка подготовки фона для проверки NSFW: {e}"}), 500
-            is_bg_nsfw = nsfw_check_client.is_nsfw(img_bg)
-            if is_bg_nsfw is None:
-                return jsonify({"error": "Не удалось проверить фон на недопустимое содержание."}), 500
-            if is_bg_nsfw:
-                print('!!! NSFW BACKGROUND DETECTED - BLOCKING !!!')
-                # ВОЗВРАЩАЕМ СПЕЦИАЛЬНЫЙ ФЛАГ ДЛЯ FRONTEND
-                return jsonify({"error": "Обнаружено недопустимое содержимое в фоне.", "nsfw_detected": True}), 400
-
-            # если всё ок — кодируем фон в base64 и продолжаем
-            background_base64 = base64.b64encode(raw_bg).decode('utf-8')
-            print("Background uploaded and verified successfully.")
+                pipeline_id = api.get_pipeline()
+                cache_key = background_cache.key_for(card_request.prompt, card_request.style,
+                                                     TARGET_WIDTH, TARGET_HEIGHT, pipeline_id)
+                return background_cache.get_or_generate(cache_key, start_generation, fresh=card_request.fresh)
+            except CircuitOpenError as e:
+                background_future = Future()
+                background_future.set_result(_fallback_background(card_request, e))
+                return background_future
 
+        stage('nsfw')
+        try:
+            background_image = _decode_image(card_request.background_bytes, (TARGET_WIDTH, TARGET_HEIGHT))
+            img_bg = background_image if background_image.mode == 'RGB' else background_image.convert('RGB')
+        except Exception as e:
+            raise CardGenerationError(f"Ошибка подготовки фона для проверки NSFW: {e}", 500)
+        with metrics.stage_timer('nsfw'):
+            is_bg_nsfw = _get_model('nsfw').is_nsfw(_nsfw_input(img_bg))
+        if is_bg_nsfw is None:
+            raise CardGenerationError("Не удалось проверить фон на недопустимое содержание.", 500)
+        if is_bg_nsfw:
+            print('!!! NSFW BACKGROUND DETECTED - BLOCKING !!!')
+            raise CardGenerationError("Обнаружено недопустимое содержимое в фоне.", 400, nsfw_detected=True)
+
+        # если всё ок — передаём уже декодированный фон дальше
+        background_future = Future()
+        background_future.set_result(img_bg)
+        print("Background uploaded and verified successfully.")
+        return background_future
+
+    except CardGenerationError:
+        raise
+    except Exception as e:
+        print(f"Error getting background (mode: {card_request.mode}): {e}")
+        raise CardGenerationError(f"Ошибка получения фона: {e}", 500)
+
+
+def _resolve_background(background_future: Future, card_request: CardRequest) -> Image.Image:
+    """Получает фон из Future (при необходимости дожидаясь его). Ошибки генерации -> CardGenerationError."""
+    try:
+        background = background_future.result()
+    except CircuitOpenError as e:  # генерацию, к которой присоединился запрос, отклонил circuit breaker
+        return _fallback_background(card_request, e)
+    except TimeoutError:
+        print(f"Background generation timed out (mode: {card_request.mode})")
+        raise CardGenerationError("Не удалось сгенерировать фоновое изображение.", 500)
+    except Exception as e:
+        print(f"Error getting background (mode: {card_request.mode}): {e}")
+        raise CardGenerationError("Не удалось сгенерировать фоновое изображение.", 500)
 
+    if isinstance(background, Image.Image):
+        return background
+    try:
+        background = _decode_image(background)
     except Exception as e:
-        print(f"Error getting background (mode: {mode}): {e}")
-        return jsonify({"error": f"Ошибка получения фона: {e}"}), 500
+        print(f"Error decoding generated background: {e}")
+        raise CardGenerationError(f"Ошибка получения фона: {e}", 500)
+    print("Background generated successfully.")
+    return background
+
 
-    # --- Composite Image ---
-    final_image_buffer = None
+def _compose_card(card_request: CardRequest, logo: Image.Image, background: Image.Image,
+                  stage) -> dict[str, EncodedImage]:
+    """
+    Накладывает обработанный логотип на фон. Возвращает закодированные изображения
+    запрошенных вариантов: 'design' (фон + лого) и/или 'card' (с шаблоном карты).
+    """
+    stage('compose')
     try:
-        if not background_base64 or not processed_logo_bytes:
+        if background is None or logo is None:
             raise ValueError("Missing background or processed logo data for composition.")
 
-        final_image_buffer = overlay_logo(
-            background_base64,
-            processed_logo_bytes,
-            logo_x_rel,  # Pass relative X (0.0-1.0)
-            logo_y_rel,  # Pass relative Y (0.0-1.0)
-            logo_scale,  # Pass scale (e.g., 0.5)
-            TARGET_WIDTH,
-            TARGET_HEIGHT
+        params = RenderParams(
+            logo_x_rel=card_request.logo_x_rel,  # Pass relative X (0.0-1.0)
+            logo_y_rel=card_request.logo_y_rel,  # Pass relative Y (0.0-1.0)
+            logo_scale=card_request.logo_scale,  # Pass scale (e.g., 0.5)
+            width=TARGET_WIDTH,
+            height=TARGET_HEIGHT,
+            variants=('design', 'card') if card_request.output == 'both' else (card_request.output,),
+            output_format=card_request.output_format,
+            quality=card_request.quality,
+            compress_level=card_request.compress_level,
         )
-        if not final_image_buffer:
-            raise ValueError("Image composition returned None")
+        # наложение и кодирование в пуле процессов (или в текущем потоке, если пул выключен)
+        results = cpu_pool.render_card(background, logo, params)
+        for variant, encoded in results.items():
+            print(f"Encoded {variant}: {encoded.header_value()}")
         print("Image composition successful.")
+        return results
 
+    except CpuPoolBusyError as e:
+        print(f"Composition rejected: {e}")
+        raise CardGenerationError("Сервер перегружен, попробуйте позже.", 503)
     except Exception as e:
         print(f"Error during composition step: {e}")
-        return jsonify({"error": f"Ошибка наложения логотипа: {e}"}), 500
+        raise CardGenerationError(f"Ошибка наложения логотипа: {e}", 500)
+
+
+# Заголовок ответа, если фон заменён заглушкой (FusionBrain недоступен)
+DEGRADED_HEADER = ('X-Degraded', 'fusionbrain-unavailable')
+
+
+def _image_response(encoded: EncodedImage, degraded: bool = False):
+    """
+    Ответ с изображением и заголовком X-Image-Encoding (формат, размер, время кодирования).
+    degraded=True добавляет X-Degraded: фон заменён заглушкой.
+    """
+    response = send_file(io.BytesIO(encoded.data), mimetype=encoded.mimetype, as_attachment=False)
+    response.headers['X-Image-Encoding'] = encoded.header_value()
+    if degraded:
+        response.headers[DEGRADED_HEADER[0]] = DEGRADED_HEADER[1]
+    response.vary.add('Accept')
+    return response
+
+
+def build_card(card_request: CardRequest, on_stage=None) -> dict[str, EncodedImage]:
+    """
+    Выполняет все этапы генерации карты: NSFW -> rembg -> фон (генерация или загрузка) -> наложение.
+    on_stage(name) вызывается перед каждым этапом, чтобы фоновая задача могла сообщать о прогрессе.
+    Возвращает закодированные варианты результата (см. _compose_card), при ошибке бросает CardGenerationError.
+    """
+    def stage(name):
+        if on_stage:
+            on_stage(name)
+
+    logo = _process_logo(card_request, stage)
+    background_future = _start_background(card_request, stage)
+    if card_request.mode == 'generate':
+        with metrics.stage_timer('fusion_wait'):  # ожидание фона (из кэша — почти мгновенно)
+            wait_futures([background_future])
+    background = _resolve_background(background_future, card_request)
+    return _compose_card(card_request, logo, background, stage)
+
+
+def _run_card_job(job, card_request: CardRequest):
+    """
+    Тело фоновой задачи. Обрабатывает логотип и запускает получение фона,
+    а наложение выполняется в продолжении, когда фон готов: пока FusionBrain
+    генерирует изображение, задача не занимает поток пула.
+    """
+    def stage(name):
+        job_manager.set_stage(job, name)
+
+    try:
+        logo = _process_logo(card_request, stage)
+        background_future = _start_background(card_request, stage)
+    except CardGenerationError as e:
+        job_manager.fail(job, e.to_dict(), e.status_code)
+        return
+    return job_manager.continue_with(job, background_future, _finish_card_job, card_request, logo,
+                                     time.perf_counter())
+
+
+def _finish_card_job(job, background_future: Future, card_request: CardRequest, logo: Image.Image,
+                     waiting_since: float):
+    if card_request.mode == 'generate':
+        metrics.observe_stage('fusion_wait', time.perf_counter() - waiting_since)
+    try:
+        background = _resolve_background(background_future, card_request)
+        results = _compose_card(card_request, logo, background, lambda name: job_manager.set_stage(job, name))
+    except CardGenerationError as e:
+        job_manager.fail(job, e.to_dict(), e.status_code)
+        return
+    job_manager.complete(job, results, degraded=card_request.degraded)
+    print(f"--- Job {job.id} processed successfully in {time.time() - job.created_at:.2f} seconds ---")
+
+
+@app.route('/generate-card', methods=['POST'])
+def generate_card_endpoint():
+    start_time = time.time()
+    print("\n--- Received request for card generation ---")
+
+    try:
+        with metrics.stage_timer('upload_read'):
+            card_request = parse_card_request(request)
+        if card_request.output == 'both':
+            raise CardGenerationError("Результат 'both' доступен только через /generate-card/jobs.", 400)
+        encoded = build_card(card_request)[card_request.output]
+    except CardGenerationError as e:
+        return jsonify(e.to_dict()), e.status_code
 
     # --- Send Result Back ---
     end_time = time.time()
     print(f"--- Request processed successfully in {end_time - start_time:.2f} seconds ---")
-    return send_file(
-        final_image_buffer,
-        mimetype='image/png',
-        as_attachment=False
+    return _image_response(encoded, degraded=card_request.degraded)
+
+
+# --- Batch Rendering ---
+@dataclass
+class PlacementSpec:
+    background: int  # индекс загруженного фона
+    logo_x_rel: float
+    logo_y_rel: float
+    logo_scale: float
+    output: str  # 'design' или 'card'
+
+
+def parse_batch_specs(raw_specs: str | None, background_count: int) -> list[PlacementSpec]:
+    """
+    Разбирает JSON список размещений: [{"background": 0, "x": 0.5, "y": 0.5, "scale": 0.5, "output": "card"}, ...].
+    Без specs логотип размещается по центру каждого фона.
+    """
+    if not raw_specs:
+        items = [{"background": index} for index in range(background_count)]
+    else:
+        try:
+            items = json.loads(raw_specs)
+        except ValueError:
+            raise CardGenerationError("Параметр specs должен быть JSON списком.", 400)
+        if not isinstance(items, list) or not items:
+            raise CardGenerationError("Параметр specs должен быть непустым JSON списком.", 400)
+    if len(items) > BATCH_MAX_SPECS:
+        raise CardGenerationError(f"Слишком много вариантов в пакете (максимум {BATCH_MAX_SPECS}).", 400)
+
+    specs = []
+    for number, item in enumerate(items):
+        try:
+            logo_x_rel, logo_y_rel, logo_scale = logo_placement(
+                float(item.get("x", 0.5)), float(item.get("y", 0.5)), float(item.get("scale", 0.5)))
+            spec = PlacementSpec(
+                background=int(item.get("background", 0)),
+                logo_x_rel=logo_x_rel,
+                logo_y_rel=logo_y_rel,
+                logo_scale=logo_scale,
+                output=item.get("output", "design"),
+            )
+        except (AttributeError, TypeError, ValueError, CardGenerationError):
+            raise CardGenerationError(f"Некорректное описание варианта #{number}.", 400)
+        if not 0 <= spec.background < background_count:
+            raise CardGenerationError(f"Вариант #{number} ссылается на несуществующий фон {spec.background}.", 400)
+        if spec.output not in ('design', 'card'):
+            raise CardGenerationError(f"Некорректный формат результата в варианте #{number}.", 400)
+        specs.append(spec)
+    return specs
+
+
+def _load_batch_backgrounds(files, target_size: tuple = (TARGET_WIDTH, TARGET_HEIGHT)) -> list[Image.Image]:
+    """Декодирует фоны и проверяет их на NSFW одним пакетом (все фоны отправляются в очередь детектора сразу)."""
+    images = []
+    for index, bg_file in enumerate(files):
+        data = read_upload(bg_file, target_size)
+        try:
+            image = _decode_image(data, target_size)
+            images.append(image if image.mode == 'RGB' else image.convert('RGB'))
+        except Exception as e:
+            raise CardGenerationError(f"Ошибка подготовки фона #{index} для проверки NSFW: {e}", 400)
+
+    detector = _get_model('nsfw')
+    verdicts = [detector.submit(_nsfw_input(image)) for image in images]
+    for index, verdict in enumerate(verdicts):
+        is_bg_nsfw = detector.wait_result(verdict)
+        if is_bg_nsfw is None:
+            raise CardGenerationError(f"Не удалось проверить фон #{index} на недопустимое содержание.", 500)
+        if is_bg_nsfw:
+            print(f'!!! NSFW BACKGROUND #{index} DETECTED - BLOCKING !!!')
+            raise CardGenerationError(f"Обнаружено недопустимое содержимое в фоне #{index}.", 400,
+                                      nsfw_detected=True)
+    return images
+
+
+def render_batch(logo: Image.Image, backgrounds: list[Image.Image], specs: list[PlacementSpec],
+                 output_format: str, quality: int | None = None, compress_level: int | None = None):
+    """
+    Генератор результатов пакета: (имя файла, EncodedImage) для каждого варианта.
+    Каждый фон проходит автоконтраст и масштабирование один раз, логотип масштабируется
+    один раз на каждый scale — для вариантов остаются только наложение и кодирование.
+    Ошибка варианта не прерывает пакет: вместо EncodedImage выдаётся CardGenerationError.
+    """
+    prepared_backgrounds = {}
+    resized_logos = {}
+    extension = 'jpg' if output_format == 'jpeg' else output_format
+    for number, spec in enumerate(specs):
+        filename = f"{number:03d}_bg{spec.background}_{spec.output}.{extension}"
+        try:
+            background = prepared_backgrounds.get(spec.background)
+            if background is None:
+                background = prepare_background(backgrounds[spec.background], TARGET_WIDTH, TARGET_HEIGHT)
+                prepared_backgrounds[spec.background] = background
+            scaled_logo = resized_logos.get(spec.logo_scale)
+            if scaled_logo is None:
+                scaled_logo = make_layer(resize_logo(logo, spec.logo_scale, TARGET_WIDTH))
+                resized_logos[spec.logo_scale] = scaled_logo
+
+            image = render_variants(background, scaled_logo, spec.logo_x_rel, spec.logo_y_rel, (spec.output,),
+                                    CARD_TEMPLATE_PATH)[spec.output]
+            encoded = image_encoder.encode(image, output_format, quality=quality, compress_level=compress_level)
+        except Exception as e:
+            print(f"Batch variant #{number} ({filename}: background {spec.background}, x={spec.logo_x_rel}, "
+                  f"y={spec.logo_y_rel}, scale={spec.logo_scale}) failed: {e}")
+            yield filename, CardGenerationError(f"Ошибка наложения логотипа в варианте #{number}: {e}", 500)
+            continue
+        yield filename, encoded
+
+
+def _batch_zip_response(results, specs: list[PlacementSpec]):
+    """ZIP без сжатия (PNG/WebP/JPEG уже сжаты) с manifest.json, описывающим каждый файл."""
+    buffer = io.BytesIO()
+    manifest = []
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for (filename, encoded), spec in zip(results, specs):
+            if isinstance(encoded, CardGenerationError):
+                raise encoded  # ZIP собирается до ответа — клиент получит JSON с ошибкой
+            archive.writestr(filename, encoded.data)
+            manifest.append({"file": filename, "background": spec.background, "x": spec.logo_x_rel,
+                             "y": spec.logo_y_rel, "scale": spec.logo_scale, "output": spec.output,
+                             "encoding": encoded.header_value()})
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    buffer.seek(0)
+    return send_file(buffer, mimetype='application/zip', as_attachment=True, download_name='cards.zip')
+
+
+def _batch_multipart_response(results, started_at: float):
+    """
+    multipart/mixed поток: каждая часть отправляется клиенту сразу после кодирования.
+    Статус 200 уже отправлен, поэтому ошибка варианта передаётся частью application/json
+    ({"error", "file"}) с заголовком X-Batch-Error, и поток продолжается.
+    """
+    boundary = uuid.uuid4().hex
+
+    def stream():
+        failed = 0
+        for filename, encoded in results:
+            if isinstance(encoded, CardGenerationError):
+                failed += 1
+                body = json.dumps(dict(encoded.to_dict(), file=filename), ensure_ascii=False).encode('utf-8')
+                headers = (f"--{boundary}\r\n"
+                           f"Content-Type: application/json; charset=utf-8\r\n"
+                           f"Content-Length: {len(body)}\r\n"
+                           f"X-Batch-Error: {encoded.status_code}\r\n\r\n")
+                yield headers.encode('ascii') + body + b"\r\n"
+                continue
+            headers = (f"--{boundary}\r\n"
+                       f"Content-Type: {encoded.mimetype}\r\n"
+                       f"Content-Disposition: attachment; filename=\"{filename}\"\r\n"
+                       f"Content-Length: {len(encoded.data)}\r\n"
+                       f"X-Image-Encoding: {encoded.header_value()}\r\n\r\n")
+            yield headers.encode('ascii') + encoded.data + b"\r\n"
+        yield f"--{boundary}--\r\n".encode('ascii')
+        print(f"--- Batch streamed in {time.time() - started_at:.2f} seconds ({failed} variants failed) ---")
+
+    return Response(stream(), mimetype=f'multipart/mixed; boundary={boundary}',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@app.route('/generate-card/batch', methods=['POST'])
+def generate_card_batch_endpoint():
+    """
+    Пакетный рендер: один логотип, несколько загруженных фонов (поле background, можно несколько)
+    и список размещений specs (JSON). Логотип проходит NSFW и удаление фона один раз,
+    каждый фон — декодирование, NSFW и автоконтраст один раз.
+    Результат — ZIP (по умолчанию) или multipart/mixed (packaging=multipart или Accept: multipart/mixed).
+    Параметры кодирования (format, quality, compressLevel) — как у /generate-card.
+    """
+    print("\n--- Received request for /generate-card/batch ---")
+    start_time = time.time()
+    try:
+        if 'logo' not in request.files or request.files['logo'].filename == '':
+            raise CardGenerationError("Логотип не был загружен.", 400)
+        bg_files = [f for f in request.files.getlist('background') if f.filename]
+        if not bg_files:
+            raise CardGenerationError("Не выбран файл фона.", 400)
+        if len(bg_files) > BATCH_MAX_BACKGROUNDS:
+            raise CardGenerationError(f"Слишком много фонов в пакете (максимум {BATCH_MAX_BACKGROUNDS}).", 400)
+        specs = parse_batch_specs(request.form.get('specs'), len(bg_files))
+
+        # Accept здесь выбирает упаковку (multipart/mixed), формат изображений — только параметр format
+        output_format, quality, compress_level = parse_encoding_options(request.values)
+        packaging = request.values.get('packaging')
+        if packaging is None:
+            packaging = 'multipart' if 'multipart/mixed' in request.headers.get('Accept', '') else 'zip'
+        if packaging not in ('zip', 'multipart'):
+            raise CardGenerationError("Параметр packaging должен быть zip или multipart.", 400)
+
+        logo_request = CardRequest(mode='upload', logo_filename=request.files['logo'].filename,
+                                   logo_bytes=read_upload(request.files['logo'], LOGO_DECODE_SIZE),
+                                   logo_x_rel=0.5, logo_y_rel=0.5,
+                                   logo_scale=0.5)
+        logo = _process_logo(logo_request, lambda name: None)
+        backgrounds = _load_batch_backgrounds(bg_files)
+    except CardGenerationError as e:
+        return jsonify(e.to_dict()), e.status_code
+
+    print(f"Batch: {len(specs)} variants over {len(backgrounds)} backgrounds, format={output_format}, {packaging}")
+    results = render_batch(logo, backgrounds, specs, output_format, quality, compress_level)
+    if packaging == 'multipart':
+        return _batch_multipart_response(results, start_time)
+    try:
+        response = _batch_zip_response(results, specs)
+    except CardGenerationError as e:
+        return jsonify(e.to_dict()), e.status_code
+    except Exception as e:
+        print(f"Error during batch composition: {e}")
+        return jsonify({"error": f"Ошибка пакетного наложения логотипа: {e}"}), 500
+    print(f"--- Batch processed in {time.time() - start_time:.2f} seconds ---")
+    return response
+
+
+# --- Interactive Preview ---
+PREVIEW_WIDTH = max(round(TARGET_WIDTH * PREVIEW_SCALE), 1)
+PREVIEW_HEIGHT = max(round(TARGET_HEIGHT * PREVIEW_SCALE), 1)
+PREVIEW_SCALED_LOGOS = 4  # слоёв логотипа на сессию: обычно пользователь двигает ползунок между парой значений
+
+
+@dataclass
+class PreviewSession:
+    background: Image.Image  # подготовленный (автоконтраст) фон размера превью
+    logo: Image.Image  # логотип без фона, уменьшенный под превью
+    # logo_scale -> слой логотипа (make_layer), масштабированного под превью; последние использованные в конце
+    scaled_logos: collections.OrderedDict = field(default_factory=collections.OrderedDict)
+    lock: threading.Lock = field(default_factory=threading.Lock)  # запросы превью одной сессии идут параллельно
+
+    def memory_size(self) -> int:
+        size = (self.background.width * self.background.height + self.logo.width * self.logo.height) * 4
+        with self.lock:
+            layers = list(self.scaled_logos.values())
+        return size + sum(layer.premultiplied.nbytes + layer.inverse_alpha.nbytes for layer in layers)
+
+    def scaled_logo(self, logo_scale: float):
+        """Слой логотипа для logo_scale; хранятся PREVIEW_SCALED_LOGOS последних масштабов."""
+        with self.lock:
+            layer = self.scaled_logos.get(logo_scale)
+            if layer is not None:
+                self.scaled_logos.move_to_end(logo_scale)
+                return layer
+        layer = make_layer(resize_logo(self.logo, logo_scale, PREVIEW_WIDTH))
+        with self.lock:
+            self.scaled_logos[logo_scale] = layer
+            while len(self.scaled_logos) > PREVIEW_SCALED_LOGOS:
+                self.scaled_logos.popitem(last=False)
+        return layer
+
+
+@functools.lru_cache(maxsize=len(PLACEHOLDER_BY_STYLE) + 1)
+def get_preview_placeholder(style: str) -> Image.Image:
+    """Заглушка фона для стиля, уже подготовленная под размер превью. Общая для всех сессий."""
+    return prepare_background(get_placeholder_background(style, PREVIEW_WIDTH, PREVIEW_HEIGHT),
+                              PREVIEW_WIDTH, PREVIEW_HEIGHT)
+
+
+@app.route('/preview/session', methods=['POST'])
+def create_preview_session_endpoint():
+    """
+    Готовит слои предпросмотра: логотип проходит NSFW и удаление фона (с кэшем логотипов),
+    загруженный фон — NSFW и автоконтраст, всё уменьшается до PREVIEW_SCALE.
+    Без загруженного фона используется заглушка выбранного стиля.
+    Дальше GET /preview/<session_id> стоит только наложения и JPEG кодирования.
+    """
+    try:
+        if 'logo' not in request.files or request.files['logo'].filename == '':
+            raise CardGenerationError("Логотип не был загружен.", 400)
+        logo_request = CardRequest(mode='upload', logo_filename=request.files['logo'].filename,
+                                   logo_bytes=read_upload(request.files['logo'], LOGO_DECODE_SIZE),
+                                   logo_x_rel=0.5, logo_y_rel=0.5,
+                                   logo_scale=0.5)
+        logo = _process_logo(logo_request, lambda name: None)
+
+        bg_file = request.files.get('background')
+        if bg_file is not None and bg_file.filename:
+            background = prepare_background(_load_batch_backgrounds([bg_file], (PREVIEW_WIDTH, PREVIEW_HEIGHT))[0],
+                                            PREVIEW_WIDTH, PREVIEW_HEIGHT)
+        else:
+            background = get_preview_placeholder(request.form.get('style', 'DEFAULT'))
+    except CardGenerationError as e:
+        return jsonify(e.to_dict()), e.status_code
+
+    # Логотип на превью не бывает шире половины карты — хранить больше незачем
+    preview_logo = logo.convert('RGBA') if logo.mode != 'RGBA' else logo.copy()
+    preview_logo.thumbnail((PREVIEW_WIDTH // 2, PREVIEW_HEIGHT), Image.Resampling.LANCZOS)
+
+    session_id = uuid.uuid4().hex
+    session = PreviewSession(background=background, logo=preview_logo)
+    preview_sessions.put(session_id, session, session.memory_size())
+    return jsonify({
+        "session_id": session_id,
+        "preview_url": url_for('preview_endpoint', session_id=session_id),
+        "width": PREVIEW_WIDTH,
+        "height": PREVIEW_HEIGHT,
+        "expires_in": PREVIEW_TTL,
+    }), 201
+
+
+@app.route('/preview/<session_id>', methods=['GET'])
+def preview_endpoint(session_id):
+    """Быстрый JPEG предпросмотр: ?x=0.5&y=0.5&scale=0.5&template=1 (template — с шаблоном карты)."""
+    session = preview_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "Сессия предпросмотра не найдена или истекла."}), 404
+
+    try:
+        logo_x_rel, logo_y_rel, logo_scale = read_logo_placement(request.args, 'x', 'y', 'scale')
+    except CardGenerationError as e:
+        return jsonify(e.to_dict()), e.status_code
+    logo_scale = round(logo_scale, 2)
+    with_template = request.args.get('template', '0').lower() in ('1', 'true', 'yes')
+
+    scaled_logo = session.scaled_logo(logo_scale)
+    preview_sessions.put(session_id, session, session.memory_size())  # продлеваем TTL, размер с новым слоем
+
+    variant = 'card' if with_template and get_card_template(PREVIEW_WIDTH, PREVIEW_HEIGHT) is not None else 'design'
+    image = render_variants(session.background, scaled_logo, logo_x_rel, logo_y_rel, (variant,),
+                            CARD_TEMPLATE_PATH)[variant]
+    encoded = image_encoder.encode(image, 'jpeg', quality=PREVIEW_JPEG_QUALITY)
+    response = _image_response(encoded)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# --- Asynchronous Job API ---
+@app.route('/generate-card/jobs', methods=['POST'])
+def submit_card_job_endpoint():
+    print("\n--- Received card generation job ---")
+    try:
+        with metrics.stage_timer('upload_read'):
+            card_request = parse_card_request(request)
+        job = job_manager.submit(_run_card_job, card_request)
+    except CardGenerationError as e:
+        return jsonify(e.to_dict()), e.status_code
+    except JobQueueFullError as e:
+        print(f"Job rejected: {e}")
+        return jsonify({"error": "Сервер перегружен, попробуйте позже."}), 503
+
+    print(f"Job {job.id} queued.")
+    body = dict(
+        job.to_dict(),
+        status_url=url_for('card_job_status_endpoint', job_id=job.id),
+        result_url=url_for('card_job_result_endpoint', job_id=job.id),
+        events_url=url_for('card_job_events_endpoint', job_id=job.id),
     )
+    return jsonify(body), 202, {'Location': body['status_url']}
+
+
+@app.route('/generate-card/jobs/<job_id>', methods=['GET'])
+def card_job_status_endpoint(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Задача не найдена."}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/generate-card/jobs/<job_id>/result', methods=['GET'])
+def card_job_result_endpoint(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Задача не найдена."}), 404
+    if job.status == JOB_FAILED:
+        return jsonify(job.error), job.error_status
+    if job.status != JOB_DONE:
+        return jsonify(job.to_dict()), 409
+    # Клиент скачивает только тот вариант, который показывает: ?variant=card или ?variant=design
+    variant = request.args.get('variant') or ('card' if 'card' in job.results else 'design')
+    if variant not in job.results:
+        return jsonify({"error": f"Вариант '{variant}' не запрашивался для этой задачи."}), 404
+    return _image_response(job.results[variant], degraded=job.degraded)
+
+
+@app.route('/generate-card/jobs/<job_id>/events', methods=['GET'])
+def card_job_events_endpoint(job_id):
+    """Server-Sent Events со статусом задачи; поток закрывается после завершения задачи."""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({"error": "Задача не найдена."}), 404
+
+    def stream():
+        version = -1  # первый снимок отправляем сразу
+        while True:
+            snapshot = job_manager.wait_for_update(job, version, timeout=15)
+            if snapshot is None:
+                yield ": keep-alive\n\n"
+                continue
+            version = snapshot.pop('version')
+            yield f"event: status\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+            if snapshot['status'] in FINISHED_STATUSES:
+                break
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
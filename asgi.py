@@ -0,0 +1,336 @@
+"""
+ASGI сервер (Starlette + uvicorn) с асинхронными /generate-card, /improve-prompt и
+/improve-prompt/stream: запросы к FusionBrain и GigaChat выполняются асинхронными
+клиентами на общем пуле соединений, поэтому ожидание генерации не занимает поток.
+CPU этапы (NSFW, rembg, наложение, кодирование) уходят в пул потоков и дальше в
+пул процессов (CPU_POOL_WORKERS). Остальные маршруты обслуживает Flask приложение
+из app.py, смонтированное через WSGI.
+
+Запуск: uvicorn asgi:app --port 5000
+"""
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import time
+from concurrent.futures import Future
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import CombinedMultiDict, FileStorage, MultiDict
+
+import app as card_app
+from app import CardGenerationError, TARGET_HEIGHT, TARGET_WIDTH, background_cache, prompt_cache
+from services import metrics
+from services.circuit_breaker import CircuitOpenError
+from services.fusion_brain import AsyncFusionBrainAPI
+from services.giga import AsyncGigaChatClient, GigaChatAPIError
+
+# Асинхронные клиенты создаются в lifespan (в цикле событий сервера)
+fusion_async_client = None
+giga_async_client = None
+
+
+class FormRequest:
+    """
+    Форма Starlette в виде запроса Flask (files/form/values/headers), чтобы проверка
+    параметров была общей с app.parse_card_request. Файлы прочитаны заранее.
+    """
+    def __init__(self, request, form: MultiDict, files: MultiDict):
+        self.form = form
+        self.files = files
+        self.values = CombinedMultiDict([MultiDict(request.query_params.multi_items()), form])
+        self.headers = request.headers
+
+
+def _request_too_large() -> CardGenerationError:
+    return CardGenerationError(f"Запрос слишком большой (максимум {card_app.REQUEST_MAX_MB:g} МБ).", 413)
+
+
+def _limited_receive(receive, limit: int):
+    """ASGI receive, который считает байты тела и прерывает чтение с 413, как только их больше limit."""
+    received = 0
+
+    async def limited():
+        nonlocal received
+        message = await receive()
+        if message['type'] == 'http.request':
+            received += len(message.get('body', b''))
+            if received > limit:
+                raise _request_too_large()
+        return message
+
+    return limited
+
+
+async def _read_form(request) -> FormRequest:
+    """
+    Читает multipart форму. Как MAX_CONTENT_LENGTH во Flask: слишком большое тело отклоняется
+    по Content-Length, а без него (chunked) — как только прочитано больше MAX_CONTENT_LENGTH байт,
+    до разбора формы целиком. Из файла читается не больше UPLOAD_MAX_BYTES + 1 байт — превышение
+    заметит app.read_upload.
+    """
+    if card_app.MAX_CONTENT_LENGTH:
+        content_length = request.headers.get('content-length', '')
+        if content_length.isdigit() and int(content_length) > card_app.MAX_CONTENT_LENGTH:
+            raise _request_too_large()
+        request = Request(request.scope, _limited_receive(request.receive, card_app.MAX_CONTENT_LENGTH))
+    read_limit = card_app.UPLOAD_MAX_BYTES + 1 if card_app.UPLOAD_MAX_BYTES else -1
+    form, files = MultiDict(), MultiDict()
+    async with request.form() as form_data:
+        for key, value in form_data.multi_items():
+            if isinstance(value, UploadFile):
+                data = await value.read(read_limit)
+                files.add(key, FileStorage(io.BytesIO(data), filename=value.filename or '', name=key,
+                                           content_type=value.content_type))
+            else:
+                form.add(key, value)
+    return FormRequest(request, form, files)
+
+
+async def _start_generation(card_request, stage) -> Future:
+    """
+    Как app._start_background для режима 'generate', но через асинхронный клиент:
+    генерация и опрос статуса — корутина в цикле событий, результат попадает в общий
+    кэш фонов (одинаковые запросы из Flask и ASGI присоединяются к одной генерации).
+    Пока circuit breaker открыт, вместо генерации — заглушка (app._fallback_background).
+    """
+    stage('generate')
+    if fusion_async_client is None:
+        raise CardGenerationError("Ошибка получения фона: FusionBrain API не настроен.", 500)
+    try:
+        pipeline_id = await fusion_async_client.get_pipeline()
+    except CircuitOpenError as e:
+        background_future = Future()
+        background_future.set_result(card_app._fallback_background(card_request, e))
+        return background_future
+    except Exception as e:
+        print(f"Error getting background (mode: {card_request.mode}): {e}")
+        raise CardGenerationError(f"Ошибка получения фона: {e}", 500)
+    cache_key = background_cache.key_for(card_request.prompt, card_request.style,
+                                         TARGET_WIDTH, TARGET_HEIGHT, pipeline_id)
+    loop = asyncio.get_running_loop()
+
+    async def generate():
+        with metrics.stage_timer('fusion_submit'):
+            uuid = await fusion_async_client.generate(card_request.prompt, pipeline_id, TARGET_WIDTH, TARGET_HEIGHT,
+                                                      card_request.style)
+        return await fusion_async_client.wait_for_generation(uuid, timeout=card_app.FUSION_POLL_TIMEOUT)
+
+    def start_generation():
+        return asyncio.run_coroutine_threadsafe(generate(), loop)
+
+    try:
+        # чтение кэша с диска — в потоке, генерация — в цикле событий
+        return await run_in_threadpool(background_cache.get_or_generate, cache_key, start_generation,
+                                       card_request.fresh)
+    except Exception as e:
+        print(f"Error getting background (mode: {card_request.mode}): {e}")
+        raise CardGenerationError(f"Ошибка получения фона: {e}", 500)
+
+
+async def build_card(card_request, stage) -> dict:
+    """Асинхронный app.build_card: этапы те же, ожидание фона не блокирует поток."""
+    logo = await run_in_threadpool(card_app._process_logo, card_request, stage)
+    if card_request.mode == 'generate':
+        background_future = await _start_generation(card_request, stage)
+        with metrics.stage_timer('fusion_wait'):
+            await asyncio.wait([asyncio.wrap_future(background_future)])  # ошибки разбирает _resolve_background
+    else:
+        background_future = await run_in_threadpool(card_app._start_background, card_request, stage)
+    background = await run_in_threadpool(card_app._resolve_background, background_future, card_request)
+    return await run_in_threadpool(card_app._compose_card, card_request, logo, background, stage)
+
+
+def server_timing(endpoint):
+    """Заголовок Server-Timing для маршрута (при SERVER_TIMING=True), как у маршрутов Flask."""
+    if not card_app.SERVER_TIMING:
+        return endpoint
+
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        started = time.perf_counter()
+        token = metrics.start_request_timing()
+        try:
+            response = await endpoint(request)
+        finally:
+            value = metrics.finish_request_timing(token, time.perf_counter() - started)
+        response.headers['Server-Timing'] = value
+        return response
+    return wrapper
+
+
+@server_timing
+async def generate_card_endpoint(request):
+    start_time = time.time()
+    print("\n--- Received request for card generation (async) ---")
+
+    try:
+        with metrics.stage_timer('upload_read'):
+            card_request = card_app.parse_card_request(await _read_form(request))
+        if card_request.output == 'both':
+            raise CardGenerationError("Результат 'both' доступен только через /generate-card/jobs.", 400)
+        encoded = (await build_card(card_request, lambda name: None))[card_request.output]
+    except CardGenerationError as e:
+        return JSONResponse(e.to_dict(), status_code=e.status_code)
+
+    print(f"--- Request processed successfully in {time.time() - start_time:.2f} seconds ---")
+    headers = {'X-Image-Encoding': encoded.header_value(), 'Vary': 'Accept'}
+    if card_request.degraded:
+        headers[card_app.DEGRADED_HEADER[0]] = card_app.DEGRADED_HEADER[1]
+    return Response(encoded.data, media_type=encoded.mimetype, headers=headers)
+
+
+def _prompt_messages(user_prompt: str) -> list:
+    return [
+        {"role": "system", "content": card_app.SYSTEM_PROMPT_IMPROVER},
+        {"role": "user", "content": user_prompt}
+    ]
+
+
+async def _read_prompt(request) -> str | None:
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    user_prompt = data.get('prompt') if isinstance(data, dict) else None
+    return user_prompt if isinstance(user_prompt, str) else None
+
+
+@server_timing
+async def improve_prompt_endpoint(request):
+    user_prompt = await _read_prompt(request)
+    if not user_prompt:
+        return JSONResponse({"error": "Промпт не может быть пустым."}, 400)
+    cache_key = prompt_cache.key_for(user_prompt)
+    cached_prompt = await run_in_threadpool(prompt_cache.get, cache_key) if cache_key else None
+    if cached_prompt:
+        print(f"Prompt cache hit: '{user_prompt}'")
+        return JSONResponse({"improved_prompt": cached_prompt, "cached": True})
+
+    if not giga_async_client:
+        return JSONResponse({"error": "Сервис улучшения промптов временно недоступен (ошибка конфигурации)."}, 503)
+
+    print(f"Отправка промпта '{user_prompt}' в GigaChat для улучшения...")
+    try:
+        with metrics.stage_timer('gigachat'):
+            response = await giga_async_client.chat(_prompt_messages(user_prompt), model=card_app.PROMPT_MODEL)
+    except GigaChatAPIError as e:
+        print(f"Ошибка GigaChat API при улучшении промпта: {e}")
+        return JSONResponse({"error": f"Ошибка сервиса улучшения промптов: {e.message}"}, e.status_code)
+    except Exception as e:
+        print(f"Непредвиденная ошибка при улучшении промпта: {e}")
+        return JSONResponse({"error": "Внутренняя ошибка сервера при улучшении промпта."}, 500)
+
+    if response and "choices" in response and response["choices"]:
+        improved_prompt = response["choices"][0].get("message", {}).get("content")
+        if improved_prompt:
+            print(f"GigaChat вернул улучшенный промпт: {improved_prompt}")
+            if cache_key:
+                await run_in_threadpool(prompt_cache.put, cache_key, improved_prompt.strip())
+            return JSONResponse({"improved_prompt": improved_prompt.strip()})
+        print("GigaChat API вернул ответ без контента.")
+        return JSONResponse({"error": "Не удалось получить улучшенный промпт от GigaChat."}, 500)
+    print(f"Неожиданный ответ от GigaChat API: {response}")
+    return JSONResponse({"error": "Неожиданный ответ от сервиса улучшения промптов."}, 500)
+
+
+@server_timing
+async def improve_prompt_stream_endpoint(request):
+    """Асинхронный вариант /improve-prompt/stream из app.py (те же события token/done/error)."""
+    user_prompt = await _read_prompt(request)
+    if not user_prompt:
+        return JSONResponse({"error": "Промпт не может быть пустым."}, 400)
+
+    def sse(event, payload):
+        return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    cache_key = prompt_cache.key_for(user_prompt)
+    cached_prompt = await run_in_threadpool(prompt_cache.get, cache_key) if cache_key else None
+    if cached_prompt:
+        print(f"Prompt cache hit: '{user_prompt}'")
+        return Response(sse('done', {"improved_prompt": cached_prompt, "cached": True}),
+                        media_type='text/event-stream', headers=sse_headers)
+
+    if not giga_async_client:
+        return JSONResponse({"error": "Сервис улучшения промптов временно недоступен (ошибка конфигурации)."}, 503)
+
+    print(f"Отправка промпта '{user_prompt}' в GigaChat для потокового улучшения...")
+    start_time = time.time()
+    try:
+        chunks = await giga_async_client.chat_stream(_prompt_messages(user_prompt), model=card_app.PROMPT_MODEL)
+    except GigaChatAPIError as e:
+        print(f"Ошибка GigaChat API при улучшении промпта: {e}")
+        return JSONResponse({"error": f"Ошибка сервиса улучшения промптов: {e.message}"}, e.status_code)
+
+    async def stream():
+        parts = []
+        try:
+            async for content in chunks:
+                if not parts:
+                    print(f"GigaChat: первый фрагмент через {time.time() - start_time:.2f} s")
+                parts.append(content)
+                yield sse('token', {"content": content})
+        except Exception as e:
+            print(f"Ошибка потока GigaChat при улучшении промпта: {e}")
+            yield sse('error', {"error": "Поток ответа сервиса улучшения промптов прерван."})
+            return
+        finally:
+            await chunks.aclose()  # закрывает соединение с GigaChat, в том числе если клиент отключился
+        improved_prompt = ''.join(parts).strip()
+        if not improved_prompt:
+            print("GigaChat API вернул поток без контента.")
+            yield sse('error', {"error": "Не удалось получить улучшенный промпт от GigaChat."})
+            return
+        print(f"GigaChat вернул улучшенный промпт за {time.time() - start_time:.2f} s: {improved_prompt}")
+        metrics.observe_stage('gigachat', time.time() - start_time)
+        if cache_key:
+            await run_in_threadpool(prompt_cache.put, cache_key, improved_prompt)
+        yield sse('done', {"improved_prompt": improved_prompt})
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers=sse_headers)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    global fusion_async_client, giga_async_client
+    try:
+        fusion_async_client = AsyncFusionBrainAPI(
+            card_app.API_URL, card_app.API_KEY, card_app.SECRET_KEY,
+            poll_min_delay=card_app.FUSION_POLL_MIN_DELAY, poll_max_delay=card_app.FUSION_POLL_MAX_DELAY,
+            poll_timeout=card_app.FUSION_POLL_TIMEOUT, pool_size=card_app.ASYNC_HTTP_POOL_SIZE,
+            pipeline_ttl=card_app.FUSION_PIPELINE_TTL, breaker=card_app.fusion_breaker)
+    except Exception as e:
+        print(f"!!! ОШИБКА инициализации AsyncFusionBrainAPI: {e}")
+        fusion_async_client = None
+    if card_app.giga_client:
+        giga_async_client = AsyncGigaChatClient(card_app.giga_client, pool_size=card_app.ASYNC_HTTP_POOL_SIZE)
+    yield
+    for client in (fusion_async_client, giga_async_client):
+        if client:
+            await client.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/generate-card', generate_card_endpoint, methods=['POST']),
+        Route('/improve-prompt', improve_prompt_endpoint, methods=['POST']),
+        Route('/improve-prompt/stream', improve_prompt_stream_endpoint, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(card_app.app)),  # остальные маршруты — Flask
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    print("Starting ASGI server...")
+    uvicorn.run(app, port=int(os.environ.get('PORT', 5000)))
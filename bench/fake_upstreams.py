@@ -0,0 +1,247 @@
+"""
+Локальные заглушки FusionBrain и GigaChat для нагрузочного тестирования без расхода квоты.
+
+Один HTTP сервер отвечает на:
+  GET  /key/api/v1/pipelines                 список из одного pipeline
+  POST /key/api/v1/pipeline/run              {"uuid", "status": "INITIAL"}
+  GET  /key/api/v1/pipeline/status/<uuid>    PROCESSING, пока не пройдёт completion_time, затем DONE (или FAIL)
+  POST /api/v2/oauth                         токен GigaChat
+  POST /api/v1/chat/completions              ответ GigaChat, обычный или потоковый (SSE)
+
+Запуск отдельно (приложение настраивается переменными, которые печатает сервер):
+  python bench/fake_upstreams.py --port 8900 --latency-ms 50 --completion-time 8 --failure-rate 0.02
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw
+
+STATUS_PATH_RE = re.compile(r'^/key/api/v1/pipeline/status/([\w-]+)$')
+
+
+class FakeUpstreamConfig:
+    def __init__(self, latency_ms: float = 30, jitter_ms: float = 10, failure_rate: float = 0.0,
+                 completion_time: float = 5.0, completion_jitter: float = 1.0, chat_tokens: int = 40,
+                 token_delay_ms: float = 20, width: int = 1032, height: int = 648):
+        self.latency_ms = latency_ms  # задержка каждого ответа
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate  # доля ответов 500 / генераций FAIL
+        self.completion_time = completion_time  # s от pipeline/run до DONE
+        self.completion_jitter = completion_jitter
+        self.chat_tokens = chat_tokens  # фрагментов в ответе GigaChat
+        self.token_delay_ms = token_delay_ms  # пауза между фрагментами потока
+        self.width = width
+        self.height = height
+
+
+def _make_background(width: int, height: int) -> str:
+    """base64 PNG, который 'генерирует' заглушка FusionBrain (один на все генерации)."""
+    image = Image.new('RGB', (width, height), (40, 60, 90))
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(0)
+    for _ in range(60):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(10, max(width, height) // 6)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class FakeUpstreams:
+    """HTTP сервер заглушек в фоновом потоке. Счётчики запросов — в stats."""
+    def __init__(self, config: FakeUpstreamConfig, host: str = '127.0.0.1', port: int = 0):
+        self.config = config
+        self.image_b64 = _make_background(config.width, config.height)
+        self._generations = {}  # uuid -> (ready_at, failed)
+        self._lock = threading.Lock()
+        self.stats = {'pipelines': 0, 'run': 0, 'status': 0, 'oauth': 0, 'chat': 0, 'errors': 0}
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def app_env(self) -> dict:
+        """Переменные окружения, которые направляют приложение на заглушки."""
+        return {
+            'FUSION_API_URL': self.base_url + '/',
+            'FUSION_API_KEY': 'fake-key',
+            'FUSION_SECRET_KEY': 'fake-secret',
+            'GIGA_AUTH_URL': self.base_url + '/api/v2/oauth',
+            'GIGA_API_BASE_URL': self.base_url + '/api/v1',
+            'GIGA_CLIENT_ID': 'fake-client',
+            'GIGA_CLIENT_SECRET': 'fake-secret',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-upstreams', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _failed(self) -> bool:
+        return random.random() < self.config.failure_rate
+
+    def _make_handler(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящих API
+
+            def log_message(self, format, *args):
+                pass  # без строки лога на каждый запрос
+
+            def _delay(self):
+                config = upstreams.config
+                time.sleep(max(config.latency_ms + random.uniform(-config.jitter_ms, config.jitter_ms), 0) / 1000)
+
+            def _read_body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+            def _send_json(self, payload, status=200):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_error(self):
+                upstreams._count('errors')
+                self._send_json({'message': 'fake upstream failure'}, 500)
+
+            def do_GET(self):
+                self._delay()
+                if self.path == '/key/api/v1/pipelines':
+                    upstreams._count('pipelines')
+                    return self._send_json([{'id': 'fake-pipeline', 'name': 'Kandinsky (fake)', 'status': 'ACTIVE'}])
+                match = STATUS_PATH_RE.match(self.path)
+                if match:
+                    upstreams._count('status')
+                    return self._status(match.group(1))
+                self._send_json({'message': 'not found'}, 404)
+
+            def do_POST(self):
+                body = self._read_body()
+                self._delay()
+                if self.path == '/key/api/v1/pipeline/run':
+                    upstreams._count('run')
+                    return self._run()
+                if self.path == '/api/v2/oauth':
+                    upstreams._count('oauth')
+                    expires_at = int((time.time() + 1800) * 1000)  # как у GigaChat: миллисекунды
+                    return self._send_json({'access_token': uuid.uuid4().hex, 'expires_at': expires_at})
+                if self.path == '/api/v1/chat/completions':
+                    upstreams._count('chat')
+                    return self._chat(json.loads(body or b'{}'))
+                self._send_json({'message': 'not found'}, 404)
+
+            def _run(self):
+                if upstreams._failed():
+                    return self._send_error()
+                config = upstreams.config
+                generation_id = str(uuid.uuid4())
+                ready_at = time.time() + max(
+                    config.completion_time + random.uniform(-config.completion_jitter, config.completion_jitter), 0)
+                with upstreams._lock:
+                    upstreams._generations[generation_id] = (ready_at, upstreams._failed())
+                self._send_json({'uuid': generation_id, 'status': 'INITIAL'}, 201)
+
+            def _status(self, generation_id):
+                with upstreams._lock:
+                    generation = upstreams._generations.get(generation_id)
+                if generation is None:
+                    return self._send_json({'message': 'generation not found'}, 404)
+                ready_at, failed = generation
+                if time.time() < ready_at:
+                    return self._send_json({'uuid': generation_id, 'status': 'PROCESSING'})
+                with upstreams._lock:
+                    upstreams._generations.pop(generation_id, None)
+                if failed:
+                    return self._send_json({'uuid': generation_id, 'status': 'FAIL',
+                                            'errorDescription': 'fake generation failure'})
+                self._send_json({'uuid': generation_id, 'status': 'DONE', 'censored': False,
+                                 'result': {'files': [upstreams.image_b64]}})
+
+            def _chat(self, payload):
+                if upstreams._failed():
+                    return self._send_error()
+                config = upstreams.config
+                prompt = payload.get('messages', [{}])[-1].get('content', '')
+                words = [f"improved({prompt})"] + [f" detail{i}" for i in range(config.chat_tokens - 1)]
+                if not payload.get('stream'):
+                    time.sleep(config.token_delay_ms * len(words) / 1000)  # модель генерирует весь ответ
+                    return self._send_json({'choices': [{'message': {'role': 'assistant', 'content': ''.join(words)},
+                                                         'finish_reason': 'stop', 'index': 0}]})
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')  # длина потока заранее неизвестна
+                self.end_headers()
+                for word in words:
+                    time.sleep(config.token_delay_ms / 1000)
+                    chunk = {'choices': [{'delta': {'content': word}, 'index': 0}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+        return Handler
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency-ms', type=float, default=30, help='задержка каждого ответа заглушек')
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='доля ответов 500 и генераций FAIL')
+    parser.add_argument('--completion-time', type=float, default=5.0, help='s от запуска генерации до DONE')
+    parser.add_argument('--completion-jitter', type=float, default=1.0)
+    parser.add_argument('--chat-tokens', type=int, default=40)
+    parser.add_argument('--token-delay-ms', type=float, default=20)
+
+
+def config_from_args(args) -> FakeUpstreamConfig:
+    return FakeUpstreamConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, failure_rate=args.failure_rate,
+                              completion_time=args.completion_time, completion_jitter=args.completion_jitter,
+                              chat_tokens=args.chat_tokens, token_delay_ms=args.token_delay_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(config_from_args(args), args.host, args.port).start()
+    print(f"Fake FusionBrain/GigaChat: {upstreams.base_url}")
+    print("Переменные окружения для приложения:")
+    for key, value in upstreams.app_env().items():
+        print(f"{key}={value}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"stats: {upstreams.stats}")
+    except KeyboardInterrupt:
+        upstreams.stop()
+
+
+if __name__ == '__main__':
+    main()
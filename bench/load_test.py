@@ -0,0 +1,313 @@
+"""
+Нагрузочный тест /generate-card и /improve-prompt с заданными уровнями конкурентности.
+Отчёт: пропускная способность и задержки p50/p95/p99 по каждому режиму.
+
+Приложение и заглушки внешних API можно запустить автоматически:
+  python bench/load_test.py --spawn flask --concurrency 1,8,32 --requests 200
+  python bench/load_test.py --spawn asgi --modes generate --completion-time 8 --concurrency 100,500
+
+или нагрузить уже запущенный сервер (направленный на bench/fake_upstreams.py):
+  python bench/load_test.py --base-url http://127.0.0.1:5000 --modes upload,improve
+
+Нагрузку можно воспроизвести из журнала запросов (--replay log.jsonl), по одному JSON на строку:
+  {"endpoint": "/generate-card", "mode": "generate", "prompt": "кот", "style": "UHD", "logoX": 0.5}
+  {"endpoint": "/generate-card", "mode": "upload", "logoScale": 0.8, "format": "webp"}
+  {"endpoint": "/improve-prompt", "prompt": "кот в космосе", "t": 12.5}
+Необязательное поле t — смещение от начала журнала в секундах; с --paced запросы
+отправляются в эти моменты (открытая нагрузка), иначе — так быстро, как позволяет concurrency.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageDraw
+
+from fake_upstreams import FakeUpstreams, add_arguments, config_from_args
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('upload', 'generate', 'improve', 'improve-stream')
+PROMPTS = ('кот в космосе', 'горный пейзаж на закате', 'абстрактные волны', 'ночной город в неоне')
+STYLES = ('DEFAULT', 'KANDINSKY', 'UHD', 'ANIME')
+
+
+def _png_bytes(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class Fixtures:
+    """Логотип и фон, сгенерированные Pillow. unique=True делает каждый логотип уникальным (мимо кэша логотипов)."""
+    def __init__(self, unique: bool):
+        self.unique = unique
+        self.logo = Image.new('RGBA', (400, 400), (0, 0, 0, 0))
+        ImageDraw.Draw(self.logo).ellipse((40, 40, 360, 360), fill=(220, 40, 40, 255))
+        self.logo_bytes = _png_bytes(self.logo)
+        background = Image.new('RGB', (1032, 648), (30, 90, 160))
+        ImageDraw.Draw(background).rectangle((100, 100, 900, 500), fill=(240, 200, 60))
+        self.background_bytes = _png_bytes(background)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def next_logo(self) -> bytes:
+        if not self.unique:
+            return self.logo_bytes
+        with self._lock:
+            n = next(self._counter)
+        logo = self.logo.copy()
+        logo.putpixel((n % 400, (n // 400) % 400), (n % 256, (n // 256) % 256, 7, 255))
+        return _png_bytes(logo)
+
+
+class Workload:
+    """Бесконечная последовательность запросов: синтетическая по режимам или из журнала (replay)."""
+    def __init__(self, modes: list[str], unique: bool, replay: list[dict] | None = None):
+        self.modes = modes
+        self.unique = unique
+        self.replay = replay
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def next(self) -> dict:
+        with self._lock:
+            n = next(self._counter)
+        if self.replay:
+            entry = dict(self.replay[n % len(self.replay)])
+        else:
+            mode = self.modes[n % len(self.modes)]
+            entry = {'mode': mode, 'prompt': PROMPTS[n % len(PROMPTS)], 'style': STYLES[n % len(STYLES)],
+                     'logoX': round(random.uniform(0.2, 0.8), 3), 'logoY': round(random.uniform(0.2, 0.8), 3)}
+            entry['endpoint'] = '/improve-prompt' if mode.startswith('improve') else '/generate-card'
+            if mode == 'improve-stream':
+                entry['endpoint'] = '/improve-prompt/stream'
+        if self.unique and entry.get('prompt'):
+            entry['prompt'] = f"{entry['prompt']} {n}"  # мимо кэшей промптов и фонов
+        return entry
+
+
+def load_replay(path: str) -> list[dict]:
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if 'endpoint' not in entry:
+                raise ValueError(f"В записи журнала нет поля endpoint: {line[:200]}")
+            entries.append(entry)
+    if not entries:
+        raise ValueError(f"Журнал {path} пуст")
+    return entries
+
+
+def mode_of(entry: dict) -> str:
+    endpoint = entry['endpoint']
+    if endpoint == '/generate-card':
+        return entry.get('mode', 'upload')
+    if endpoint == '/improve-prompt/stream':
+        return 'improve-stream'
+    if endpoint == '/improve-prompt':
+        return 'improve'
+    return endpoint
+
+
+def send(session: requests.Session, base_url: str, entry: dict, fixtures: Fixtures, timeout: float) -> int:
+    """Отправляет запрос и дочитывает ответ целиком. Возвращает HTTP статус."""
+    url = base_url + entry['endpoint']
+    if entry['endpoint'] == '/generate-card':
+        form = {key: str(value) for key, value in entry.items() if key not in ('endpoint', 't')}
+        files = {'logo': ('logo.png', fixtures.next_logo(), 'image/png')}
+        if form.get('mode', 'upload') == 'upload':
+            files['background'] = ('background.png', fixtures.background_bytes, 'image/png')
+        form.setdefault('mode', 'upload')
+        response = session.post(url, data=form, files=files, timeout=timeout)
+    elif entry['endpoint'].startswith('/improve-prompt'):
+        response = session.post(url, json={'prompt': entry.get('prompt', '')}, timeout=timeout)
+        if response.ok and entry['endpoint'].endswith('/stream') and b'event: error' in response.content:
+            return 599  # ошибка пришла событием внутри потока SSE
+    else:
+        response = session.get(url, timeout=timeout)
+    response.content  # дочитываем тело: задержка — до последнего байта ответа
+    return response.status_code
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Перцентиль по методу ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def run_level(base_url: str, workload: Workload, fixtures: Fixtures, concurrency: int, total: int,
+              duration: float | None, timeout: float, paced: bool) -> list[dict]:
+    """Прогон с фиксированной конкурентностью. Возвращает записи (mode, status, latency, finished_at)."""
+    records = []
+    lock = threading.Lock()
+    counter = itertools.count()
+    started = time.perf_counter()
+
+    def worker():
+        session = requests.Session()  # keep-alive соединение на каждого виртуального пользователя
+        while True:
+            n = next(counter)
+            if duration is None and n >= total:
+                return
+            if duration is not None and time.perf_counter() - started >= duration:
+                return
+            entry = workload.next()
+            if paced and 't' in entry:
+                delay = entry['t'] - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            request_started = time.perf_counter()
+            try:
+                status = send(session, base_url, entry, fixtures, timeout)
+            except requests.exceptions.RequestException:
+                status = 0  # сетевая ошибка или таймаут
+            finished = time.perf_counter()
+            with lock:
+                records.append({'mode': mode_of(entry), 'status': status,
+                                'latency': finished - request_started, 'finished_at': finished - started})
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    return records
+
+
+def summarize(records: list[dict], concurrency: int) -> list[dict]:
+    if not records:
+        return []
+    wall = max(record['finished_at'] for record in records)
+    rows = []
+    for mode in sorted({record['mode'] for record in records}):
+        mode_records = [record for record in records if record['mode'] == mode]
+        ok = [record['latency'] for record in mode_records if 200 <= record['status'] < 300]
+        rows.append({
+            'concurrency': concurrency,
+            'mode': mode,
+            'requests': len(mode_records),
+            'ok': len(ok),
+            'errors': len(mode_records) - len(ok),
+            'throughput_rps': round(len(ok) / wall, 2) if wall else 0.0,
+            'p50_ms': round(percentile(ok, 50) * 1000, 1),
+            'p95_ms': round(percentile(ok, 95) * 1000, 1),
+            'p99_ms': round(percentile(ok, 99) * 1000, 1),
+            'statuses': {str(status): sum(1 for record in mode_records if record['status'] == status)
+                         for status in sorted({record['status'] for record in mode_records})},
+        })
+    return rows
+
+
+def print_table(rows: list[dict]):
+    header = f"{'conc':>5} {'mode':<15} {'reqs':>6} {'ok':>6} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(f"{row['concurrency']:>5} {row['mode']:<15} {row['requests']:>6} {row['ok']:>6} {row['errors']:>5} "
+              f"{row['throughput_rps']:>8.2f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+
+
+# --- Запуск приложения для теста ---
+def spawn_app(server: str, port: int, env: dict) -> subprocess.Popen:
+    if server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads',
+                   '--no-reload', '--no-debugger']
+    return subprocess.Popen(command, cwd=ROOT, env={**os.environ, **env},
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(base_url: str, process: subprocess.Popen, timeout: float = 300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Приложение завершилось с кодом {process.returncode}")
+        try:
+            if requests.get(base_url + '/readyz', timeout=2).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError("Приложение не стало готовым вовремя")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--spawn', choices=('flask', 'asgi'),
+                        help='запустить заглушки и приложение (на свободном порту) на время теста')
+    parser.add_argument('--app-port', type=int, default=5099)
+    parser.add_argument('--modes', default='upload,generate,improve', help=f"через запятую из {', '.join(MODES)}")
+    parser.add_argument('--concurrency', default='1,8,32', help='уровни конкурентности через запятую')
+    parser.add_argument('--requests', type=int, default=100, help='запросов на уровень конкурентности')
+    parser.add_argument('--duration', type=float, help='секунд на уровень (вместо --requests)')
+    parser.add_argument('--timeout', type=float, default=180)
+    parser.add_argument('--replay', help='журнал запросов JSONL (см. описание)')
+    parser.add_argument('--paced', action='store_true', help='соблюдать смещения t из журнала')
+    parser.add_argument('--cache-hits', action='store_true',
+                        help='повторять одинаковые промпты и логотипы (по умолчанию каждый запрос уникален)')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"неизвестные режимы: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+    replay = load_replay(args.replay) if args.replay else None
+
+    upstreams = process = None
+    base_url = args.base_url.rstrip('/')
+    if args.spawn:
+        upstreams = FakeUpstreams(config_from_args(args)).start()
+        env = dict(upstreams.app_env(), MODEL_WARMUP='eager', GIGA_TOKEN_CACHE='')
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        print(f"Заглушки: {upstreams.base_url}; запуск приложения ({args.spawn}) на {base_url}...")
+        process = spawn_app(args.spawn, args.app_port, env)
+
+    # общие на все уровни, чтобы уникальные промпты и логотипы не повторялись между уровнями
+    workload = Workload(modes, unique=not args.cache_hits, replay=replay)
+    fixtures = Fixtures(unique=not args.cache_hits)
+    results = []
+    try:
+        if process:
+            wait_ready(base_url, process)
+        for concurrency in levels:
+            print(f"\n== concurrency {concurrency} ==")
+            records = run_level(base_url, workload, fixtures, concurrency, args.requests, args.duration,
+                                args.timeout, args.paced)
+            rows = summarize(records, concurrency)
+            print_table(rows)
+            results.extend(rows)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        if upstreams:
+            print(f"\nЗапросов к заглушкам: {upstreams.stats}")
+            upstreams.stop()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'base_url': base_url, 'server': args.spawn, 'results': results}, f, ensure_ascii=False,
+                      indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Генерирует изображения для bench/microbench.py в bench/fixtures (детерминированно, seed фиксирован).
+Файлы лежат в репозитории; скрипт нужен, чтобы их можно было пересоздать или добавить новые.
+
+  python bench/make_fixtures.py
+"""
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# имя файла -> (размер, режим); RGBA — логотипы с прозрачностью, как после загрузки PNG
+FIXTURES = {
+    'logo_small_alpha.png': ((128, 128), 'RGBA'),
+    'logo_typical_alpha.png': ((800, 800), 'RGBA'),
+    'logo_typical_opaque.jpg': ((800, 600), 'RGB'),
+    'logo_4k_alpha.png': ((3840, 2160), 'RGBA'),
+    'background_typical.png': ((1032, 648), 'RGB'),  # размер ответа FusionBrain (TARGET_WIDTH x TARGET_HEIGHT)
+    'background_4k_opaque.jpg': ((3840, 2160), 'RGB'),
+    'background_4k_alpha.png': ((3840, 2160), 'RGBA'),
+}
+
+
+def make_image(size: tuple, mode: str, seed: int) -> Image.Image:
+    """Градиент с фигурами и лёгким размытием — сжимается как реальные картинки, а не как шум или заливка."""
+    rng = random.Random(seed)
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', (gradient, gradient.rotate(90).resize(size), Image.new('L', size, rng.randrange(256))))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(max(width, height) // 40 + 1, max(width, height) // 6 + 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+        else:
+            draw.rectangle((x - r, y - r // 2, x + r, y + r // 2), fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(1))
+    if mode == 'RGBA':
+        # непрозрачная фигура в центре на прозрачном поле, с мягким краем
+        alpha = Image.new('L', size, 0)
+        ImageDraw.Draw(alpha).ellipse((width // 8, height // 8, width * 7 // 8, height * 7 // 8), fill=255)
+        image.putalpha(alpha.filter(ImageFilter.GaussianBlur(max(width, height) // 200 + 1)))
+    return image
+
+
+def main():
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    for seed, (name, (size, mode)) in enumerate(sorted(FIXTURES.items())):
+        image = make_image(size, mode, seed)
+        path = os.path.join(FIXTURES_DIR, name)
+        if name.endswith('.jpg'):
+            image.save(path, format='JPEG', quality=90)
+        else:
+            image.save(path, format='PNG', optimize=True)
+        print(f"{name}: {size[0]}x{size[1]} {mode}, {os.path.getsize(path) // 1024} KB")
+
+
+if __name__ == '__main__':
+    main()
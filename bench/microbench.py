@@ -0,0 +1,290 @@
+"""
+Микробенчмарки обработки изображений: декодирование, NsfwDetector._load_image, автоконтраст
+с LANCZOS, масштабирование и наложение логотипа, шаблон карты, кодирование и весь путь
+overlay_logo целиком. Каждый этап замеряется отдельно на изображениях из bench/fixtures
+(маленькие, типичные и 4K, с прозрачностью и без), плюс прирост пикового RSS на этап.
+
+  python bench/microbench.py --output results.json               # замер
+  python bench/microbench.py --save-baseline                     # записать bench/baseline.json
+  python bench/microbench.py --compare bench/baseline.json       # код выхода 1 при регрессии
+  python bench/microbench.py --filter overlay --min-time 2
+
+Базовую линию имеет смысл сравнивать только с замером на той же машине.
+"""
+import argparse
+import base64
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PIL  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from services import compositing  # noqa: E402
+from services.image_encoding import ImageEncoder  # noqa: E402
+from services.nsfw_detector import NsfwDetector  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows: пиковая память не замеряется
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+TEMPLATE_PATH = os.path.join(ROOT, 'placeholders', 'card-vanished.png')
+CARD_WIDTH, CARD_HEIGHT = 1032, 648
+
+LOGOS = ('logo_small_alpha.png', 'logo_typical_alpha.png', 'logo_typical_opaque.jpg', 'logo_4k_alpha.png')
+BACKGROUNDS = ('background_typical.png', 'background_4k_opaque.jpg', 'background_4k_alpha.png')
+TYPICAL_LOGO = 'logo_typical_alpha.png'
+TYPICAL_BACKGROUND = 'background_typical.png'
+
+
+# --- Подготовка данных ---
+def _read(name: str) -> bytes:
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def _decode(data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def _fixture_name(name: str) -> str:
+    return os.path.splitext(name)[0]
+
+
+def _nsfw_loader():
+    # _load_image не использует модель — экземпляр создаётся без загрузки transformers
+    return NsfwDetector.__new__(NsfwDetector)._load_image
+
+
+def _prepared_pair():
+    background = compositing.prepare_background(_decode(_read(TYPICAL_BACKGROUND)), CARD_WIDTH, CARD_HEIGHT)
+    logo = compositing.resize_logo(_decode(_read(TYPICAL_LOGO)), 0.5, CARD_WIDTH)
+    return background, logo
+
+
+def _design():
+    background, logo = _prepared_pair()
+    return compositing.place_logo(background, logo, 0.5, 0.5)
+
+
+def _overlay(background_bytes: bytes, logo: Image.Image, encoder: ImageEncoder) -> bytes:
+    """Путь overlay_logo из app.py: декодирование фона, композиция и PNG."""
+    design = compositing.compose_design(_decode(background_bytes), logo, 0.5, 0.5, 0.5, CARD_WIDTH, CARD_HEIGHT)
+    return encoder.encode(design, 'png').data
+
+
+# Каждый бенчмарк: имя -> setup(), возвращающий функцию без аргументов (замеряется только она)
+def _benchmarks() -> dict:
+    benchmarks = {}
+    encoder = ImageEncoder()
+
+    for name in LOGOS + BACKGROUNDS:
+        fixture = _fixture_name(name)
+        benchmarks[f'decode/{fixture}'] = lambda name=name: (lambda data=_read(name): _decode(data))
+        benchmarks[f'nsfw_load_image/{fixture}'] = (
+            lambda name=name: (lambda image=_decode(_read(name)), load=_nsfw_loader(): load(image)))
+
+    for name in BACKGROUNDS:
+        fixture = _fixture_name(name)
+        # FusionBrain возвращает фон в base64
+        benchmarks[f'b64decode/{fixture}'] = (
+            lambda name=name: (lambda encoded=base64.b64encode(_read(name)).decode(): base64.b64decode(encoded)))
+        benchmarks[f'nsfw_load_image_b64/{fixture}'] = (
+            lambda name=name: (lambda encoded=base64.b64encode(_read(name)).decode(), load=_nsfw_loader():
+                               load(encoded)))
+        benchmarks[f'autocontrast_resize/{fixture}'] = (
+            lambda name=name: (lambda image=_decode(_read(name)):
+                               compositing.prepare_background(image, CARD_WIDTH, CARD_HEIGHT)))
+        benchmarks[f'overlay_logo/{fixture}'] = (
+            lambda name=name: (lambda data=_read(name), logo=_decode(_read(TYPICAL_LOGO)):
+                               _overlay(data, logo, encoder)))
+
+    for name in LOGOS:
+        fixture = _fixture_name(name)
+        benchmarks[f'resize_logo/{fixture}'] = (
+            lambda name=name: (lambda image=_decode(_read(name)): compositing.resize_logo(image, 0.5, CARD_WIDTH)))
+
+    benchmarks['paste/typical'] = lambda: (lambda pair=_prepared_pair(): compositing.place_logo(*pair, 0.5, 0.5))
+    benchmarks['card_template/typical'] = (
+        lambda: (lambda design=_design(): compositing.apply_card_template(design, TEMPLATE_PATH)))
+    # как cpu_pool.render_card: дизайн и карта с одного холста
+    benchmarks['render_variants/typical'] = (
+        lambda: (lambda pair=_prepared_pair(): compositing.render_variants(*pair, 0.5, 0.5, ('design', 'card'),
+                                                                           TEMPLATE_PATH)))
+    for fmt in ('png', 'webp', 'jpeg'):
+        benchmarks[f'encode_{fmt}/typical'] = lambda fmt=fmt: (lambda design=_design(): encoder.encode(design, fmt))
+    return benchmarks
+
+
+# --- Замер ---
+def measure_time(fn, min_time: float, min_rounds: int, max_rounds: int) -> dict:
+    fn()  # прогрев: ленивые инициализации Pillow и кэши шаблона карты
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_rounds and (len(timings) < min_rounds or time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'stdev_ms': round(statistics.stdev(timings), 3) if len(timings) > 1 else 0.0,
+        'rounds': len(timings),
+    }
+
+
+def _proc_status_mb(field: str) -> float | None:
+    """VmRSS / VmHWM из /proc/self/status (Linux), МБ."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """Сбрасывает пиковый RSS процесса (VmHWM) до текущего; только Linux."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024  # macOS — байты, Linux — КБ
+
+
+def _peak_memory_task(name: str) -> float:
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        fn = _benchmarks()[name]()
+        gc.collect()
+        if _reset_peak_rss():
+            before = _proc_status_mb('VmRSS')
+            fn()
+            return round(_proc_status_mb('VmHWM') - before, 2)
+        # без сброса пика: прирост ru_maxrss, занижен, если подготовка заняла больше памяти
+        before = _max_rss_mb()
+        fn()
+        return round(_max_rss_mb() - before, 2)
+
+
+def measure_peak_memory(name: str) -> float | None:
+    """Прирост пикового RSS за один вызов, в отдельном процессе (память Pillow не видна tracemalloc)."""
+    if resource is None:
+        return None
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_peak_memory_task, (name,))
+
+
+def run(filter_text: str | None, min_time: float, min_rounds: int, max_rounds: int, memory: bool) -> dict:
+    results = {}
+    for name, setup in _benchmarks().items():
+        if filter_text and filter_text not in name:
+            continue
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):  # отладочные print сервисов
+            result = measure_time(setup(), min_time, min_rounds, max_rounds)
+        if memory:
+            result['peak_rss_mb'] = measure_peak_memory(name)
+        results[name] = result
+        memory_text = f", peak +{result['peak_rss_mb']:.1f} MB" if result.get('peak_rss_mb') is not None else ''
+        print(f"{name:<50} {result['median_ms']:>10.2f} ms (min {result['min_ms']:.2f}, "
+              f"n={result['rounds']}){memory_text}")
+    return {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+        },
+        'benchmarks': results,
+    }
+
+
+# --- Сравнение с базовой линией ---
+def compare(current: dict, baseline: dict, time_threshold: float, memory_threshold: float,
+            min_delta_ms: float = 0.5, min_delta_mb: float = 5.0) -> list[str]:
+    """Возвращает описания регрессий. Небольшие абсолютные разницы (шум) не считаются."""
+    regressions = []
+    print(f"\nСравнение с базовой линией ({baseline['meta'].get('created_at')}, "
+          f"Pillow {baseline['meta'].get('pillow')} -> {current['meta']['pillow']}):")
+    for name, result in current['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None:
+            print(f"  {name:<50} нет в базовой линии")
+            continue
+        ratio = result['median_ms'] / base['median_ms'] if base['median_ms'] else 1.0
+        flag = ''
+        if ratio > 1 + time_threshold and result['median_ms'] - base['median_ms'] > min_delta_ms:
+            flag = '  <-- РЕГРЕССИЯ'
+            regressions.append(f"{name}: {base['median_ms']:.2f} -> {result['median_ms']:.2f} ms (x{ratio:.2f})")
+        base_mb, mb = base.get('peak_rss_mb'), result.get('peak_rss_mb')
+        if base_mb is not None and mb is not None and mb > base_mb * (1 + memory_threshold) \
+                and mb - base_mb > min_delta_mb:
+            flag = '  <-- РЕГРЕССИЯ ПАМЯТИ'
+            regressions.append(f"{name}: peak RSS {base_mb:.1f} -> {mb:.1f} MB")
+        print(f"  {name:<50} {base['median_ms']:>9.2f} -> {result['median_ms']:>9.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', help='только бенчмарки, в имени которых есть эта подстрока')
+    parser.add_argument('--min-time', type=float, default=0.5, help='секунд замеров на бенчмарк')
+    parser.add_argument('--min-rounds', type=int, default=5)
+    parser.add_argument('--max-rounds', type=int, default=200)
+    parser.add_argument('--no-memory', action='store_true', help='не замерять пиковую память')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE, metavar='PATH',
+                        help=f'сохранить результаты как базовую линию (по умолчанию {os.path.relpath(DEFAULT_BASELINE, ROOT)})')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, metavar='PATH',
+                        help='сравнить с базовой линией; код выхода 1 при регрессии')
+    parser.add_argument('--threshold', type=float, default=0.15, help='допустимое замедление медианы (0.15 = 15%%)')
+    parser.add_argument('--memory-threshold', type=float, default=0.25)
+    args = parser.parse_args()
+
+    current = run(args.filter, args.min_time, args.min_rounds, args.max_rounds, memory=not args.no_memory)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(current, f, ensure_ascii=False, indent=2)
+            print(f"Результаты сохранены в {path}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold, args.memory_threshold)
+        if regressions:
+            print(f"\nРегрессий: {len(regressions)}")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nРегрессий нет.")
+
+
+if __name__ == '__main__':
+    main()
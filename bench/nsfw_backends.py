@@ -0,0 +1,202 @@
+"""
+Сравнение бэкендов NsfwDetector: transformers (PyTorch) и ONNX Runtime (fp32 и int8).
+Каждый бэкенд загружается в отдельном процессе: время загрузки, прирост RSS после загрузки,
+пиковый RSS, задержка на одно изображение и на изображение в батче. Затем вердикты и nsfw score
+сравниваются с эталоном (transformers) на наборе изображений — по умолчанию bench/fixtures и
+placeholders; для реальной оценки укажите каталог с размеченной выборкой (--images).
+
+  python bench/nsfw_backends.py
+  python bench/nsfw_backends.py --images /data/nsfw-sample --output nsfw.json
+  python bench/nsfw_backends.py --backends onnx-fp32,onnx-int8      # без torch, модель уже экспортирована
+
+ONNX модель экспортируется в --onnx-dir при первом запуске (нужны torch и transformers).
+Изображения уменьшаются так же, как в приложении (services.ingest.model_input).
+"""
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+
+from services import ingest, nsfw_onnx  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGE_DIRS = (os.path.join(BENCH_DIR, 'fixtures'), os.path.join(ROOT, 'placeholders'))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+NSFW_INPUT_SIZE = 224
+
+# имя -> параметры NsfwDetector
+BACKENDS = {
+    'transformers': {'backend': 'transformers'},
+    'onnx-fp32': {'backend': 'onnx', 'onnx_quantize': False},
+    'onnx-int8': {'backend': 'onnx', 'onnx_quantize': True},
+}
+
+
+def _image_paths(paths: list[str]) -> list[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            found.append(path)
+    return found
+
+
+def _load_images(paths: list[str]) -> list[Image.Image]:
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(ingest.model_input(ingest.decode_image(f.read()), NSFW_INPUT_SIZE))
+    return images
+
+
+def _rss_mb(field: str = 'VmRSS') -> float | None:
+    """VmRSS / VmHWM из /proc/self/status (Linux), МБ."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _nsfw_score(result: list) -> float:
+    return next((item['score'] for item in result if item['label'] == 'nsfw'), 0.0)
+
+
+def _measure(fn, rounds: int) -> float:
+    """Медиана времени вызова, мс (после одного прогрева)."""
+    fn()
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def _export_task(model: str, onnx_dir: str, quantize: bool) -> str:
+    return nsfw_onnx.ensure_model(model, onnx_dir, quantize)
+
+
+def _backend_task(name: str, paths: list[str], model: str, onnx_dir: str, threads: int,
+                  rounds: int, batch_size: int) -> dict:
+    """Выполняется в отдельном процессе: память и потоки одного бэкенда не влияют на другой."""
+    from services.nsfw_detector import NsfwDetector
+
+    images = _load_images(paths)
+    gc.collect()
+    rss_before = _rss_mb()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            detector = NsfwDetector(model_name=model, max_wait_ms=0, onnx_dir=onnx_dir, onnx_threads=threads,
+                                    **BACKENDS[name])
+    except Exception as e:
+        return {'error': f'классификатор не загрузился: {e}'}
+    load_seconds = time.perf_counter() - start
+    rss_loaded = _rss_mb()
+
+    classifier = detector.classifier
+    results = classifier(images, batch_size=batch_size)
+    batch = (images * (batch_size // len(images) + 1))[:batch_size]
+    single_ms = statistics.median(_measure(lambda image=image: classifier([image], batch_size=1), rounds)
+                                  for image in images)
+    batch_ms = _measure(lambda: classifier(batch, batch_size=batch_size), rounds)
+    return {
+        'load_s': round(load_seconds, 2),
+        'rss_load_mb': round(rss_loaded - rss_before, 1) if rss_before is not None else None,
+        'peak_rss_mb': _rss_mb('VmHWM'),
+        'single_ms': round(single_ms, 2),
+        'batch_ms_per_image': round(batch_ms / batch_size, 2),
+        'predictions': [{'file': os.path.relpath(path, ROOT), 'label': result[0]['label'],
+                         'nsfw_score': round(_nsfw_score(result), 5)} for path, result in zip(paths, results)],
+    }
+
+
+def _run_in_process(fn, *args):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def agreement(reference: dict, candidate: dict) -> dict:
+    """Доля совпавших вердиктов и расхождение nsfw score с эталоном."""
+    pairs = list(zip(reference['predictions'], candidate['predictions']))
+    deltas = [abs(ref['nsfw_score'] - other['nsfw_score']) for ref, other in pairs]
+    return {
+        'agreement': round(sum(ref['label'] == other['label'] for ref, other in pairs) / len(pairs), 4),
+        'max_score_delta': round(max(deltas), 5),
+        'mean_score_delta': round(sum(deltas) / len(deltas), 5),
+        'disagreements': [ref['file'] for ref, other in pairs if ref['label'] != other['label']],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', nargs='+', default=list(DEFAULT_IMAGE_DIRS), help='файлы или каталоги')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help=f"через запятую из {', '.join(BACKENDS)}")
+    parser.add_argument('--model', default=nsfw_onnx.DEFAULT_MODEL)
+    parser.add_argument('--onnx-dir', default=os.path.join(ROOT, 'cache', 'nsfw_onnx'))
+    parser.add_argument('--threads', type=int, default=0, help='потоки onnxruntime (0 = по числу ядер)')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.backends.split(',') if name.strip()]
+    unknown = [name for name in names if name not in BACKENDS]
+    if unknown:
+        parser.error(f"неизвестные бэкенды: {', '.join(unknown)}")
+    paths = _image_paths(args.images)
+    if not paths:
+        parser.error('нет изображений')
+    print(f"{len(paths)} изображений, бэкенды: {', '.join(names)}")
+
+    # экспорт отдельно, чтобы torch при экспорте не попал в замер памяти бэкенда
+    for quantize in sorted({BACKENDS[name].get('onnx_quantize') for name in names if name.startswith('onnx')}):
+        _run_in_process(_export_task, args.model, args.onnx_dir, quantize)
+
+    results = {}
+    for name in names:
+        results[name] = _run_in_process(_backend_task, name, paths, args.model, args.onnx_dir, args.threads,
+                                        args.rounds, args.batch_size)
+        if 'error' in results[name]:
+            print(f"{name}: {results[name]['error']}")
+
+    loaded = [name for name in names if 'error' not in results[name]]
+    reference = loaded[0] if loaded else None
+    print(f"\n{'backend':<14} {'load s':>7} {'RSS MB':>8} {'peak MB':>8} {'1 img ms':>9} "
+          f"{'batch ms/img':>13} {'agree':>7} {'max Δscore':>11}")
+    for name in loaded:
+        result = results[name]
+        if name != reference:
+            result['vs_' + reference] = agreement(results[reference], result)
+        compared = result.get('vs_' + reference, {})
+        print(f"{name:<14} {result['load_s']:>7.2f} {result['rss_load_mb'] or 0:>8.1f} "
+              f"{result['peak_rss_mb'] or 0:>8.1f} {result['single_ms']:>9.2f} {result['batch_ms_per_image']:>13.2f} "
+              f"{compared.get('agreement', 1.0):>7.2%} {compared.get('max_score_delta', 0.0):>11.5f}")
+        for file in compared.get('disagreements', []):
+            print(f"  расхождение с {reference}: {file}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'images': len(paths), 'reference': reference, 'backends': results}, f,
+                      ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,7 @@ document.addEventListener('DOMContentLoaded', () => {
             loading: document.getElementById('loading-indicator'),
             area: document.getElementById('result-area'),
             image: document.getElementById('result-image'),
+            notice: document.getElementById('result-notice'),
             download: document.getElementById('download-btn'),
             restart: document.getElementById('restart-btn')
         },
@@ -62,13 +63,23 @@ document.addEventListener('DOMContentLoaded', () => {
             baseHeight: 0, // Will be calculated based on aspect ratio
         },
         designOnlyImageUrl: null, // <<<--- ДОБАВИТЬ: URL для скачивания чистого дизайна
+        cardImageUrl: null, // Object URL готовой карты (дизайн + шаблон) для отображения
+        designResultUrl: null, // Адрес варианта 'design' задачи; скачивается только по кнопке
         dragInfo: {
             isDragging: false,
             mouseOffsetX: 0,
             mouseOffsetY: 0
+        },
+        preview: {
+            sessionPromise: null, // Promise с URL серверного предпросмотра для текущих логотипа/фона
+            imageUrl: null, // Object URL последнего серверного рендера
+            timer: null,
+            requestId: 0
         }
     };
 
+    const PREVIEW_DEBOUNCE_MS = 150;
+
     // --- Event Handlers ---
     function initEventListeners() {
         // Form navigation
@@ -105,6 +116,11 @@ document.addEventListener('DOMContentLoaded', () => {
         // Logo resizing
         elements.logo.sizeSlider.addEventListener('input', handleLogoResize);
 
+        // Смена стиля меняет заглушку фона в серверном предпросмотре
+        document.querySelectorAll('input[name="style-select"]').forEach(radio => {
+            radio.addEventListener('change', invalidatePreviewSession);
+        });
+
         // Form submission
         elements.form.addEventListener('submit', handleFormSubmit);
 
@@ -237,6 +253,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!validateFile(file, ['image/jpeg', 'image/png', 'image/svg+xml'], 'Пожалуйста, загрузите изображение в формате PNG, JPG или SVG.')) return;
 
         state.logoFile = file;
+        invalidatePreviewSession();
         const reader = new FileReader();
 
         reader.onload = (e) => {
@@ -260,6 +277,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!validateFile(file, ['image/jpeg', 'image/png'], 'Пожалуйста, загрузите изображение в формате PNG или JPG.')) return;
 
         state.backgroundFile = file;
+        invalidatePreviewSession();
         const reader = new FileReader();
 
         reader.onload = (e) => {
@@ -309,6 +327,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function removeLogo() {
         state.logoFile = null;
+        invalidatePreviewSession();
         elements.logo.upload.value = '';
         elements.logo.previewArea.style.display = 'none';
         elements.logo.dropzone.style.display = 'block';
@@ -325,6 +344,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function removeBg() {
         state.backgroundFile = null;
+        invalidatePreviewSession();
         elements.bg.upload.value = '';
         elements.bg.previewArea.style.display = 'none';
         elements.bg.dropzone.style.display = 'block';
@@ -342,6 +362,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         // Update hidden input value
         elements.bg.option.value = targetId === 'generate-inputs' ? 'generate' : 'upload';
+        invalidatePreviewSession();
 
         const isGenerate = elements.bg.option.value === 'generate';
 
@@ -391,6 +412,8 @@ document.addEventListener('DOMContentLoaded', () => {
         state.dragInfo.mouseOffsetY = mouseYInContainer - currentTopPx;
         state.dragInfo.isDragging = true;
         elements.logo.positionPreview.classList.add('dragging');
+        // Пока логотип перетаскивается, показываем локальное превью, серверный рендер догонит после паузы
+        elements.interactivePreview.classList.remove('server-preview');
     }
 
     function dragLogo(e) {
@@ -471,6 +494,88 @@ document.addEventListener('DOMContentLoaded', () => {
         elements.logo.positionPreview.style.top = `${targetTop}px`;
         elements.logo.positionPreview.style.transform = 'none';
         elements.logo.positionPreview.style.display = 'block';
+
+        schedulePreviewRender();
+    }
+
+    // --- Server-side Preview ---
+    // Сервер держит обработанный логотип и фон сессии, каждый рендер — только наложение и JPEG.
+    function invalidatePreviewSession() {
+        state.preview.sessionPromise = null;
+        state.preview.requestId++;
+        clearTimeout(state.preview.timer);
+        elements.interactivePreview.classList.remove('server-preview');
+        elements.interactivePreview.style.backgroundImage = '';
+        if (state.preview.imageUrl) {
+            URL.revokeObjectURL(state.preview.imageUrl);
+            state.preview.imageUrl = null;
+        }
+    }
+
+    function ensurePreviewSession() {
+        if (state.preview.sessionPromise) return state.preview.sessionPromise;
+
+        const formData = new FormData();
+        formData.append('logo', state.logoFile);
+        if (elements.bg.option.value === 'upload' && state.backgroundFile) {
+            formData.append('background', state.backgroundFile);
+        } else {
+            formData.append('style', document.querySelector('input[name="style-select"]:checked').value);
+        }
+
+        const sessionPromise = fetch('/preview/session', {method: 'POST', body: formData})
+            .then(async response => {
+                if (!response.ok) {
+                    const data = await response.json().catch(() => ({}));
+                    throw new Error(data.error || `Ошибка ${response.status}`);
+                }
+                return (await response.json()).preview_url;
+            });
+        state.preview.sessionPromise = sessionPromise;
+        sessionPromise.catch(() => {
+            if (state.preview.sessionPromise === sessionPromise) state.preview.sessionPromise = null;
+        });
+        return sessionPromise;
+    }
+
+    function schedulePreviewRender() {
+        if (!state.logoFile || state.currentSection !== 3) return;
+        clearTimeout(state.preview.timer);
+        state.preview.timer = setTimeout(renderServerPreview, PREVIEW_DEBOUNCE_MS);
+    }
+
+    async function renderServerPreview(retry = true) {
+        if (state.dragInfo.isDragging) {
+            schedulePreviewRender();
+            return;
+        }
+        const requestId = ++state.preview.requestId;
+        try {
+            const previewUrl = await ensurePreviewSession();
+            const params = new URLSearchParams({
+                x: (state.logoPosition.x / 100).toFixed(4),
+                y: (state.logoPosition.y / 100).toFixed(4),
+                scale: state.logoPosition.scale.toFixed(2),
+                template: '1',
+            });
+            const response = await fetch(`${previewUrl}?${params}`);
+            if (response.status === 404 && retry) {
+                // Сессия истекла или создана другим воркером — создаём заново
+                state.preview.sessionPromise = null;
+                return renderServerPreview(false);
+            }
+            if (!response.ok) throw new Error(`Ошибка ${response.status}`);
+            const blob = await response.blob();
+            if (requestId !== state.preview.requestId || state.dragInfo.isDragging) return; // уже устарел
+
+            if (state.preview.imageUrl) URL.revokeObjectURL(state.preview.imageUrl);
+            state.preview.imageUrl = URL.createObjectURL(blob);
+            elements.interactivePreview.style.backgroundImage = `url(${state.preview.imageUrl})`;
+            elements.interactivePreview.classList.add('server-preview');
+        } catch (error) {
+            // Предпросмотр необязателен: остаётся локальное превью логотипа
+            console.warn('Серверный предпросмотр недоступен:', error);
+        }
     }
 
     function checkAndAdjustBounds() {
@@ -561,35 +666,113 @@ document.addEventListener('DOMContentLoaded', () => {
         hideError();
 
         try {
-            const response = await fetch('/improve-prompt', {
+            const improvedPrompt = await streamImprovedPrompt(currentPrompt)
+                ?? await fetchImprovedPrompt(currentPrompt);
+            elements.prompt.input.value = improvedPrompt;
+
+            // Highlight animation
+            elements.prompt.input.classList.add('highlighted');
+            setTimeout(() => {
+                elements.prompt.input.classList.remove('highlighted');
+            }, 1000);
+        } catch (error) {
+            console.error('Ошибка при улучшении промпта:', error);
+            elements.prompt.input.value = currentPrompt;
+            showError(error instanceof TypeError || !error.message
+                ? 'Сетевая ошибка или не удалось связаться с сервисом улучшения промптов.'
+                : error.message);
+        } finally {
+            // Reset button state
+            elements.prompt.improve.disabled = false;
+            buttonSpan.textContent = originalButtonText;
+        }
+    }
+
+    // Потоковое улучшение: текст появляется в поле промпта по мере генерации.
+    // Возвращает null, если потоковый режим недоступен (тогда используется обычный запрос).
+    async function streamImprovedPrompt(prompt) {
+        let response;
+        try {
+            response = await fetch('/improve-prompt/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream',
                 },
-                body: JSON.stringify({prompt: currentPrompt}),
+                body: JSON.stringify({prompt}),
             });
+        } catch (error) {
+            console.warn('Потоковое улучшение промпта недоступно:', error);
+            return null;
+        }
 
-            const data = await response.json();
-
-            if (response.ok && data.improved_prompt) {
-                elements.prompt.input.value = data.improved_prompt;
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!response.ok || !response.body || !contentType.startsWith('text/event-stream')) {
+            if (response.status === 404 || response.status === 405 || !response.body) {
+                return null;
+            }
+            const data = await response.json().catch(() => ({}));
+            throw new Error(data.error || `Ошибка ${response.status}: Не удалось улучшить промпт.`);
+        }
 
-                // Highlight animation
-                elements.prompt.input.classList.add('highlighted');
-                setTimeout(() => {
-                    elements.prompt.input.classList.remove('highlighted');
-                }, 1000);
-            } else {
-                showError(data.error || `Ошибка ${response.status}: Не удалось улучшить промпт.`);
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        elements.prompt.input.value = '';
+
+        while (true) {
+            const {value, done} = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, {stream: true});
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let eventName = 'message';
+                let data = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                }
+                if (!data) continue;
+                const payload = JSON.parse(data);
+
+                if (eventName === 'token') {
+                    text += payload.content;
+                    elements.prompt.input.value = text;
+                    elements.prompt.input.scrollTop = elements.prompt.input.scrollHeight;
+                } else if (eventName === 'done') {
+                    reader.cancel();
+                    return payload.improved_prompt;
+                } else if (eventName === 'error') {
+                    reader.cancel();
+                    throw new Error(payload.error);
+                }
             }
-        } catch (error) {
-            console.error('Ошибка при улучшении промпта:', error);
-            showError('Сетевая ошибка или не удалось связаться с сервисом улучшения промптов.');
-        } finally {
-            // Reset button state
-            elements.prompt.improve.disabled = false;
-            buttonSpan.textContent = originalButtonText;
         }
+        if (!text.trim()) {
+            throw new Error('Не удалось получить улучшенный промпт.');
+        }
+        return text.trim();
+    }
+
+    async function fetchImprovedPrompt(prompt) {
+        const response = await fetch('/improve-prompt', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({prompt}),
+        });
+
+        const data = await response.json();
+        if (response.ok && data.improved_prompt) {
+            return data.improved_prompt;
+        }
+        throw new Error(data.error || `Ошибка ${response.status}: Не удалось улучшить промпт.`);
     }
 
     // --- Form Submission ---
@@ -631,6 +814,8 @@ document.addEventListener('DOMContentLoaded', () => {
         formData.append('logoY', (state.logoPosition.y / 100).toFixed(4));
         formData.append('logoScale', state.logoPosition.scale.toFixed(4));
         formData.append('mode', isGenerating ? 'generate' : 'upload');
+        // Сервер сам накладывает шаблон карты: показываем 'card', а 'design' забираем только для скачивания
+        formData.append('output', 'both');
 
         // Add mode-specific data
         if (isGenerating) {
@@ -651,27 +836,20 @@ document.addEventListener('DOMContentLoaded', () => {
         // Show loading
         showLoading(true);
 
-        if (state.designOnlyImageUrl) {
-            URL.revokeObjectURL(state.designOnlyImageUrl);
-            state.designOnlyImageUrl = null;
-        }
-        elements.results.image.src = ''; // Очищаем старое изображение на время загрузки
+        resetResultImages();
 
         try {
-            const response = await fetch('/generate-card', {
-                method: 'POST',
-                body: formData
-            });
+            const response = await submitCardJob(formData);
 
             if (response.ok) {
                 const contentType = response.headers.get("content-type");
                 if (contentType && contentType.includes("image/")) {
                     const imageBlob = await response.blob();
-                    // Создаем URL для ЧИСТОГО дизайна (фон + лого)
-                    state.designOnlyImageUrl = URL.createObjectURL(imageBlob); // <<<--- СОХРАНЯЕМ URL
-
-                    // Отображаем композитное изображение (дизайн + шаблон) через Canvas
-                    await displayCompositeImage(state.designOnlyImageUrl);
+                    // Сервер вернул готовую карту (дизайн + шаблон) — просто показываем её
+                    state.cardImageUrl = URL.createObjectURL(imageBlob);
+                    elements.results.image.src = state.cardImageUrl;
+                    // X-Degraded: FusionBrain недоступен, сервер подставил заглушку фона вместо генерации
+                    elements.results.notice.classList.toggle('hidden', !response.headers.get('X-Degraded'));
 
                     elements.results.area.classList.remove('hidden');
                     elements.results.area.scrollIntoView({behavior: 'smooth'});
@@ -723,60 +901,66 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    async function displayCompositeImage(designUrl) {
-        const displayImgElement = elements.results.image; // Элемент <img> для показа результата
-        const templateImgElement = document.getElementById('card-template-img'); // Скрытый <img> с шаблоном
+    // --- Card Job API ---
+    // Генерация идёт в фоновой задаче: отправляем форму, опрашиваем статус
+    // и забираем готовое изображение, когда задача завершится.
+    const JOB_POLL_INTERVAL_MS = 1000;
+    const JOB_STAGE_LABELS = {
+        nsfw: 'Проверяем изображения',
+        remove_background: 'Обрабатываем логотип',
+        generate: 'Генерируем фон',
+        compose: 'Собираем дизайн'
+    };
 
-        if (!templateImgElement) {
-            console.error("Элемент шаблона карты #card-template-img не найден!");
-            // Показываем только дизайн как запасной вариант
-            displayImgElement.src = designUrl;
-            return;
+    async function submitCardJob(formData) {
+        const submitResponse = await fetch('/generate-card/jobs', {
+            method: 'POST',
+            body: formData
+        });
+        if (submitResponse.status !== 202) {
+            // Ошибка валидации или перегрузка сервера — обрабатывается как обычный ответ
+            return submitResponse;
         }
 
-        const canvas = document.createElement('canvas');
-        const ctx = canvas.getContext('2d');
+        const job = await submitResponse.json();
+        await waitForJob(job.status_url);
+        state.designResultUrl = `${job.result_url}?variant=design`;
+        // result_url вернёт изображение или JSON с ошибкой задачи
+        return fetch(`${job.result_url}?variant=card`);
+    }
 
-        // Загружаем оба изображения (дизайн и шаблон)
-        const loadImage = (src) => {
-            return new Promise((resolve, reject) => {
-                const img = new Image();
-                img.onload = () => resolve(img);
-                img.onerror = (err) => {
-                    console.error(`Ошибка загрузки изображения: ${src}`, err);
-                    reject(err);
-                };
-                img.src = src;
-            });
-        };
+    async function waitForJob(statusUrl) {
+        const subtitle = elements.results.loading.querySelector('.loading-subtitle');
+        const defaultSubtitle = subtitle ? subtitle.textContent : '';
 
         try {
-            // Ждем загрузки обоих изображений
-            const [designImage, templateImage] = await Promise.all([
-                loadImage(designUrl),
-                loadImage(templateImgElement.src) // Загружаем шаблон из скрытого img
-            ]);
-
-            // Устанавливаем размер Canvas по размеру дизайна
-            canvas.width = designImage.naturalWidth;
-            canvas.height = designImage.naturalHeight;
-
-            // 1. Рисуем дизайн (фон + лого)
-            ctx.drawImage(designImage, 0, 0);
-
-            // 2. Рисуем шаблон карты поверх
-            // Убедимся, что шаблон рисуется на весь размер холста
-            ctx.drawImage(templateImage, 0, 0, canvas.width, canvas.height);
-
-            // Устанавливаем результат Canvas как src для отображаемого <img>
-            displayImgElement.src = canvas.toDataURL('image/png');
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+                const statusResponse = await fetch(statusUrl);
+                if (!statusResponse.ok) return;
+
+                const job = await statusResponse.json();
+                if (job.status === 'done' || job.status === 'failed') return;
+                if (subtitle && JOB_STAGE_LABELS[job.stage]) {
+                    subtitle.textContent = JOB_STAGE_LABELS[job.stage];
+                }
+            }
+        } finally {
+            if (subtitle) subtitle.textContent = defaultSubtitle;
+        }
+    }
 
-        } catch (error) {
-            console.error("Ошибка при создании композитного изображения на Canvas:", error);
-            // Показываем только дизайн как запасной вариант при ошибке
-            displayImgElement.src = designUrl;
-            showError("Не удалось наложить шаблон карты для предпросмотра. Результат будет без него.");
+    function resetResultImages() {
+        if (state.designOnlyImageUrl) {
+            URL.revokeObjectURL(state.designOnlyImageUrl); // Освобождаем память
+            state.designOnlyImageUrl = null;
         }
+        if (state.cardImageUrl) {
+            URL.revokeObjectURL(state.cardImageUrl);
+            state.cardImageUrl = null;
+        }
+        state.designResultUrl = null;
+        elements.results.image.src = ''; // Очищаем отображаемое изображение
     }
 
     // --- UI Helper Functions ---
@@ -800,12 +984,23 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- Results Functions ---
-    function downloadResult() {
-        // Используем сохраненный URL ЧИСТОГО дизайна
+    async function downloadResult() {
+        // Чистый дизайн (фон + лого) загружаем с сервера только при первом скачивании
         if (!state.designOnlyImageUrl) {
-            console.error("URL чистого дизайна для скачивания не найден.");
-            showError("Не удалось подготовить файл для скачивания.");
-            return;
+            if (!state.designResultUrl) {
+                console.error("URL чистого дизайна для скачивания не найден.");
+                showError("Не удалось подготовить файл для скачивания.");
+                return;
+            }
+            try {
+                const response = await fetch(state.designResultUrl);
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                state.designOnlyImageUrl = URL.createObjectURL(await response.blob());
+            } catch (error) {
+                console.error("Не удалось загрузить дизайн для скачивания:", error);
+                showError("Не удалось подготовить файл для скачивания.");
+                return;
+            }
         }
 
         const link = document.createElement('a');
@@ -819,6 +1014,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function restartProcess() {
         // Reset form and state
         elements.form.reset();
+        invalidatePreviewSession();
 
         // Reset logo position and scale
         state.logoPosition = {
@@ -868,11 +1064,7 @@ document.addEventListener('DOMContentLoaded', () => {
         });
 
         // Сброс URL и изображения результата
-        if (state.designOnlyImageUrl) {
-            URL.revokeObjectURL(state.designOnlyImageUrl); // Освобождаем память
-            state.designOnlyImageUrl = null; // <<<--- СБРОС URL
-        }
-        elements.results.image.src = ''; // <<<--- СБРОС ОТОБРАЖАЕМОГО ИЗОБРАЖЕНИЯ
+        resetResultImages();
 
         // Reset background option tabs
         document.querySelector('.option-tab.active').classList.remove('active');
@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+from services.cache import DiskLRUCache
+
+
+class BackgroundCache:
+    """
+    Кэш сгенерированных фонов, адресуемый SHA-256 от (prompt, style, width, height, pipeline).
+    Готовые изображения хранятся на диске с вытеснением по размеру (общий для всех воркеров).
+    Одновременные запросы с одинаковым ключом присоединяются к уже идущей генерации
+    (single-flight): FusionBrain получает одну задачу, а Future с результатом — все запросы.
+    """
+    def __init__(self, disk_dir: str | None = None, disk_bytes: int = 0):
+        self._disk = DiskLRUCache(disk_dir, disk_bytes) if disk_dir and disk_bytes else None
+        self._inflight = {}  # key -> Future[bytes] идущей генерации
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        print(f"BackgroundCache инициализирован (disk={disk_dir or 'off'})")
+
+    @staticmethod
+    def key_for(prompt: str, style: str | None, width: int, height: int, pipeline: str) -> str:
+        style = (style or 'DEFAULT').upper()
+        raw = json.dumps([prompt.strip(), style, width, height, pipeline], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get_or_generate(self, key: str, start_generation, fresh: bool = False) -> Future:
+        """
+        Возвращает Future с байтами изображения фона.
+        start_generation() запускает генерацию и возвращает Future с base64 строкой;
+        вызывается только если фона нет в кэше и такая же генерация ещё не идёт.
+        fresh=True пропускает чтение кэша (но не дублирует уже идущую генерацию).
+        Исключения start_generation() пробрасываются вызывающему.
+        """
+        if not fresh and self._disk:
+            data = self._disk.get(key)
+            if data:
+                with self._lock:
+                    self.hits += 1
+                future = Future()
+                future.set_result(data)
+                return future
+
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.joined += 1
+                return future
+            self.misses += 1
+            future = Future()
+            self._inflight[key] = future
+
+        try:
+            generation = start_generation()
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        generation.add_done_callback(lambda done: self._on_generated(key, future, done))
+        return future
+
+    def _on_generated(self, key: str, future: Future, generation: Future):
+        try:
+            data = base64.b64decode(generation.result())
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            return
+        if self._disk:
+            self._disk.put(key, data)
+        self._finish(key, future, result=data)
+
+    def _finish(self, key: str, future: Future, result=None, exception=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "joined": self.joined, "inflight": len(self._inflight)}
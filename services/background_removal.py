@@ -0,0 +1,68 @@
+import io
+import os
+import queue
+
+from PIL import Image
+
+# Короткие имена моделей -> имена моделей rembg.
+# u2net — лучшее качество, u2netp — быстрее и легче, isnet — точнее на границах, silueta — компромисс.
+MODEL_ALIASES = {
+    'u2net': 'u2net',
+    'u2netp': 'u2netp',
+    'isnet': 'isnet-general-use',
+    'isnet-general-use': 'isnet-general-use',
+    'silueta': 'silueta',
+}
+
+
+class BackgroundRemover:
+    """
+    Удаление фона логотипа через rembg с заранее созданными сессиями модели.
+    Сессии создаются один раз при старте и хранятся в ограниченном пуле:
+    загрузка модели не попадает в обработку запроса, а одновременных вызовов
+    не больше, чем сессий. Слишком большие изображения уменьшаются до max_side
+    перед инференсом — на карте логотип всё равно занимает не больше четверти ширины.
+    """
+    def __init__(self, model_name: str = 'u2net', pool_size: int | None = None, max_side: int = 1024):
+        if model_name not in MODEL_ALIASES:
+            raise ValueError(f"Unknown rembg model '{model_name}'. Must be one of {', '.join(MODEL_ALIASES)}.")
+        self.model_name = MODEL_ALIASES[model_name]
+        self.pool_size = pool_size or os.cpu_count() or 1
+        self.max_side = max_side
+
+        # rembg тянет за собой onnxruntime, поэтому импортируется только при создании движка
+        from rembg import new_session, remove
+        self._remove = remove
+
+        self._sessions = queue.Queue(maxsize=self.pool_size)
+        for _ in range(self.pool_size):
+            self._sessions.put(new_session(self.model_name))
+        print(f"BackgroundRemover инициализирован (model={self.model_name}, sessions={self.pool_size}, max_side={max_side})")
+
+    def _downscale(self, img: Image.Image) -> Image.Image:
+        if self.max_side and max(img.size) > self.max_side:
+            original_size = img.size
+            img = img.copy()
+            img.thumbnail((self.max_side, self.max_side), Image.Resampling.LANCZOS)
+            print(f"Logo downscaled from {original_size} to {img.size} before background removal")
+        return img
+
+    def remove(self, image_input: bytes | Image.Image) -> bytes | Image.Image:
+        """
+        Удаляет фон. Как и rembg.remove, возвращает результат того же типа,
+        что и вход: PNG байты для bytes, RGBA изображение для PIL Image.
+        """
+        img = image_input if isinstance(image_input, Image.Image) else Image.open(io.BytesIO(image_input))
+        img = self._downscale(img)
+
+        session = self._sessions.get()  # ждём свободную сессию, если все заняты
+        try:
+            result = self._remove(img, session=session)
+        finally:
+            self._sessions.put(session)
+
+        if isinstance(image_input, Image.Image):
+            return result
+        buffer = io.BytesIO()
+        result.save(buffer, format='PNG')
+        return buffer.getvalue()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryLRUCache:
+    """
+    Потокобезопасный LRU кэш в памяти с ограничением по суммарному размеру значений.
+    Размер каждого значения передаётся в put() явно (для изображений это не len()).
+    Если задан ttl (секунды), записи старше ttl считаются отсутствующими.
+    """
+    def __init__(self, max_bytes: int, ttl: float | None = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, size, expires_at)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[2] is not None and item[2] <= time.monotonic():
+                del self._data[key]
+                self._size -= item[1]
+                return default
+            self._data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size: int):
+        if size > self.max_bytes:
+            return  # значение больше всего бюджета — не кэшируем
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._data[key] = (value, size, expires_at)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self._size -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            self._size -= item[1]
+            return item[0]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskLRUCache:
+    """
+    Кэш байтовых значений на диске с вытеснением по суммарному размеру.
+    Время последнего обращения хранится в mtime файла, поэтому при превышении
+    бюджета удаляются давно не читавшиеся записи. Запись атомарная (tmp + replace),
+    так что кэш можно разделять между несколькими процессами-воркерами.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self):
+        """Возвращает (path, size, mtime) всех записей кэша."""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # запись удалили параллельно
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # отмечаем обращение для LRU
+            return data
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Disk cache write failed for {key}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict_locked()
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict_locked(self):
+        # Пересканируем каталог: другие процессы тоже пишут в него
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9  # освобождаем с запасом, чтобы не вытеснять на каждой записи
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
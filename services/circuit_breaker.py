@@ -0,0 +1,143 @@
+import collections
+import threading
+import time
+
+from services import metrics
+
+# Состояния
+CLOSED = 'closed'  # вызовы проходят, исходы копятся в скользящем окне
+OPEN = 'open'  # вызовы сразу отклоняются (CircuitOpenError), сервис не нагружается
+HALF_OPEN = 'half_open'  # после open_seconds пропускается пробный вызов: успех закрывает, ошибка открывает снова
+
+
+class CircuitOpenError(ConnectionError):
+    """Вызов отклонён без обращения к сервису: circuit breaker открыт."""
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker для внешнего API, общий для всех потоков (и цикла событий) процесса.
+    Исходы вызовов за последние window секунд хранятся в окне; медленный вызов
+    (дольше slow_call_seconds) считается неудачным. Когда в окне не меньше min_calls
+    исходов и доля неудачных достигает failure_rate, breaker открывается: check()
+    бросает CircuitOpenError, пока не пройдёт open_seconds. Затем пропускается
+    half_open_calls пробных вызовов; если пробный вызов так и не сообщил исход,
+    через open_seconds пропускается следующий.
+
+    Клиент вызывает token = check() перед запросом, а затем record_success(token=token) или
+    record_failure(token). Вызовы, которые не проходят через check() (например, ожидание
+    уже запущенной генерации), берут метку token() при старте. Каждый переход состояния
+    начинает новую эпоху: исходы вызовов, начатых в прошлой эпохе, не учитываются,
+    а в half-open состояние меняют только исходы пробных вызовов.
+    """
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 5, window: float = 60.0,
+                 slow_call_seconds: float = 10.0, open_seconds: float = 30.0, half_open_calls: int = 1,
+                 enabled: bool = True):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = max(min_calls, 1)
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(half_open_calls, 1)
+        self.enabled = enabled
+        self._state = CLOSED
+        self._outcomes = collections.deque()  # (время, неудача)
+        self._failures = 0  # неудачных исходов в _outcomes
+        self._opened_at = 0.0
+        self._probes = 0  # пробных вызовов пропущено в текущем периоде half-open
+        self._probes_since = 0.0
+        self._epoch = 0  # номер периода между переходами состояния
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def token(self) -> tuple:
+        """Метка вызова, не прошедшего через check(): (эпоха, 0). В half-open его исход не учитывается."""
+        with self._lock:
+            return self._epoch, 0
+
+    def check(self) -> tuple | None:
+        """
+        Перед вызовом сервиса: бросает CircuitOpenError, если вызов сейчас пропускать нельзя.
+        Возвращает метку вызова для record_success()/record_failure(): (эпоха, номер пробы),
+        у обычного вызова номер пробы 0.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            if self._state == CLOSED:
+                return self._epoch, 0
+            now = time.monotonic()
+            if self._state == OPEN:
+                retry_after = self._opened_at + self.open_seconds - now
+                if retry_after > 0:
+                    raise CircuitOpenError(self.name, retry_after)
+                self._transition_locked(HALF_OPEN)
+            if self._probes >= self.half_open_calls:
+                retry_after = self._probes_since + self.open_seconds - now
+                if retry_after > 0:
+                    raise CircuitOpenError(self.name, retry_after)
+                self._probes = 0  # пробный вызов не вернулся — пропускаем следующий
+            if self._probes == 0:
+                self._probes_since = now
+            self._probes += 1
+            return self._epoch, self._probes
+
+    def record_success(self, duration: float | None = None, token: tuple | None = None):
+        """Успешный вызов; duration (s) дольше slow_call_seconds засчитывается как неудача."""
+        if duration is not None and self.slow_call_seconds and duration > self.slow_call_seconds:
+            print(f"{self.name}: slow call ({duration:.1f}s > {self.slow_call_seconds:g}s)")
+            self.record_failure(token)
+            return
+        self._record(False, token)
+
+    def record_failure(self, token: tuple | None = None):
+        self._record(True, token)
+
+    def _record(self, failed: bool, token: tuple | None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if token is None or token[0] != self._epoch or self._state == OPEN:
+                return  # вызов начат до последнего перехода (или без метки) — на состояние не влияет
+            if self._state == HALF_OPEN:
+                if token[1]:  # исход пробного вызова
+                    self._transition_locked(OPEN if failed else CLOSED)
+                return
+            now = time.monotonic()
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._failures -= self._outcomes.popleft()[1]
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+                print(f"{self.name}: {self._failures} of {calls} recent calls failed")
+                self._transition_locked(OPEN)
+
+    def _transition_locked(self, state: str):
+        self._state = state
+        self._epoch += 1
+        self._probes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != HALF_OPEN:
+            self._outcomes.clear()
+            self._failures = 0
+        print(f"Circuit breaker {self.name}: {state}")
+        metrics.record_circuit_state(self.name, state)
+
+    def stats(self) -> dict:
+        with self._lock:
+            data = {"state": self._state if self.enabled else 'disabled',
+                    "recent_calls": len(self._outcomes), "recent_failures": self._failures}
+            if self._state == OPEN:
+                data["retry_after"] = round(max(self._opened_at + self.open_seconds - time.monotonic(), 0), 1)
+            return data
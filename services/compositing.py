@@ -0,0 +1,241 @@
+import functools
+import os
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+# Функции композиции не зависят от Flask и глобального состояния приложения,
+# поэтому их можно вызывать как в потоках запросов, так и в процессах пула (services.cpu_pool).
+#
+# Наложение слоёв выполняется на numpy массиве RGB (холст H x W x 3, uint8): логотип смешивается
+# только в прямоугольнике своей непрозрачной области, шаблон карты — только в пикселях с ненулевой
+# альфой. Слои хранятся в premultiplied виде (rgb * alpha), поэтому на пиксель остаётся
+# dst * (255 - alpha) + premultiplied и деление на 255 сдвигами — всё в uint16.
+
+AUTOCONTRAST_CUTOFF = 0.5  # % пикселей, отрезаемых с каждого края гистограммы (как ImageOps.autocontrast)
+RESIZE_REDUCING_GAP = 3.0  # уменьшение больших фонов: сначала reduce() в целое число раз, затем LANCZOS
+
+
+class Layer(NamedTuple):
+    """
+    RGBA слой, подготовленный к наложению (make_layer). Хранит только пиксели с ненулевой альфой:
+    плотный слой — прямоугольник box (h x w x 3), разреженный — плоские массивы по каналам пикселей (n * 3).
+    """
+    size: tuple  # (width, height) исходного изображения
+    box: tuple  # (left, top, right, bottom) области с ненулевой альфой
+    premultiplied: np.ndarray  # uint16, rgb * alpha
+    inverse_alpha: np.ndarray  # uint16, 255 - alpha
+    pixels: np.ndarray | None = None  # разреженный слой: индексы байтов холста ((y * width + x) * 3 + канал)
+
+
+def make_layer(image: Image.Image, sparse: bool = False) -> Layer:
+    """
+    Переводит RGBA изображение в Layer. sparse=True — для слоёв во весь холст, где непрозрачная
+    часть мала (шаблон карты — рамка): смешиваются только пиксели с ненулевой альфой.
+    """
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    if sparse:
+        rgba = np.asarray(image).reshape(-1, 4)
+        visible = np.flatnonzero(rgba[:, 3])
+        rgba = rgba[visible]
+        # одномерные индексы байтов: take/присваивание по ним в разы быстрее выборки строк (n x 3)
+        pixels = (visible[:, None] * 3 + np.arange(3)).astype(np.int32).ravel()
+        alpha = np.repeat(rgba[:, 3].astype(np.uint16), 3)
+        return Layer(image.size, (0, 0) + image.size, rgba[:, :3].ravel() * alpha, 255 - alpha, pixels)
+
+    box = image.getchannel("A").getbbox() or (0, 0, 0, 0)
+    rgba = np.asarray(image.crop(box))
+    alpha = rgba[..., 3:].astype(np.uint16)
+    return Layer(image.size, box, rgba[..., :3] * alpha, 255 - alpha)
+
+
+def _blend(destination: np.ndarray, premultiplied: np.ndarray, inverse_alpha: np.ndarray) -> np.ndarray:
+    """round((rgb * a + dst * (255 - a)) / 255). Сумма не больше 255 * 255, поэтому хватает uint16."""
+    value = destination * inverse_alpha
+    value += premultiplied
+    value += 128
+    value += value >> 8
+    value >>= 8
+    return value
+
+
+def blend_layer(canvas: np.ndarray, layer: Layer, x: int = 0, y: int = 0) -> np.ndarray:
+    """Накладывает слой на холст (H x W x 3, uint8) на месте; (x, y) — левый верхний угол слоя."""
+    if layer.pixels is not None:
+        if (x, y) != (0, 0) or layer.size != (canvas.shape[1], canvas.shape[0]):
+            raise ValueError("Sparse layer must cover the whole canvas.")
+        flat = canvas.reshape(-1)
+        flat[layer.pixels] = _blend(flat[layer.pixels], layer.premultiplied, layer.inverse_alpha)
+        return canvas
+
+    left, top, right, bottom = layer.box
+    # видимая часть слоя в координатах холста
+    x0, y0 = max(x + left, 0), max(y + top, 0)
+    x1, y1 = min(x + right, canvas.shape[1]), min(y + bottom, canvas.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return canvas
+    crop = (slice(y0 - y - top, y1 - y - top), slice(x0 - x - left, x1 - x - left))
+    region = canvas[y0:y1, x0:x1]
+    region[...] = _blend(region, layer.premultiplied[crop], layer.inverse_alpha[crop])
+    return canvas
+
+
+def autocontrast_lut(histogram, cutoff: float = AUTOCONTRAST_CUTOFF) -> list[int]:
+    """
+    Таблица ImageOps.autocontrast(cutoff=...) для всех каналов сразу по готовой гистограмме
+    (256 значений на канал). Результат совпадает с Pillow, но без циклов Python по каналам.
+    """
+    histogram = np.asarray(histogram, dtype=np.int64).reshape(-1, 256)
+    cut = (histogram.sum(axis=1) * cutoff // 100).astype(np.int64)[:, None]
+    # lo/hi — первое и последнее значение, после которых отрезано больше cut пикселей
+    above_low = np.cumsum(histogram, axis=1) > cut
+    above_high = np.cumsum(histogram[:, ::-1], axis=1) > cut
+    lo = above_low.argmax(axis=1)
+    hi = 255 - above_high.argmax(axis=1)
+    stretch = above_low.any(axis=1) & (hi > lo)
+    scale = 255.0 / np.where(stretch, hi - lo, 1)
+    offset = -lo * scale
+    lut = np.clip(np.trunc(np.arange(256) * scale[:, None] + offset[:, None]), 0, 255).astype(np.uint8)
+    lut[~stretch] = np.arange(256, dtype=np.uint8)
+    return lut.ravel().tolist()
+
+
+def prepare_background(background: Image.Image, card_width, card_height) -> Image.Image:
+    """
+    Автоконтраст и приведение фона к размеру карты, результат в RGB.
+    Гистограмма считается по исходному фону за один проход, а таблица применяется уже к
+    уменьшенному: работы меньше, а результат приближённый — из-за округления таблицы и
+    ресэмплинга (reducing_gap) отличается от автоконтраста после масштабирования на несколько
+    уровней (на тестовых фонах не больше 4/255).
+    Результат можно переиспользовать для разных логотипов.
+    """
+    if background.mode != "RGB":
+        background = background.convert("RGB")
+    lut = autocontrast_lut(background.histogram())
+    if background.size != (card_width, card_height):
+        print(
+            f"Warning: Background size {background.size} differs from target {card_width}x{card_height}. Resizing.")
+        background = background.resize((card_width, card_height), Image.Resampling.LANCZOS,
+                                       reducing_gap=RESIZE_REDUCING_GAP)
+    return background.point(lut)
+
+
+def resize_logo(logo: Image.Image, logo_scale, card_width) -> Image.Image:
+    """Масштабирует логотип: при scale=1.0 ширина логотипа — четверть ширины карты."""
+    if logo.mode != "RGBA":
+        logo = logo.convert("RGBA")
+    base_max_logo_w = card_width * 0.25
+    aspect_ratio = logo.height / logo.width
+    target_logo_w = int(base_max_logo_w * logo_scale)
+    target_logo_h = int(target_logo_w * aspect_ratio)
+    target_logo_w = max(target_logo_w, 5)
+    target_logo_h = max(target_logo_h, 5)
+    return logo.resize((target_logo_w, target_logo_h), Image.Resampling.LANCZOS)
+
+
+def logo_position(card_size: tuple, logo_size: tuple, logo_x_rel, logo_y_rel) -> tuple[int, int]:
+    """Левый верхний угол логотипа: центр в (x_rel, y_rel) от размера карты, логотип не выходит за край."""
+    card_width, card_height = card_size
+    logo_w, logo_h = logo_size
+    center_x_px = logo_x_rel * card_width
+    center_y_px = logo_y_rel * card_height
+    paste_x = int(center_x_px - (logo_w / 2))
+    paste_y = int(center_y_px - (logo_h / 2))
+    paste_x = max(0, min(paste_x, card_width - logo_w))
+    paste_y = max(0, min(paste_y, card_height - logo_h))
+    return paste_x, paste_y
+
+
+def _canvas(image: Image.Image) -> np.ndarray:
+    """Изменяемая копия пикселей RGB для наложения слоёв."""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.array(image)
+
+
+def render_variants(background: Image.Image, logo: Image.Image | Layer, logo_x_rel, logo_y_rel,
+                    variants=("design",), template_path: str | None = None) -> dict[str, Image.Image]:
+    """
+    Дизайн (фон + лого) и/или карта (с шаблоном) из одного холста: после логотипа снимается
+    дизайн, затем на том же холсте накладывается шаблон. Фон (prepare_background) не изменяется,
+    logo — результат resize_logo или make_layer от него.
+    """
+    layer = logo if isinstance(logo, Layer) else make_layer(logo)
+    canvas = _canvas(background)
+    paste_position = logo_position(background.size, layer.size, logo_x_rel, logo_y_rel)
+    print(f"Calculated paste position (top-left): {paste_position}")
+    blend_layer(canvas, layer, *paste_position)
+    print("Логотип наложен на фон.")  # Убедимся, что логотип наложен
+
+    images = {}
+    if "design" in variants:
+        images["design"] = Image.fromarray(canvas)  # fromarray копирует пиксели, холст можно менять дальше
+    if "card" in variants:
+        template = get_card_template_layer(template_path, *background.size)
+        if template is None:
+            raise ValueError("Card template is not available.")
+        images["card"] = Image.fromarray(blend_layer(canvas, template))
+    return images
+
+
+def place_logo(background: Image.Image, logo: Image.Image | Layer, logo_x_rel, logo_y_rel) -> Image.Image:
+    """
+    Накладывает уже масштабированный логотип (resize_logo) на подготовленный фон
+    (prepare_background). Фон не изменяется — возвращается новое RGB изображение.
+    """
+    return render_variants(background, logo, logo_x_rel, logo_y_rel)["design"]
+
+
+def compose_design(background: Image.Image, logo: Image.Image, logo_x_rel, logo_y_rel, logo_scale,
+                   card_width, card_height) -> Image.Image:
+    """Overlays logo (already processed by rembg) onto background. Returns the RGB design (без шаблона карты)."""
+    return place_logo(prepare_background(background, card_width, card_height),
+                      resize_logo(logo, logo_scale, card_width), logo_x_rel, logo_y_rel)
+
+
+@functools.lru_cache(maxsize=4)
+def load_card_template(path: str) -> Image.Image | None:
+    """Исходный шаблон карты в RGBA (загружается один раз на процесс). None, если файла нет."""
+    try:
+        if not os.path.exists(path):
+            print(f"!!! ОШИБКА: Файл шаблона карты не найден по пути: {path}")
+            return None
+        print(f"Загрузка шаблона карты из: {path}")
+        with Image.open(path) as template:
+            return template.convert("RGBA")
+    except Exception as e:
+        print(f"!!! КРИТИЧЕСКАЯ ОШИБКА при загрузке/обработке шаблона карты: {e}")
+        return None
+
+
+@functools.lru_cache(maxsize=8)
+def get_card_template(path: str, width: int, height: int) -> Image.Image | None:
+    """
+    Шаблон карты, подготовленный для наложения один раз на каждый размер:
+    RGBA (альфа-канал готов для alpha_composite) и уже масштабированный.
+    Возвращаемое изображение общее для всех запросов и не должно изменяться.
+    """
+    source = load_card_template(path)
+    if source is None:
+        return None
+    if source.size == (width, height):
+        return source
+    print(f"Изменение размера шаблона карты с {source.size} до {width}x{height}")
+    return source.resize((width, height), Image.Resampling.LANCZOS)
+
+
+@functools.lru_cache(maxsize=8)
+def get_card_template_layer(path: str, width: int, height: int) -> Layer | None:
+    """Шаблон карты нужного размера в виде разреженного слоя (только пиксели с ненулевой альфой)."""
+    template = get_card_template(path, width, height)
+    return None if template is None else make_layer(template, sparse=True)
+
+
+def apply_card_template(design: Image.Image, template_path: str) -> Image.Image:
+    """Накладывает подготовленный шаблон карты поверх дизайна (фон + лого)."""
+    template = get_card_template_layer(template_path, design.width, design.height)
+    if template is None:
+        raise ValueError("Card template is not available.")
+    return Image.fromarray(blend_layer(_canvas(design), template))
@@ -0,0 +1,257 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple
+
+from PIL import Image
+
+from services import compositing, metrics
+from services.image_encoding import EncodedImage, ImageEncoder
+
+
+class CpuPoolBusyError(Exception):
+    """Очередь CPU задач заполнена — запрос нужно отклонить (503), а не ставить в бесконечное ожидание."""
+
+
+class RenderParams(NamedTuple):
+    logo_x_rel: float
+    logo_y_rel: float
+    logo_scale: float
+    width: int
+    height: int
+    variants: tuple  # ('design',), ('card',) или ('design', 'card')
+    output_format: str
+    quality: int | None = None
+    compress_level: int | None = None
+
+
+# --- Передача данных через разделяемую память ---
+# Пиксели и закодированные изображения не сериализуются pickle: в очередь пула уходит
+# только имя сегмента, размер и режим. Сегмент удаляет (unlink) принимающая сторона.
+class SharedImage(NamedTuple):
+    name: str
+    mode: str
+    size: tuple
+    nbytes: int
+
+
+class SharedBytes(NamedTuple):
+    name: str
+    nbytes: int
+
+
+def _put_bytes(data: bytes) -> SharedMemory:
+    shm = SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    return shm
+
+
+def _take_bytes(name: str, nbytes: int) -> bytes:
+    """Копирует данные из сегмента и удаляет его."""
+    shm = SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:nbytes])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def export_image(image: Image.Image) -> tuple[SharedImage, SharedMemory]:
+    """Кладёт пиксели изображения в новый сегмент. Вызывающий закрывает сегмент после передачи."""
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGBA')  # палитра и прочие режимы не переносятся одним tobytes()
+    data = image.tobytes()
+    shm = _put_bytes(data)
+    return SharedImage(shm.name, image.mode, image.size, len(data)), shm
+
+
+def import_image(ref: SharedImage) -> Image.Image:
+    return Image.frombytes(ref.mode, ref.size, _take_bytes(ref.name, ref.nbytes))
+
+
+def _release(shm: SharedMemory):
+    """Закрывает и удаляет сегмент, если получатель не успел (например, задача упала)."""
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass  # получатель уже забрал данные
+
+
+# --- Задачи (выполняются в процессе пула или, без пула, в потоке запроса) ---
+_worker_state = {}
+
+
+def _init_worker(config: dict):
+    _worker_state.clear()
+    _worker_state.update(config)
+    _worker_state['encoder'] = ImageEncoder(**config['encoder_settings'])
+
+
+def _get_remover():
+    remover = _worker_state.get('remover')
+    if remover is None:
+        from services.background_removal import BackgroundRemover
+        remover = BackgroundRemover(_worker_state['rembg_model'], pool_size=1,
+                                    max_side=_worker_state['rembg_max_side'])
+        _worker_state['remover'] = remover
+    return remover
+
+
+def render_card(background: Image.Image, logo: Image.Image, params: RenderParams, encoder: ImageEncoder,
+                template_path: str, timings: dict | None = None) -> dict[str, EncodedImage]:
+    """
+    Автоконтраст и масштабирование фона, наложение логотипа, шаблон карты и кодирование вариантов.
+    Длительности этапов autocontrast / composite / encode (в секундах) добавляются в timings.
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    prepared = compositing.prepare_background(background, params.width, params.height)
+    timings['autocontrast'] = timings.get('autocontrast', 0.0) + time.perf_counter() - start
+
+    start = time.perf_counter()
+    images = compositing.render_variants(prepared, compositing.resize_logo(logo, params.logo_scale, params.width),
+                                         params.logo_x_rel, params.logo_y_rel, params.variants, template_path)
+    timings['composite'] = timings.get('composite', 0.0) + time.perf_counter() - start
+
+    results = {}
+    for variant, image in images.items():
+        results[variant] = encoder.encode(image, params.output_format, quality=params.quality,
+                                          compress_level=params.compress_level)
+        timings['encode'] = timings.get('encode', 0.0) + results[variant].encode_ms / 1000
+    return results
+
+
+def _warm_up_task(load_rembg: bool) -> int:
+    if load_rembg:
+        _get_remover()
+    return os.getpid()
+
+
+def _remove_background_task(ref: SharedImage) -> SharedImage:
+    result = _get_remover().remove(import_image(ref))
+    result_ref, shm = export_image(result)
+    shm.close()  # сегмент удалит родительский процесс после чтения
+    return result_ref
+
+
+def _render_card_task(background_ref: SharedImage, logo_ref: SharedImage, params: RenderParams) -> tuple[dict, dict]:
+    timings = {}
+    results = render_card(import_image(background_ref), import_image(logo_ref), params,
+                          _worker_state['encoder'], _worker_state['template_path'], timings)
+    shared = {}
+    for variant, encoded in results.items():
+        shm = _put_bytes(encoded.data)
+        shm.close()
+        shared[variant] = encoded._replace(data=SharedBytes(shm.name, len(encoded.data)))
+    return shared, timings  # метрики пишет родительский процесс
+
+
+class CpuPool:
+    """
+    Пул процессов для CPU-тяжёлых этапов (rembg, автоконтраст, LANCZOS, наложение, кодирование),
+    чтобы они не конкурировали за GIL с потоками Flask. Изображения передаются через
+    multiprocessing.shared_memory. Число одновременно принятых задач ограничено max_pending:
+    если слот не освободился за queue_timeout секунд, бросается CpuPoolBusyError.
+
+    workers=0 — пул не создаётся, задачи выполняются в потоке запроса (ограничение
+    max_pending действует и здесь). Процессы создаются в start() через fork — вызывайте
+    его при старте приложения, до запуска фоновых потоков.
+    """
+    def __init__(self, workers: int = 0, max_pending: int | None = None, queue_timeout: float = 5.0,
+                 rembg_model: str = 'u2net', rembg_max_side: int = 1024, template_path: str | None = None,
+                 encoder_settings: dict | None = None):
+        self.workers = workers
+        self.max_pending = max_pending or max(workers, os.cpu_count() or 1) * 2
+        self.queue_timeout = queue_timeout
+        self._config = {
+            'rembg_model': rembg_model,
+            'rembg_max_side': rembg_max_side,
+            'template_path': template_path,
+            'encoder_settings': encoder_settings or {},
+        }
+        self._encoder = ImageEncoder(**self._config['encoder_settings'])
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        print(f"CpuPool инициализирован (workers={workers or 'inline'}, max_pending={self.max_pending})")
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def start(self):
+        """Запускает процессы пула (все сразу). Без пула ничего не делает."""
+        if self.enabled:
+            self._get_executor()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # новый процесс (например, gunicorn --preload) не может пользоваться пулом родителя
+                resource_tracker.ensure_running()  # общий трекер сегментов для родителя и процессов пула
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=context,
+                                                     initializer=_init_worker, initargs=(self._config,))
+                self._pid = os.getpid()
+                # c fork ProcessPoolExecutor создаёт все процессы при первой задаче
+                self._executor.submit(_warm_up_task, False).result()
+            return self._executor
+
+    def warm_up_rembg(self):
+        """Загружает модель rembg в процессах пула заранее (по задаче на процесс)."""
+        executor = self._get_executor()
+        pids = {future.result() for future in [executor.submit(_warm_up_task, True) for _ in range(self.workers)]}
+        print(f"rembg загружен в процессах пула: {sorted(pids)}")
+
+    def _acquire_slot(self):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise CpuPoolBusyError(f"CPU pool is busy ({self.max_pending} tasks pending)")
+
+    def _run(self, task, *args):
+        try:
+            return self._get_executor().submit(task, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                self._executor = None  # процесс пула упал — при следующей задаче создадим пул заново
+            raise
+
+    def remove(self, image: Image.Image) -> Image.Image:
+        """Удаление фона в процессе пула; интерфейс совпадает с BackgroundRemover.remove для PIL."""
+        self._acquire_slot()
+        ref, shm = export_image(image)
+        try:
+            return import_image(self._run(_remove_background_task, ref))
+        finally:
+            _release(shm)
+            self._slots.release()
+
+    def render_card(self, background: Image.Image, logo: Image.Image, params: RenderParams) -> dict[str, EncodedImage]:
+        """Рендер и кодирование вариантов карты; длительности этапов записываются в metrics."""
+        self._acquire_slot()
+        try:
+            timings = {}
+            if not self.enabled:
+                results = render_card(background, logo, params, self._encoder, self._config['template_path'], timings)
+            else:
+                background_ref, background_shm = export_image(background)
+                logo_ref, logo_shm = export_image(logo)
+                try:
+                    shared, timings = self._run(_render_card_task, background_ref, logo_ref, params)
+                finally:
+                    _release(background_shm)
+                    _release(logo_shm)
+                results = {variant: encoded._replace(data=_take_bytes(*encoded.data))
+                           for variant, encoded in shared.items()}
+        finally:
+            self._slots.release()
+        for stage, seconds in timings.items():
+            metrics.observe_stage(stage, seconds)
+        return results
@@ -1,6 +1,115 @@
-import requests
+import asyncio
+import heapq
+import itertools
 import json
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services import metrics
+from services.circuit_breaker import CircuitBreaker
+
+# Эндпоинты и разбор ответов общие для синхронного и асинхронного клиентов
+PIPELINES_ENDPOINT = 'key/api/v1/pipelines'
+RUN_ENDPOINT = 'key/api/v1/pipeline/run'
+STATUS_ENDPOINT = 'key/api/v1/pipeline/status/{}'
+
+
+def _record_response(response, *args, **kwargs):
+    """Хук requests/httpx: счётчик ответов FusionBrain по коду статуса."""
+    metrics.record_upstream('fusionbrain', response.status_code)
+
+
+async def _record_response_async(response):
+    _record_response(response)
+
+
+def _is_pipeline_error(message: str) -> bool:
+    return 'pipeline' in (message or '').lower()
+
+
+def _is_client_error(status_code: int | None) -> bool:
+    """4xx (кроме 429): API ответил, ошибка в запросе — для circuit breaker это не сбой сервиса."""
+    return status_code is not None and 400 <= status_code < 500 and status_code != 429
+
+
+def _record_generation(breaker: CircuitBreaker, generation, token: tuple):
+    """Исход генерации для circuit breaker: таймаут и FAIL — неудача, цензура и разбор ответа — нет."""
+    error = generation.exception()
+    if error is None or isinstance(error, (ValueError, KeyError)):
+        breaker.record_success(token=token)
+    else:
+        breaker.record_failure(token)
+
+
+def _generation_form(prompt: str, pipeline: str, width: int, height: int, style: str) -> dict:
+    """Поля multipart/form-data запроса генерации (JSON параметров передаётся частью формы, как требует API)."""
+    params = {
+        "type": "GENERATE",
+        "numImages": 1,
+        "width": width,
+        "height": height,
+        "generateParams": {
+            "query": f'{prompt}'
+        }
+    }
+    if style and style.upper() != "DEFAULT":
+        params["style"] = style.upper()
+    return {
+        'pipeline_id': (None, pipeline),
+        'params': (None, json.dumps(params), 'application/json')
+    }
+
+
+def _parse_pipeline_id(data) -> str:
+    if not data or not isinstance(data, list) or 'id' not in data[0]:
+        raise ValueError("API did not return a valid pipeline list.")
+    return data[0]['id']
+
+
+def _parse_generation_uuid(data: dict, invalidate_pipeline) -> str:
+    if 'uuid' in data:
+        return data['uuid']
+    error_msg = data.get('errorDescription', data.get('message', str(data)))
+    if _is_pipeline_error(error_msg):
+        invalidate_pipeline()
+    raise ValueError(f"API error starting generation: {error_msg}")
+
+
+def _parse_status(request_id: str, data: dict, invalidate_pipeline) -> str | None:
+    """
+    Разбирает ответ статуса генерации: base64 изображения, если готово, None если ещё идёт.
+    Бросает ValueError/RuntimeError при цензуре, ошибке генерации или некорректном ответе.
+    """
+    status = data.get('status', 'UNKNOWN')
+    print(f"UUID {request_id}: Status = {status}")
+
+    if status == 'DONE':
+        if data.get('censored', False):
+            print("Warning: Generation result is censored.")
+            raise ValueError("Generated image was censored by the API.")
+
+        if data.get('result') and isinstance(data['result'].get('files'), list) and data['result']['files']:
+            print("Generation DONE. Image received.")
+            return data['result']['files'][0] # Возвращаем base64 первого изображения
+        else:
+            print(f"Status 'DONE' but no image data found. Response: {data}")
+            raise ValueError("Generation status is DONE, but no image data was returned.")
+
+    elif status == 'FAIL':
+        error_desc = data.get('errorDescription', 'Unknown generation error')
+        print(f"Generation failed: {error_desc}")
+        if _is_pipeline_error(error_desc):
+            invalidate_pipeline()
+        raise RuntimeError(f"FusionBrain generation failed: {error_desc}")
+
+    elif status not in ['PROCESSING', 'INITIAL']:
+        print(f"Unknown status received: {status}. Response: {data}")
+    return None
+
 
 class FusionBrainAPI:
     """
@@ -8,136 +117,504 @@ class FusionBrainAPI:
     Отвечает за получение pipeline, запуск генерации изображений
     и проверку статуса генерации.
     """
-    def __init__(self, url, api_key, secret_key):
+    def __init__(self, url, api_key, secret_key, poll_min_delay: float = 1.0, poll_max_delay: float = 10.0,
+                 poll_timeout: float = 100.0, poll_workers: int = 4, pool_size: int = 20,
+                 pipeline_ttl: float = 3600.0, breaker: CircuitBreaker | None = None):
         if not all([url, api_key, secret_key]):
             raise ValueError("URL, API Key, and Secret Key cannot be empty for FusionBrainAPI.")
+        # Пока FusionBrain недоступен, запросы pipeline и генерации отклоняются сразу (CircuitOpenError)
+        self.breaker = breaker or CircuitBreaker('fusionbrain')
         self.URL = url.rstrip('/') + '/' # Ensure trailing slash for consistency
         self.AUTH_HEADERS = {
             'X-Key': f'Key {api_key}',
             'X-Secret': f'Secret {secret_key}',
         }
+        # Keep-alive сессия с пулом соединений: без нового TLS рукопожатия на каждый запрос
+        self._session = requests.Session()
+        self._session.headers.update(self.AUTH_HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.hooks['response'].append(_record_response)
+
+        # Кэш ID pipeline: значение почти не меняется, незачем запрашивать его на каждую карту
+        self.pipeline_ttl = pipeline_ttl
+        self._pipeline_id = None
+        self._pipeline_fetched_at = 0
+        self._pipeline_refreshing = False
+        self._pipeline_lock = threading.Lock()
+        self._pipeline_fetch_lock = threading.Lock()
+        # Один общий планировщик опроса на все генерации этого клиента
+        self.poller = GenerationPoller(self.fetch_status, min_delay=poll_min_delay, max_delay=poll_max_delay,
+                                       timeout=poll_timeout, workers=poll_workers)
         print(f"FusionBrainAPI инициализирован")
         # print(f"FusionBrainAPI initialized for URL: {self.URL}")
 
-    def get_pipeline(self):
-        """Получает ID первого доступного pipeline."""
+    def get_pipeline(self, force_refresh: bool = False):
+        """
+        Возвращает ID pipeline из кэша.
+        Свежее значение (моложе pipeline_ttl) отдаётся без запроса к API; устаревшее
+        отдаётся сразу, а обновление запускается в фоне. Запрос в пути обработки
+        выполняется только когда кэш пуст (первый вызов или после invalidate_pipeline()).
+        """
+        with self._pipeline_lock:
+            pipeline_id = self._pipeline_id
+            age = time.time() - self._pipeline_fetched_at
+        if pipeline_id and not force_refresh:
+            if age >= self.pipeline_ttl:
+                self._refresh_pipeline_in_background()
+            return pipeline_id
+
+        # Один запрос на всех: остальные потоки ждут его результат
+        with self._pipeline_fetch_lock:
+            with self._pipeline_lock:
+                if self._pipeline_id and not force_refresh:
+                    return self._pipeline_id
+            return self._fetch_pipeline()
+
+    def invalidate_pipeline(self):
+        """Сбрасывает кэшированный ID pipeline; следующий get_pipeline() запросит его заново."""
+        with self._pipeline_lock:
+            if self._pipeline_id:
+                print(f"Pipeline ID {self._pipeline_id} invalidated.")
+            self._pipeline_id = None
+            self._pipeline_fetched_at = 0
+
+    def _refresh_pipeline_in_background(self):
+        with self._pipeline_lock:
+            if self._pipeline_refreshing:
+                return
+            self._pipeline_refreshing = True
+
+        def refresh():
+            try:
+                with self._pipeline_fetch_lock:
+                    self._fetch_pipeline()
+            except Exception as e:
+                print(f"Background pipeline refresh failed, keeping cached ID: {e}")
+            finally:
+                with self._pipeline_lock:
+                    self._pipeline_refreshing = False
+
+        threading.Thread(target=refresh, name='fusion-pipeline-refresh', daemon=True).start()
+
+    def _fetch_pipeline(self):
+        """Получает ID первого доступного pipeline и сохраняет его в кэш."""
+        token = self.breaker.check()
         print("Getting FusionBrain pipeline ID...")
-        endpoint = 'key/api/v1/pipelines'
+        endpoint = PIPELINES_ENDPOINT
+        started = time.monotonic()
         try:
-            response = requests.get(self.URL + endpoint, headers=self.AUTH_HEADERS, timeout=30)
+            response = self._session.get(self.URL + endpoint, timeout=30)
             response.raise_for_status() # Проверяет HTTP ошибки (4xx, 5xx)
-            data = response.json()
-            if not data or not isinstance(data, list) or 'id' not in data[0]:
-                raise ValueError("API did not return a valid pipeline list.")
-            pipeline_id = data[0]['id']
+            pipeline_id = _parse_pipeline_id(response.json())
+            self.breaker.record_success(time.monotonic() - started, token)
             print(f"Pipeline ID received: {pipeline_id}")
+            with self._pipeline_lock:
+                self._pipeline_id = pipeline_id
+                self._pipeline_fetched_at = time.time()
             return pipeline_id
         except requests.exceptions.RequestException as e:
             print(f"Network error getting pipeline: {e}")
+            self.breaker.record_failure(token)
             raise ConnectionError(f"Failed to connect to FusionBrain API at {self.URL + endpoint}: {e}") from e
         except (ValueError, KeyError, IndexError) as e:
             print(f"Error parsing pipeline response: {e}")
+            self.breaker.record_failure(token)
             raise ValueError(f"Invalid response format from FusionBrain API when getting pipeline: {e}") from e
         except Exception as e:
             print(f"Unexpected error getting pipeline: {e}")
+            self.breaker.record_failure(token)
             raise
 
     def generate(self, prompt: str, pipeline: str, width: int, height: int, style: str):
         """Запускает генерацию изображения."""
         print(f"Starting generation: P='{prompt[:50]}...', S='{style}', W={width}, H={height}, Pipeline='{pipeline}'")
-        endpoint = 'key/api/v1/pipeline/run'
-        params = {
-            "type": "GENERATE",
-            "numImages": 1,
-            "width": width,
-            "height": height,
-            "generateParams": {
-                "query": f'{prompt}'
-            }
-        }
-        if style and style.upper() != "DEFAULT":
-            params["style"] = style.upper()
-
+        endpoint = RUN_ENDPOINT
         # Используем files для отправки JSON как multipart/form-data, как требует API
-        data_payload = {
-            'pipeline_id': (None, pipeline),
-            'params': (None, json.dumps(params), 'application/json')
-        }
+        data_payload = _generation_form(prompt, pipeline, width, height, style)
 
+        token = self.breaker.check()
+        started = time.monotonic()
         try:
-            response = requests.post(self.URL + endpoint, headers=self.AUTH_HEADERS, files=data_payload, timeout=60)
+            response = self._session.post(self.URL + endpoint, files=data_payload, timeout=60)
             response.raise_for_status()
             data = response.json()
             print(f"Generation request response: {data}")
-            if 'uuid' in data:
-                return data['uuid']
-            else:
-                error_msg = data.get('errorDescription', data.get('message', str(data)))
-                raise ValueError(f"API error starting generation: {error_msg}")
+            request_id = _parse_generation_uuid(data, self.invalidate_pipeline)
+            self.breaker.record_success(time.monotonic() - started, token)
+            return request_id
         except requests.exceptions.RequestException as e:
             print(f"Network error starting generation: {e}")
+            status_code = e.response.status_code if e.response is not None else None
+            if status_code in (400, 404, 422):
+                # Скорее всего, pipeline больше не существует или недоступен
+                self.invalidate_pipeline()
+            if _is_client_error(status_code):
+                self.breaker.record_success(token=token)
+            else:
+                self.breaker.record_failure(token)
             raise ConnectionError(f"Failed to connect to FusionBrain API at {self.URL + endpoint}: {e}") from e
         except (ValueError, KeyError) as e:
              print(f"Error parsing generation start response: {e}")
+             self.breaker.record_failure(token)
              raise ValueError(f"Invalid response format from FusionBrain API when starting generation: {e}") from e
         except Exception as e:
             print(f"Unexpected error starting generation: {e}")
+            self.breaker.record_failure(token)
             raise
 
+    def poll_generation(self, request_id: str, timeout: float | None = None) -> Future:
+        """
+        Регистрирует UUID в общем планировщике опроса и сразу возвращает Future.
+        Future завершается base64 строкой изображения или исключением
+        (RuntimeError/ValueError при ошибке генерации, TimeoutError по таймауту).
+        Исход генерации учитывается в circuit breaker.
+        """
+        token = self.breaker.token()  # генерации, начатые до перехода breaker, на новое состояние не влияют
+        generation = self.poller.track(request_id, timeout=timeout)
+        generation.add_done_callback(lambda done: _record_generation(self.breaker, done, token))
+        return generation
+
+    def fetch_status(self, request_id: str) -> str | None:
+        """
+        Делает один запрос статуса генерации.
+        Возвращает base64 изображения, если генерация готова, None если ещё идёт.
+        Бросает ValueError/RuntimeError при цензуре, ошибке генерации или некорректном ответе,
+        requests.exceptions.RequestException при сетевой ошибке.
+        """
+        endpoint = STATUS_ENDPOINT.format(request_id)
+        response = self._session.get(self.URL + endpoint, timeout=30)
+        response.raise_for_status()
+        return _parse_status(request_id, response.json(), self.invalidate_pipeline)
+
     def check_generation(self, request_id: str, attempts: int = 20, delay: int = 5) -> str | None:
         """
-        Проверяет статус генерации по UUID.
+        Проверяет статус генерации по UUID, блокируя вызывающий поток до результата.
+        Опрос выполняет общий планировщик; attempts * delay задаёт общий таймаут ожидания.
         Возвращает base64 строку изображения при успехе, None при ошибке или таймауте.
         """
-        print(f"Checking status for UUID: {request_id} (attempts={attempts}, delay={delay}s)")
-        endpoint = f'key/api/v1/pipeline/status/{request_id}'
-        for attempt in range(attempts):
-            try:
-                response = requests.get(self.URL + endpoint, headers=self.AUTH_HEADERS, timeout=30)
-                response.raise_for_status()
-                data = response.json()
-                status = data.get('status', 'UNKNOWN')
-                print(f"Attempt {attempt + 1}/{attempts}: Status = {status}")
-
-                if status == 'DONE':
-                    if data.get('censored', False):
-                        print("Warning: Generation result is censored.")
-                        # Можно либо вернуть None, либо специальное значение, либо кинуть исключение
-                        # return None
-                        raise ValueError("Generated image was censored by the API.")
-
-                    if data.get('result') and isinstance(data['result'].get('files'), list) and data['result']['files']:
-                        print("Generation DONE. Image received.")
-                        return data['result']['files'][0] # Возвращаем base64 первого изображения
-                    else:
-                        print(f"Status 'DONE' but no image data found. Response: {data}")
-                        raise ValueError("Generation status is DONE, but no image data was returned.")
-
-                elif status == 'FAIL':
-                    error_desc = data.get('errorDescription', 'Unknown generation error')
-                    print(f"Generation failed: {error_desc}")
-                    raise RuntimeError(f"FusionBrain generation failed: {error_desc}")
-
-                elif status in ['PROCESSING', 'INITIAL']:
-                     print("Generation still processing...") # Просто ждем следующей попытки
-                     pass
+        print(f"Waiting for UUID: {request_id} (timeout={attempts * delay}s)")
+        try:
+            return self.poll_generation(request_id, timeout=attempts * delay).result()
+        except TimeoutError:
+            print(f"Generation timed out for UUID: {request_id}")
+            return None
+        except (ValueError, KeyError, RuntimeError) as e:
+            print(f"Error checking status for UUID {request_id}: {e}")
+            return None
+        except Exception as e:
+            print(f"Unexpected error checking status for UUID {request_id}: {e}")
+            return None
+
+
+class _PendingGeneration:
+    """Состояние одной ожидаемой генерации в GenerationPoller."""
+    def __init__(self, request_id: str, timeout: float, delay: float):
+        self.request_id = request_id
+        self.future = Future()
+        self.submitted_at = time.time()
+        self.deadline = self.submitted_at + timeout
+        self.delay = delay  # текущий интервал между опросами
+        self.polls = 0
+
+
+class GenerationPoller:
+    """
+    Общий планировщик опроса статусов FusionBrain.
+    Вместо отдельного цикла со sleep на каждый запрос один фоновый поток держит
+    очередь всех ожидающих UUID и отправляет запросы статуса, когда подходит их время.
+
+    Интервалы адаптивные: первый опрос назначается чуть раньше типичного времени
+    генерации (по скользящему среднему наблюдаемых длительностей), после этого
+    интервал растёт от min_delay до max_delay с множителем backoff.
+    """
+    def __init__(self, fetch_status, min_delay: float = 1.0, max_delay: float = 10.0,
+                 backoff: float = 1.5, timeout: float = 100.0, workers: int = 4):
+        self._fetch_status = fetch_status
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fusion-poll')
+        self._queue = []  # heap of (due_time, seq, request_id)
+        self._pending = {}
+        self._seq = itertools.count()
+        self._expected_duration = None  # EMA времени до готовности, сек
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def track(self, request_id: str, timeout: float | None = None) -> Future:
+        """Добавляет UUID в опрос и возвращает Future с base64 изображения."""
+        with self._cond:
+            pending = self._pending.get(request_id)
+            if pending:
+                return pending.future
+            pending = _PendingGeneration(request_id, timeout or self.timeout, self.min_delay)
+            self._pending[request_id] = pending
+            self._schedule_locked(pending, self._first_delay_locked())
+            self._ensure_thread_locked()
+            self._cond.notify()
+        return pending.future
+
+    @property
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _first_delay_locked(self) -> float:
+        if self._expected_duration is None:
+            return self.min_delay
+        # Опрашиваем немного раньше ожидаемого завершения, чтобы не пропустить быстрые генерации
+        return min(max(self._expected_duration * 0.8, self.min_delay), self.timeout)
+
+    def _schedule_locked(self, pending: _PendingGeneration, delay: float):
+        heapq.heappush(self._queue, (time.time() + delay, next(self._seq), pending.request_id))
+
+    def _ensure_thread_locked(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name='fusion-poller', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                due_time, _, request_id = self._queue[0]
+                wait = due_time - time.time()
+                if wait > 0:
+                    self._cond.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._queue)
+                pending = self._pending.get(request_id)
+            if pending:
+                self._executor.submit(self._poll, pending)
+
+    def _poll(self, pending: _PendingGeneration):
+        pending.polls += 1
+        try:
+            result = self._fetch_status(pending.request_id)
+        except requests.exceptions.RequestException as e:
+            print(f"Network error checking status for {pending.request_id} (poll {pending.polls}): {e}. Retrying...")
+            metrics.record_retry('fusionbrain', 'status_poll')
+            result = None
+        except Exception as e:
+            self._finish(pending, error=e)
+            return
+
+        if result is not None:
+            self._finish(pending, result=result)
+            return
+
+        with self._cond:
+            if time.time() >= pending.deadline:
+                self._pending.pop(pending.request_id, None)
+                timed_out = True
+            else:
+                timed_out = False
+                delay = min(pending.delay, pending.deadline - time.time())
+                pending.delay = min(pending.delay * self.backoff, self.max_delay)
+                self._schedule_locked(pending, max(delay, 0))
+                self._cond.notify()
+        if timed_out:
+            print(f"Generation timed out after {pending.polls} polls for UUID: {pending.request_id}")
+            pending.future.set_exception(TimeoutError(f"Generation {pending.request_id} timed out"))
+
+    def _finish(self, pending: _PendingGeneration, result=None, error=None):
+        with self._cond:
+            self._pending.pop(pending.request_id, None)
+            if error is None:
+                duration = time.time() - pending.submitted_at
+                if self._expected_duration is None:
+                    self._expected_duration = duration
                 else:
-                    print(f"Unknown status received: {status}. Response: {data}")
-                    # Можно подождать или считать ошибкой
-                    # raise ValueError(f"Unknown generation status received: {status}")
+                    self._expected_duration = 0.8 * self._expected_duration + 0.2 * duration
+        if error is None:
+            print(f"UUID {pending.request_id} done after {pending.polls} polls")
+            pending.future.set_result(result)
+        else:
+            pending.future.set_exception(error)
+
+
+class AsyncFusionBrainAPI:
+    """
+    Асинхронный клиент FusionBrain на httpx.AsyncClient с общим пулом соединений.
+    Ожидание генерации — корутина со sleep между опросами, а не поток, поэтому
+    процесс может держать тысячи открытых генераций. Интервалы опроса те же, что
+    у GenerationPoller: первый опрос чуть раньше типичного времени генерации,
+    дальше рост от min_delay до max_delay. Circuit breaker можно разделить
+    с синхронным клиентом того же процесса.
+    """
+    def __init__(self, url, api_key, secret_key, poll_min_delay: float = 1.0, poll_max_delay: float = 10.0,
+                 poll_backoff: float = 1.5, poll_timeout: float = 100.0, pool_size: int = 100,
+                 pipeline_ttl: float = 3600.0, breaker: CircuitBreaker | None = None):
+        if not all([url, api_key, secret_key]):
+            raise ValueError("URL, API Key, and Secret Key cannot be empty for AsyncFusionBrainAPI.")
+        self.breaker = breaker or CircuitBreaker('fusionbrain')
+        import httpx  # нужен только для ASGI сервера
+        self._httpx = httpx
+        self.URL = url.rstrip('/') + '/'
+        self._client = httpx.AsyncClient(
+            base_url=self.URL,
+            headers={'X-Key': f'Key {api_key}', 'X-Secret': f'Secret {secret_key}'},
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            event_hooks={'response': [_record_response_async]},
+        )
+        self.poll_min_delay = poll_min_delay
+        self.poll_max_delay = poll_max_delay
+        self.poll_backoff = poll_backoff
+        self.poll_timeout = poll_timeout
+        self._expected_duration = None  # EMA времени до готовности, сек
+
+        self.pipeline_ttl = pipeline_ttl
+        self._pipeline_id = None
+        self._pipeline_fetched_at = 0
+        self._pipeline_lock = asyncio.Lock()
+        self._pipeline_refresh_task = None
+        print(f"AsyncFusionBrainAPI инициализирован")
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def get_pipeline(self, force_refresh: bool = False) -> str:
+        """Как FusionBrainAPI.get_pipeline: кэш с TTL, устаревшее значение обновляется в фоне."""
+        if self._pipeline_id and not force_refresh:
+            if time.time() - self._pipeline_fetched_at >= self.pipeline_ttl:
+                self._refresh_pipeline_in_background()
+            return self._pipeline_id
+        async with self._pipeline_lock:  # один запрос на всех ожидающих
+            if self._pipeline_id and not force_refresh:
+                return self._pipeline_id
+            return await self._fetch_pipeline()
 
+    def invalidate_pipeline(self):
+        if self._pipeline_id:
+            print(f"Pipeline ID {self._pipeline_id} invalidated.")
+        self._pipeline_id = None
+        self._pipeline_fetched_at = 0
 
-            except requests.exceptions.RequestException as e:
-                print(f"Network error checking status (Attempt {attempt + 1}): {e}. Retrying...")
-                # Не прерываем цикл при временных сетевых ошибках
-            except (ValueError, KeyError, RuntimeError) as e:
-                 print(f"Error checking status (Attempt {attempt + 1}): {e}")
-                 return None # Прерываем цикл при ошибках парсинга, цензуре или статусе FAIL
+    def _refresh_pipeline_in_background(self):
+        if self._pipeline_refresh_task and not self._pipeline_refresh_task.done():
+            return
+
+        async def refresh():
+            try:
+                async with self._pipeline_lock:
+                    await self._fetch_pipeline()
             except Exception as e:
-                print(f"Unexpected error checking status (Attempt {attempt + 1}): {e}. Response: {response.text if 'response' in locals() else 'N/A'}")
-                return None # Прерываем при других неожиданных ошибках
+                print(f"Background pipeline refresh failed, keeping cached ID: {e}")
+
+        self._pipeline_refresh_task = asyncio.get_running_loop().create_task(refresh())
+
+    async def _fetch_pipeline(self) -> str:
+        token = self.breaker.check()
+        print("Getting FusionBrain pipeline ID...")
+        started = time.monotonic()
+        try:
+            response = await self._client.get(PIPELINES_ENDPOINT)
+            response.raise_for_status()
+            pipeline_id = _parse_pipeline_id(response.json())
+        except self._httpx.HTTPError as e:
+            print(f"Network error getting pipeline: {e}")
+            self.breaker.record_failure(token)
+            raise ConnectionError(f"Failed to connect to FusionBrain API at {self.URL + PIPELINES_ENDPOINT}: {e}") from e
+        except (ValueError, KeyError, IndexError) as e:
+            print(f"Error parsing pipeline response: {e}")
+            self.breaker.record_failure(token)
+            raise ValueError(f"Invalid response format from FusionBrain API when getting pipeline: {e}") from e
+        self.breaker.record_success(time.monotonic() - started, token)
+        print(f"Pipeline ID received: {pipeline_id}")
+        self._pipeline_id = pipeline_id
+        self._pipeline_fetched_at = time.time()
+        return pipeline_id
+
+    async def generate(self, prompt: str, pipeline: str, width: int, height: int, style: str) -> str:
+        """Запускает генерацию изображения, возвращает UUID."""
+        print(f"Starting generation: P='{prompt[:50]}...', S='{style}', W={width}, H={height}, Pipeline='{pipeline}'")
+        token = self.breaker.check()
+        started = time.monotonic()
+        try:
+            response = await self._client.post(RUN_ENDPOINT, files=_generation_form(prompt, pipeline, width, height, style),
+                                               timeout=60)
+            response.raise_for_status()
+            data = response.json()
+        except self._httpx.HTTPStatusError as e:
+            print(f"Network error starting generation: {e}")
+            if e.response.status_code in (400, 404, 422):
+                # Скорее всего, pipeline больше не существует или недоступен
+                self.invalidate_pipeline()
+            if _is_client_error(e.response.status_code):
+                self.breaker.record_success(token=token)
+            else:
+                self.breaker.record_failure(token)
+            raise ConnectionError(f"Failed to connect to FusionBrain API at {self.URL + RUN_ENDPOINT}: {e}") from e
+        except self._httpx.HTTPError as e:
+            print(f"Network error starting generation: {e}")
+            self.breaker.record_failure(token)
+            raise ConnectionError(f"Failed to connect to FusionBrain API at {self.URL + RUN_ENDPOINT}: {e}") from e
+        except ValueError as e:  # тело ответа не JSON
+            print(f"Error parsing generation start response: {e}")
+            self.breaker.record_failure(token)
+            raise ValueError(f"Invalid response format from FusionBrain API when starting generation: {e}") from e
+        print(f"Generation request response: {data}")
+        try:
+            request_id = _parse_generation_uuid(data, self.invalidate_pipeline)
+        except ValueError:
+            self.breaker.record_failure(token)
+            raise
+        self.breaker.record_success(time.monotonic() - started, token)
+        return request_id
 
-            time.sleep(delay)
+    async def fetch_status(self, request_id: str) -> str | None:
+        """Один запрос статуса. base64 изображения, None если ещё идёт; ошибки — как у FusionBrainAPI."""
+        response = await self._client.get(STATUS_ENDPOINT.format(request_id))
+        response.raise_for_status()
+        return _parse_status(request_id, response.json(), self.invalidate_pipeline)
+
+    async def wait_for_generation(self, request_id: str, timeout: float | None = None) -> str:
+        """Дожидается генерации и возвращает base64 изображения. TimeoutError по таймауту."""
+        token = self.breaker.token()
+        try:
+            result = await self._wait_for_generation(request_id, timeout)
+        except (ValueError, KeyError):  # цензура или некорректный ответ: сервис отвечает
+            self.breaker.record_success(token=token)
+            raise
+        except Exception:
+            self.breaker.record_failure(token)
+            raise
+        self.breaker.record_success(token=token)
+        return result
+
+    async def _wait_for_generation(self, request_id: str, timeout: float | None) -> str:
+        started_at = time.time()
+        deadline = started_at + (timeout or self.poll_timeout)
+        delay = self.poll_min_delay
+        first_delay = self.poll_min_delay
+        if self._expected_duration is not None:
+            first_delay = max(self._expected_duration * 0.8, self.poll_min_delay)
+        await asyncio.sleep(min(first_delay, max(deadline - time.time(), 0)))
+
+        polls = 0
+        while True:
+            polls += 1
+            try:
+                result = await self.fetch_status(request_id)
+            except self._httpx.HTTPError as e:
+                print(f"Network error checking status for {request_id} (poll {polls}): {e}. Retrying...")
+                metrics.record_retry('fusionbrain', 'status_poll')
+                result = None
+            if result is not None:
+                duration = time.time() - started_at
+                self._expected_duration = duration if self._expected_duration is None \
+                    else 0.8 * self._expected_duration + 0.2 * duration
+                print(f"UUID {request_id} done after {polls} polls")
+                return result
 
-        print(f"Generation timed out after {attempts} attempts for UUID: {request_id}")
-        return None
\ No newline at end of file
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print(f"Generation timed out after {polls} polls for UUID: {request_id}")
+                raise TimeoutError(f"Generation {request_id} timed out")
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * self.poll_backoff, self.poll_max_delay)
@@ -1,17 +1,42 @@
+import asyncio
 import base64
+import hashlib
+import json
+import logging
 import os
+import threading
 import time
 import uuid
 
 import requests
 from dotenv import load_dotenv
 
+from services import metrics
+
+try:
+    from filelock import FileLock, Timeout as FileLockTimeout
+except ImportError:  # без filelock токен не разделяется между воркерами
+    FileLock = None
+    FileLockTimeout = TimeoutError
+
 # Load environment variables
 load_dotenv()
 
 AUTH_URL = os.environ.get('GIGA_AUTH_URL')
 API_BASE_URL = os.environ.get('GIGA_API_BASE_URL')
 
+logger = logging.getLogger(__name__)
+
+def _record_response(response, *args, **kwargs):
+    """Хук requests/httpx: счётчик ответов GigaChat (OAuth отдельно) по коду статуса."""
+    service = 'gigachat_oauth' if AUTH_URL and str(response.url).startswith(AUTH_URL) else 'gigachat'
+    metrics.record_upstream(service, response.status_code)
+
+
+async def _record_response_async(response):
+    _record_response(response)
+
+
 # --- Custom Exception ---
 class GigaChatAPIError(Exception):
     """Custom exception for GigaChat API errors."""
@@ -20,6 +45,152 @@ class GigaChatAPIError(Exception):
         self.message = message
         super().__init__(f"GigaChat API Error {status_code}: {message}")
 
+# --- Token Manager ---
+MAX_REFRESH_DELAY = 24 * 3600  # s; таймер дольше не нужен и не должен переполнять time_t
+REFRESH_RETRY_SECONDS = 5  # s до повтора неудачного фонового обновления, удваивается
+MAX_REFRESH_RETRY_SECONDS = 300
+class TokenManager:
+    """
+    Потокобезопасное хранение OAuth токена с обновлением заранее, до истечения срока.
+    В процессе обновление выполняется одним потоком (single-flight), остальные ждут его.
+    Фоновый таймер обновляет токен за refresh_margin секунд до истечения, поэтому
+    запросы к API не ждут аутентификацию (refresh_margin не больше половины срока жизни токена;
+    после неудачи обновление повторяется с растущей паузой). Если задан cache_path, токен разделяется
+    между воркерами (gunicorn) через файл под файловой блокировкой: запрос к OAuth
+    делает один воркер, остальные читают токен из файла.
+    """
+    def __init__(self, fetch_token, cache_path: str | None = None, owner: str = '',
+                 refresh_margin: float = 300, min_valid: float = 60):
+        self._fetch_token = fetch_token  # () -> (access_token, expires_at в секундах)
+        self.cache_path = cache_path if cache_path and FileLock else None
+        if cache_path and not FileLock:
+            print("filelock не установлен: токен GigaChat не будет разделяться между воркерами")
+        if self.cache_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        self._file_lock = FileLock(self.cache_path + '.lock') if self.cache_path else None
+        self._owner = hashlib.sha256(owner.encode()).hexdigest()  # не путаем токены разных ключей/scope
+        self.refresh_margin = refresh_margin
+        self.min_valid = min_valid
+
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._refresh_failures = 0
+        self._margin_warned = False
+
+    def get_token(self) -> str:
+        """Возвращает действующий токен; аутентифицируется только если его нет или он почти истёк."""
+        token, expires_at = self._token, self._expires_at
+        if token and time.time() < expires_at - self.min_valid:
+            return token
+        return self._refresh(self.min_valid)
+
+    def peek(self) -> str | None:
+        """Действующий токен без ожидания блокировок и запросов; None, если нужно обновление."""
+        token, expires_at = self._token, self._expires_at
+        if token and time.time() < expires_at - self.min_valid:
+            return token
+        return None
+
+    def prefetch(self):
+        """Получает токен в фоне сразу после старта, чтобы первый запрос не ждал аутентификацию."""
+        with self._lock:
+            self._schedule_refresh()
+
+    def invalidate(self, token: str):
+        """Сбрасывает токен, отклонённый API (например, 401), чтобы следующий запрос получил новый."""
+        with self._lock:
+            if self._token == token:
+                self._token, self._expires_at = None, 0
+        if self.cache_path:
+            try:
+                with self._file_lock.acquire(timeout=30):
+                    shared = self._read_shared()
+                    if shared and shared[0] == token:
+                        self._write_shared(None, 0)
+            except FileLockTimeout:
+                pass
+
+    def _refresh(self, min_valid: float) -> str:
+        with self._lock:
+            # другой поток мог обновить токен, пока мы ждали блокировку
+            if self._token and time.time() < self._expires_at - min_valid:
+                return self._token
+            try:
+                token, expires_at = self._refresh_shared(min_valid) if self.cache_path else self._fetch_token()
+            except FileLockTimeout:
+                print("Не дождались блокировки файла токена GigaChat, аутентифицируемся без неё")
+                token, expires_at = self._fetch_token()
+            self._token, self._expires_at = token, expires_at
+            self._schedule_refresh()
+            return token
+
+    def _refresh_shared(self, min_valid: float) -> tuple[str, float]:
+        with self._file_lock.acquire(timeout=30):
+            shared = self._read_shared()
+            if shared and time.time() < shared[1] - min_valid:
+                return shared  # токен уже обновил другой воркер
+            token, expires_at = self._fetch_token()
+            self._write_shared(token, expires_at)
+            return token, expires_at
+
+    def _schedule_refresh(self, delay: float | None = None):
+        """Планирует фоновое обновление: за refresh_margin до истечения токена или через delay секунд."""
+        if self._timer:
+            self._timer.cancel()
+        margin = self.refresh_margin
+        remaining = self._expires_at - time.time()
+        if remaining > 0 and margin > remaining / 2:
+            # иначе свежий токен сразу считается истекающим и OAuth запрашивается каждую секунду
+            margin = remaining / 2
+            if not self._margin_warned:
+                logger.warning("GIGA_TOKEN_REFRESH_MARGIN (%gs) не меньше половины срока жизни токена GigaChat "
+                               "(%.0fs): обновляем за %.0fs до истечения", self.refresh_margin, remaining, margin)
+                self._margin_warned = True
+        if delay is None:
+            delay = max(remaining - margin, 1.0)
+        self._timer = threading.Timer(min(delay, MAX_REFRESH_DELAY), self._refresh_in_background, args=(margin,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self, margin: float):
+        try:
+            self._refresh(margin)
+        except Exception as e:
+            # токен, возможно, ещё действует; запросы к API при необходимости обновят его сами
+            with self._lock:
+                self._refresh_failures += 1
+                delay = min(REFRESH_RETRY_SECONDS * 2 ** (self._refresh_failures - 1), MAX_REFRESH_RETRY_SECONDS)
+                if self._timer is threading.current_thread():  # не заменяем таймер, поставленный после обновления
+                    self._schedule_refresh(delay)
+            logger.warning("Фоновое обновление токена GigaChat не удалось, повтор через %gs: %s", delay, e)
+            return
+        self._refresh_failures = 0
+        logger.info("Токен доступа GigaChat обновлён заранее.")
+
+    def _read_shared(self) -> tuple[str, float] | None:
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('owner') != self._owner or not data.get('access_token'):
+            return None
+        return data['access_token'], float(data.get('expires_at', 0))
+
+    def _write_shared(self, token: str | None, expires_at: float):
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            # файл с токеном доступен только владельцу процесса
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({"owner": self._owner, "access_token": token, "expires_at": expires_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Не удалось сохранить токен GigaChat в {self.cache_path}: {e}")
+
+
 # --- API Client Class ---
 class GigaChatClient:
     """
@@ -27,7 +198,8 @@ class GigaChatClient:
     Handles authentication (OAuth 2.0) and provides methods
     for various API endpoints.
     """
-    def __init__(self, client_id: str, client_secret: str, scope: str = "GIGACHAT_API_PERS", verify_ssl: bool = True):
+    def __init__(self, client_id: str, client_secret: str, scope: str = "GIGACHAT_API_PERS", verify_ssl: bool = True,
+                 token_cache_path: str | None = None, token_refresh_margin: float = 300):
         if not client_id or not client_secret:
             raise ValueError("Client ID and Client Secret cannot be empty.")
         if scope not in ["GIGACHAT_API_PERS", "GIGACHAT_API_B2B", "GIGACHAT_API_CORP"]:
@@ -38,10 +210,11 @@ class GigaChatClient:
         self.scope = scope
         self.verify_ssl = verify_ssl
 
-        self._access_token = None
-        self._token_expires_at = 0
+        self._tokens = TokenManager(self._authenticate, cache_path=token_cache_path,
+                                    owner=f"{client_id}:{scope}:{AUTH_URL}", refresh_margin=token_refresh_margin)
         self._session = requests.Session()
         self._session.verify = self.verify_ssl
+        self._session.hooks['response'].append(_record_response)
 
         if not verify_ssl:
             import urllib3
@@ -54,7 +227,8 @@ class GigaChatClient:
         encoded_credentials = base64.b64encode(credentials.encode()).decode()
         return encoded_credentials
 
-    def _authenticate(self):
+    def _authenticate(self) -> tuple[str, float]:
+        """Получает новый токен доступа. Возвращает (access_token, expires_at в секундах)."""
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "Accept": "application/json",
@@ -67,17 +241,16 @@ class GigaChatClient:
             response = self._session.post(AUTH_URL, headers=headers, data=payload, timeout=20)
             response.raise_for_status()
             token_data = response.json()
-            self._access_token = token_data.get("access_token")
+            access_token = token_data.get("access_token")
             expires_at_raw = token_data.get("expires_at")
             if expires_at_raw is None:
                 raise GigaChatAPIError(response.status_code, "Missing 'expires_at' in token response")
-            if expires_at_raw > 4102444800000: # approx 2100-01-01 in ms
-                 self._token_expires_at = expires_at_raw / 1000
-            else:
-                 self._token_expires_at = expires_at_raw
-            if not self._access_token:
+            # GigaChat отдаёт миллисекунды (~1.8e12); 1e11 — это 1973 год в мс и 5138 год в секундах
+            expires_at = expires_at_raw / 1000 if expires_at_raw > 1e11 else expires_at_raw
+            if not access_token:
                  raise GigaChatAPIError(response.status_code, "Missing 'access_token' in token response")
             print("Успешно получен новый токен доступа.")
+            return access_token, expires_at
         except requests.exceptions.RequestException as e:
             error_message = str(e)
             if e.response is not None:
@@ -92,14 +265,13 @@ class GigaChatClient:
             raise GigaChatAPIError(500, f"Не удалось разобрать ответ токена: {e}") from e
 
     def _get_valid_token(self) -> str:
-        if self._access_token and time.time() < (self._token_expires_at - 60):
-            return self._access_token
-        else:
-            print("Токен доступа истек или не найден. Аутентификация...")
-            self._authenticate()
-            return self._access_token
-
-    def _make_request(self, method: str, endpoint: str, **kwargs):
+        return self._tokens.get_token()
+
+    def prefetch_token(self):
+        """Запускает получение токена в фоне (вызывается при старте приложения)."""
+        self._tokens.prefetch()
+
+    def _make_request(self, method: str, endpoint: str, _retried: bool = False, **kwargs):
         token = self._get_valid_token()
         url = f"{API_BASE_URL}{endpoint}"
         default_headers = {
@@ -116,6 +288,12 @@ class GigaChatClient:
 
         try:
             response = self._session.request(method, url, timeout=30, **kwargs)
+            if response.status_code == 401 and not _retried:
+                # токен отозван или истёк раньше срока — получаем новый и повторяем один раз
+                self._tokens.invalidate(token)
+                metrics.record_retry('gigachat', 'unauthorized')
+                kwargs['headers'].pop('Authorization', None)
+                return self._make_request(method, endpoint, _retried=True, **kwargs)
             response.raise_for_status()
             return response
         except requests.exceptions.RequestException as e:
@@ -151,4 +329,160 @@ class GigaChatClient:
             **kwargs
         }
         response = self._make_request("POST", "/chat/completions", json=payload)
-        return response.json()
\ No newline at end of file
+        return response.json()
+
+    def chat_stream(self, messages: list, model: str = "GigaChat", **kwargs):
+        """
+        Потоковый вариант chat(): POST /chat/completions со "stream": true.
+        Запрос к API выполняется сразу (ошибки HTTP бросаются как GigaChatAPIError),
+        а возвращается генератор фрагментов текста ответа по мере их прихода (SSE).
+
+        Args:
+            messages (list): Список объектов сообщений.
+            model (str): ID модели для использования.
+            **kwargs: Дополнительные параметры для эндпоинта чата.
+
+        Returns:
+            Iterator[str]: Фрагменты content из delta каждого чанка.
+        """
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            **kwargs
+        }
+        response = self._make_request("POST", "/chat/completions", json=payload, stream=True,
+                                      headers={"Accept": "text/event-stream"})
+        return self._iter_stream(response)
+
+    @staticmethod
+    def _iter_stream(response):
+        """Разбирает SSE поток GigaChat: строки 'data: {json}' и завершающая 'data: [DONE]'."""
+        try:
+            for line in response.iter_lines():
+                contents = _parse_stream_line(line.decode('utf-8'))
+                if contents is None:
+                    break
+                yield from contents
+        except requests.exceptions.RequestException as e:
+            raise GigaChatAPIError(502, f"Поток ответа прерван: {e}") from e
+        finally:
+            response.close()
+
+
+def _parse_stream_line(line: str) -> list[str] | None:
+    """Фрагменты content из строки SSE потока GigaChat; None для завершающей 'data: [DONE]'."""
+    if not line or not line.startswith('data:'):
+        return []  # пустые строки-разделители, комментарии и прочие поля SSE
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return None
+    try:
+        chunk = json.loads(data)
+    except ValueError as e:
+        raise GigaChatAPIError(502, f"Некорректный чанк потока: {data[:200]!r}") from e
+    return [content for choice in chunk.get("choices", [])
+            if (content := choice.get("delta", {}).get("content"))]
+
+
+class AsyncGigaChatClient:
+    """
+    Асинхронный вариант GigaChatClient для ASGI сервера: запросы идут через общий пул
+    соединений httpx.AsyncClient и не занимают поток на время ответа модели.
+    Токен берётся из TokenManager синхронного клиента, поэтому оба клиента (и все
+    воркеры, если задан token_cache_path) используют один и тот же токен.
+    """
+    def __init__(self, client: GigaChatClient, pool_size: int = 100):
+        import httpx  # нужен только для ASGI сервера
+        self._httpx = httpx
+        self._tokens = client._tokens
+        self._client = httpx.AsyncClient(
+            verify=client.verify_ssl,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(30.0),
+            event_hooks={'response': [_record_response_async]},
+        )
+        print(f"AsyncGigaChatClient инициализирован")
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _get_valid_token(self) -> str:
+        token = self._tokens.peek()
+        if token:
+            return token
+        # аутентификация и файловая блокировка — блокирующие, выполняем в потоке
+        return await asyncio.to_thread(self._tokens.get_token)
+
+    async def _make_request(self, method: str, endpoint: str, stream: bool = False, _retried: bool = False,
+                            **kwargs):
+        token = await self._get_valid_token()
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/json",
+            **kwargs.pop('headers', {}),
+        }
+        request = self._client.build_request(method, f"{API_BASE_URL}{endpoint}", headers=headers, **kwargs)
+        try:
+            response = await self._client.send(request, stream=stream)
+        except self._httpx.HTTPError as e:
+            raise GigaChatAPIError(500, f"Ошибка API запроса: {e}") from e
+
+        if response.status_code == 401 and not _retried:
+            # токен отозван или истёк раньше срока — получаем новый и повторяем один раз
+            await response.aclose()
+            await asyncio.to_thread(self._tokens.invalidate, token)
+            metrics.record_retry('gigachat', 'unauthorized')
+            headers.pop('Authorization')
+            return await self._make_request(method, endpoint, stream=stream, _retried=True, headers=headers, **kwargs)
+        if response.is_error:
+            try:
+                await response.aread()
+                try:
+                    details = response.json().get('message', response.text)
+                except ValueError:
+                    details = response.text
+            finally:
+                await response.aclose()
+            raise GigaChatAPIError(response.status_code,
+                                   f"Ошибка API запроса: {response.status_code} {response.reason_phrase} | Детали: {details}")
+        return response
+
+    async def chat(self, messages: list, model: str = "GigaChat", **kwargs):
+        """Асинхронный GigaChatClient.chat(): возвращает полный JSON ответ в виде словаря."""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": False,
+            **kwargs
+        }
+        response = await self._make_request("POST", "/chat/completions", json=payload)
+        return response.json()
+
+    async def chat_stream(self, messages: list, model: str = "GigaChat", **kwargs):
+        """
+        Асинхронный GigaChatClient.chat_stream(): ошибки HTTP бросаются при await,
+        возвращается асинхронный генератор фрагментов текста ответа.
+        """
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            **kwargs
+        }
+        response = await self._make_request("POST", "/chat/completions", stream=True, json=payload,
+                                            headers={"Accept": "text/event-stream"})
+        return self._iter_stream(response)
+
+    async def _iter_stream(self, response):
+        try:
+            async for line in response.aiter_lines():
+                contents = _parse_stream_line(line)
+                if contents is None:
+                    break
+                for content in contents:
+                    yield content
+        except self._httpx.HTTPError as e:
+            raise GigaChatAPIError(502, f"Поток ответа прерван: {e}") from e
+        finally:
+            await response.aclose()
@@ -0,0 +1,83 @@
+import io
+
+from PIL import Image, UnidentifiedImageError
+
+# Приём загруженных изображений с ограниченной памятью на запрос:
+#   read_upload  — читает файл формы не больше max_bytes (+1 байт, чтобы заметить превышение);
+#   open_image   — только заголовок: формат и размер, уменьшенное декодирование JPEG (draft)
+#                  и проверка бюджета пикселей до того, как декодирован хоть один пиксель;
+#   decode_image — open_image + load;
+#   model_input  — дешёвая уменьшенная копия для моделей с маленьким входом (NSFW).
+# Модуль не зависит от Flask: ошибки — UploadRejectedError со статусом для ответа.
+
+# Режимы, которые умеет Image.reduce (палитру сначала нужно развернуть)
+_REDUCIBLE_MODES = ("RGB", "RGBA", "L", "LA", "I", "F")
+
+
+class UploadRejectedError(Exception):
+    """Загрузка отклонена до декодирования: слишком большой файл или изображение, либо не изображение."""
+    def __init__(self, message, status_code=413):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def read_upload(stream, max_bytes: int) -> bytes:
+    """Читает загруженный файл целиком, но не больше max_bytes (0 — без ограничения)."""
+    if not max_bytes:
+        return stream.read()
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise UploadRejectedError(f"Файл слишком большой (максимум {max_bytes / (1024 * 1024):g} МБ).")
+    return data
+
+
+def open_image(data: bytes, max_pixels: int = 0, target_size: tuple | None = None) -> Image.Image:
+    """
+    Открывает изображение без декодирования пикселей. С target_size JPEG декодируется сразу
+    в 1/2, 1/4 или 1/8 размера, но не меньше target_size по обеим сторонам (Image.draft).
+    Бюджет max_pixels (0 — без ограничения) проверяется по размеру, который будет декодирован.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise UploadRejectedError(f"Изображение слишком большое: {e}")
+    except (UnidentifiedImageError, OSError):
+        raise UploadRejectedError("Файл не является изображением или формат не поддерживается.", 400)
+
+    if target_size and image.format == "JPEG":
+        image.draft(None, target_size)  # меняет image.size; для остальных форматов ничего не делает
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise UploadRejectedError(
+            f"Изображение слишком большое: {width}x{height} (максимум {max_pixels / 1_000_000:g} Мп).")
+    return image
+
+
+def decode_image(data: bytes, max_pixels: int = 0, target_size: tuple | None = None) -> Image.Image:
+    """
+    Декодирует изображение (см. open_image). Форматы без уменьшенного декодирования
+    после загрузки сжимаются в целое число раз (Image.reduce), тоже не меньше target_size,
+    чтобы дальше по конвейеру не держать полноразмерную копию.
+    """
+    image = open_image(data, max_pixels, target_size)
+    image.load()
+    if target_size and image.mode in _REDUCIBLE_MODES:
+        factor = min(image.width // target_size[0], image.height // target_size[1])
+        if factor > 1:
+            image = image.reduce(factor)
+    return image
+
+
+def model_input(image: Image.Image, size: int) -> Image.Image:
+    """
+    RGB копия для классификатора со входом size x size: уменьшена в целое число раз так,
+    что меньшая сторона не меньше size. Препроцессор модели всё равно сжимает вход,
+    но из маленького изображения, а не из полноразмерного тензора float32.
+    """
+    if image.mode not in _REDUCIBLE_MODES:
+        image = image.convert("RGB")
+    factor = min(image.size) // size if size else 0
+    if factor > 1:
+        image = image.reduce(factor)
+    return image if image.mode == "RGB" else image.convert("RGB")
@@ -0,0 +1,170 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Статусы задачи
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+FINISHED_STATUSES = (JOB_DONE, JOB_FAILED)
+
+# Возвращается функцией задачи, если её продолжение запланировано через continue_with()
+DEFERRED = object()
+
+
+class JobQueueFullError(Exception):
+    """Очередь задач заполнена, новую задачу принять нельзя."""
+
+
+class Job:
+    """
+    Состояние одной фоновой задачи генерации.
+    Все изменения выполняются под блокировкой JobManager.
+    """
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = JOB_QUEUED
+        self.stage = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.results = None  # {вариант: готовое изображение}
+        self.degraded = False  # результат собран с запасным вариантом (например, заглушка вместо генерации)
+        self.error = None  # dict с телом ответа об ошибке
+        self.error_status = None
+        self.version = 0  # увеличивается при каждом изменении, нужен для SSE
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.results:
+            data["variants"] = list(self.results)
+        if self.degraded:
+            data["degraded"] = True
+        if self.error:
+            data.update(self.error)
+        return data
+
+
+class JobManager:
+    """
+    Выполняет задачи генерации карт в фоновом пуле потоков.
+    Endpoint сразу получает id задачи, а клиент опрашивает статус
+    (или подписывается на SSE) и забирает результат, когда он готов.
+    Ожидание внешних операций не занимает поток: задача может передать
+    продолжение в continue_with() и освободить пул до готовности Future.
+    Завершённые задачи хранятся ttl секунд, затем удаляются.
+
+    Задачи хранятся в памяти процесса: при нескольких воркерах запросы
+    /generate-card/jobs/* должны попадать в воркер, создавший задачу
+    (sticky routing по job_id), иначе используйте один воркер.
+    """
+    def __init__(self, max_workers: int = 8, max_pending: int = 500, ttl: int = 600):
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='card-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        print(f"JobManager инициализирован (workers={max_workers}, max_pending={max_pending}, ttl={ttl}s)")
+
+    def submit(self, fn, *args, **kwargs) -> Job:
+        """
+        Ставит fn(job, *args, **kwargs) в очередь. Функция сообщает о прогрессе
+        через set_stage() и завершает задачу через complete()/fail().
+        """
+        with self._lock:
+            self._cleanup_locked()
+            pending = sum(1 for job in self._jobs.values() if not job.finished)
+            if pending >= self.max_pending:
+                raise JobQueueFullError(f"Too many pending jobs ({pending})")
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            self._cleanup_locked()
+            return self._jobs.get(job_id)
+
+    def set_stage(self, job: Job, stage: str):
+        with self._lock:
+            job.stage = stage
+            self._touch_locked(job)
+
+    def complete(self, job: Job, results: dict, degraded: bool = False):
+        """Сохраняет готовые изображения задачи: {вариант: результат}."""
+        with self._lock:
+            job.results = results
+            job.degraded = degraded
+            job.status = JOB_DONE
+            job.finished_at = time.time()
+            self._touch_locked(job)
+
+    def fail(self, job: Job, error: dict, status_code: int = 500):
+        with self._lock:
+            job.error = error
+            job.error_status = status_code
+            job.status = JOB_FAILED
+            job.finished_at = time.time()
+            self._touch_locked(job)
+
+    def continue_with(self, job: Job, future, fn, *args):
+        """
+        Когда future завершится, выполняет fn(job, future, *args) в пуле задач.
+        Пока future не готов (например, ждём генерацию фона), поток пула не занят.
+        Функция задачи должна вернуть результат этого вызова (DEFERRED).
+        """
+        future.add_done_callback(lambda done: self._executor.submit(self._run, job, fn, (done,) + args, {}))
+        return DEFERRED
+
+    def wait_for_update(self, job: Job, last_version: int, timeout: float) -> dict | None:
+        """
+        Блокирует до изменения задачи (version > last_version) или таймаута.
+        Возвращает снимок состояния задачи или None при таймауте.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: job.version > last_version, timeout=timeout)
+            if job.version > last_version:
+                return dict(job.to_dict(), version=job.version)
+            return None
+
+    def _run(self, job: Job, fn, args, kwargs):
+        with self._lock:
+            if job.status == JOB_QUEUED:
+                job.status = JOB_RUNNING
+                job.started_at = time.time()
+                self._touch_locked(job)
+        try:
+            if fn(job, *args, **kwargs) is DEFERRED:
+                return
+        except Exception as e:
+            print(f"Unexpected error in job {job.id}: {e}")
+            self.fail(job, {"error": f"Внутренняя ошибка сервера: {e}"}, 500)
+        if not job.finished:
+            self.fail(job, {"error": "Задача завершилась без результата."}, 500)
+
+    def _touch_locked(self, job: Job):
+        job.version += 1
+        self._changed.notify_all()
+
+    def _cleanup_locked(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,84 @@
+import hashlib
+import io
+import threading
+from typing import NamedTuple
+
+from PIL import Image
+
+from services.cache import DiskLRUCache, MemoryLRUCache
+
+
+class CachedLogo(NamedTuple):
+    is_nsfw: bool
+    logo: Image.Image | None  # RGBA логотип без фона; None для NSFW логотипов
+
+
+class LogoCache:
+    """
+    Кэш обработанных логотипов, адресуемый SHA-256 исходных байтов файла.
+    Хранит результат удаления фона и вердикт NSFW, поэтому повторная
+    загрузка того же логотипа не запускает ни одну из моделей.
+    Два уровня: LRU в памяти с бюджетом по байтам (декодированные RGBA изображения,
+    без повторного декодирования при попадании) и (опционально) каталог на диске
+    с вытеснением по размеру, общий для всех воркеров (PNG).
+    Изображения из кэша разделяются между потоками и не должны изменяться на месте.
+    """
+    def __init__(self, memory_bytes: int, disk_dir: str | None = None, disk_bytes: int = 0):
+        self._memory = MemoryLRUCache(memory_bytes)
+        self._disk = DiskLRUCache(disk_dir, disk_bytes) if disk_dir and disk_bytes else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        print(f"LogoCache инициализирован (memory={memory_bytes // (1024 * 1024)}MB, disk={disk_dir or 'off'})")
+
+    @staticmethod
+    def key_for(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, key: str) -> CachedLogo | None:
+        entry = self._memory.get(key)
+        if entry is None and self._disk:
+            raw = self._disk.get(key)
+            if raw:
+                entry = self._decode(raw)
+                self._memory.put(key, entry, self._memory_size(entry))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key: str, is_nsfw: bool, logo: Image.Image | None = None):
+        entry = CachedLogo(is_nsfw, None if is_nsfw else logo)
+        self._memory.put(key, entry, self._memory_size(entry))
+        if self._disk:
+            self._disk.put(key, self._encode(entry))
+
+    @staticmethod
+    def _memory_size(entry: CachedLogo) -> int:
+        if entry.logo is None:
+            return 1
+        return entry.logo.width * entry.logo.height * len(entry.logo.getbands())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._memory)}
+
+    # Формат записи на диске: 1 байт вердикта NSFW + PNG логотипа
+    @staticmethod
+    def _encode(entry: CachedLogo) -> bytes:
+        if entry.is_nsfw:
+            return b'\x01'
+        buffer = io.BytesIO()
+        buffer.write(b'\x00')
+        entry.logo.save(buffer, format='PNG', compress_level=1)  # быстрее, размер на диске вторичен
+        return buffer.getvalue()
+
+    @staticmethod
+    def _decode(raw: bytes) -> CachedLogo:
+        if raw[:1] == b'\x01':
+            return CachedLogo(True, None)
+        logo = Image.open(io.BytesIO(raw[1:]))
+        logo.load()
+        return CachedLogo(False, logo)
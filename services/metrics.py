@@ -0,0 +1,140 @@
+import contextlib
+import contextvars
+import os
+import time
+
+try:
+    from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest,
+                                   multiprocess)
+    from prometheus_client.core import CounterMetricFamily, REGISTRY
+except ImportError:  # без prometheus_client метрики не собираются, /metrics отвечает 503
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+    Counter = Histogram = None
+
+# Этапы конвейера карты (метка stage):
+#   upload_read, decode, nsfw, rembg, fusion_submit, fusion_wait, gigachat,
+#   autocontrast, composite, encode
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+if Histogram:
+    STAGE_SECONDS = Histogram('card_stage_seconds', 'Duration of card pipeline stages', ['stage'],
+                              buckets=STAGE_BUCKETS)
+    UPSTREAM_RESPONSES = Counter('upstream_responses_total', 'Responses from upstream APIs by status code',
+                                 ['service', 'status'])
+    UPSTREAM_RETRIES = Counter('upstream_retries_total', 'Retried upstream requests', ['service', 'reason'])
+    CIRCUIT_TRANSITIONS = Counter('circuit_breaker_transitions_total', 'Circuit breaker state changes',
+                                  ['service', 'state'])
+    UPSTREAM_FALLBACKS = Counter('upstream_fallbacks_total', 'Responses served with a fallback instead of the API',
+                                 ['service'])
+else:
+    STAGE_SECONDS = UPSTREAM_RESPONSES = UPSTREAM_RETRIES = CIRCUIT_TRANSITIONS = UPSTREAM_FALLBACKS = None
+
+# Тайминги текущего запроса для заголовка Server-Timing (None — заголовок не собирается)
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def available() -> bool:
+    return STAGE_SECONDS is not None
+
+
+def observe_stage(stage: str, seconds: float):
+    """Записывает длительность этапа в гистограмму и в Server-Timing текущего запроса."""
+    if STAGE_SECONDS is not None:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    """with stage_timer('nsfw'): ... — длительность блока записывается даже при исключении."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def record_upstream(service: str, status) -> None:
+    """status — HTTP код ответа или 'error' для сетевой ошибки."""
+    if UPSTREAM_RESPONSES is not None:
+        UPSTREAM_RESPONSES.labels(service, str(status)).inc()
+
+
+def record_retry(service: str, reason: str) -> None:
+    if UPSTREAM_RETRIES is not None:
+        UPSTREAM_RETRIES.labels(service, reason).inc()
+
+
+def record_circuit_state(service: str, state: str) -> None:
+    """Переход circuit breaker в состояние state (closed / open / half_open)."""
+    if CIRCUIT_TRANSITIONS is not None:
+        CIRCUIT_TRANSITIONS.labels(service, state).inc()
+
+
+def record_fallback(service: str) -> None:
+    if UPSTREAM_FALLBACKS is not None:
+        UPSTREAM_FALLBACKS.labels(service).inc()
+
+
+# --- Server-Timing ---
+def start_request_timing() -> contextvars.Token:
+    """Начинает сбор таймингов этапов для текущего запроса (потока или задачи asyncio)."""
+    return _request_timings.set({})
+
+
+def finish_request_timing(token: contextvars.Token, total_seconds: float | None = None) -> str | None:
+    """Завершает сбор и возвращает значение заголовка Server-Timing (None, если этапов не было)."""
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    if not timings and total_seconds is None:
+        return None
+    parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in (timings or {}).items()]
+    if total_seconds is not None:
+        parts.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ', '.join(parts)
+
+
+# --- Кэши ---
+CACHE_RESULTS = {'hits': 'hit', 'misses': 'miss', 'joined': 'joined'}  # поле stats() -> метка result
+
+
+class CacheStatsCollector:
+    """
+    Счётчики попаданий в кэши (cache_requests_total{cache, result}) читаются из stats()
+    кэшей в момент запроса /metrics, поэтому сами кэши не зависят от prometheus_client.
+    Кэши живут в памяти воркера: с PROMETHEUS_MULTIPROC_DIR значения относятся к воркеру,
+    который ответил на /metrics, а не суммируются по всем воркерам.
+    """
+    def __init__(self, caches: dict):
+        self._caches = caches  # имя -> объект с методом stats()
+
+    def collect(self):
+        family = CounterMetricFamily('cache_requests', 'Cache lookups by result', labels=['cache', 'result'])
+        for name, cache in self._caches.items():
+            for field, value in cache.stats().items():
+                if field in CACHE_RESULTS:
+                    family.add_metric([name, CACHE_RESULTS[field]], value)
+        yield family
+
+
+_cache_collectors = []  # добавляются и в реестр, который render_latest() собирает в multiprocess режиме
+
+
+def register_caches(caches: dict):
+    if available():
+        collector = CacheStatsCollector(caches)
+        REGISTRY.register(collector)
+        _cache_collectors.append(collector)
+
+
+def render_latest() -> tuple[bytes, str]:
+    """Тело ответа /metrics и его Content-Type. С PROMETHEUS_MULTIPROC_DIR метрики собираются со всех воркеров."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _cache_collectors:
+            registry.register(collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
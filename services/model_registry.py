@@ -0,0 +1,124 @@
+import threading
+import time
+
+
+class ModelRegistry:
+    """
+    Реестр тяжёлых моделей (NSFW классификатор, rembg), которые создаются лениво.
+    Импорт приложения не загружает ни transformers, ни onnxruntime: модель создаётся
+    при первом обращении через get() или заранее в фоне через warm_up().
+    Каждая модель создаётся ровно один раз, даже при одновременных обращениях.
+    Неудачная загрузка повторяется не раньше, чем через retry_seconds (интервал удваивается
+    с каждой неудачей до max_retry_seconds): временный сбой (скачивание, нехватка памяти)
+    не оставляет воркер без модели до перезапуска.
+    """
+    def __init__(self, started_at: float | None = None, retry_seconds: float = 30.0, max_retry_seconds: float = 600.0):
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self._factories = {}
+        self._instances = {}
+        self._errors = {}  # имя -> (текст ошибки, время неудачи, число неудач подряд)
+        self._retrying = False  # идёт фоновый повтор (retry_failed), под _lock
+        self._lock = threading.Lock()
+        self._load_seconds = {}
+        self._locks = {}
+        self.started_at = started_at or time.time()  # точка отсчёта холодного старта
+        self.ready_at = None  # время, когда все модели загружены
+
+    def register(self, name: str, factory):
+        """Регистрирует фабрику модели. factory() вызывается при первом get(name)."""
+        self._factories[name] = factory
+        self._locks[name] = threading.Lock()
+
+    def get(self, name: str):
+        """
+        Возвращает модель, создавая её при первом обращении. None, если создать не удалось
+        (до истечения интервала повтора после неудачи новая попытка не делается).
+        """
+        if name in self._instances:
+            return self._instances[name]
+        with self._locks[name]:
+            if name in self._instances:
+                return self._instances[name]
+            if self._retry_in(name) > 0:
+                return None
+            attempts = self._errors[name][2] if name in self._errors else 0
+            print(f"Загрузка модели '{name}'..." + (f" (попытка {attempts + 1})" if attempts else ""))
+            start = time.time()
+            try:
+                self._instances[name] = self._factories[name]()
+            except Exception as e:
+                print(f"!!! ОШИБКА загрузки модели '{name}': {e}")
+                self._errors[name] = (str(e), time.time(), attempts + 1)
+                return None
+            finally:
+                self._load_seconds[name] = time.time() - start
+            self._errors.pop(name, None)
+            print(f"Модель '{name}' загружена за {self._load_seconds[name]:.2f} s")
+            if self.ready_at is None and self.is_ready():
+                self.ready_at = time.time()
+            return self._instances[name]
+
+    def _retry_in(self, name: str) -> float:
+        """Секунд до следующей попытки загрузки после неудачи (0 — можно загружать)."""
+        if name not in self._errors:
+            return 0.0
+        _, failed_at, attempts = self._errors[name]
+        delay = min(self.retry_seconds * 2 ** (attempts - 1), self.max_retry_seconds)
+        return max(failed_at + delay - time.time(), 0.0)
+
+    def retry_failed(self) -> threading.Thread | None:
+        """
+        В фоне повторяет загрузку моделей, у которых истёк интервал повтора.
+        Вызывается из проверки готовности, чтобы воркер восстановился без запросов к модели.
+        """
+        due = [name for name in list(self._errors) if self._retry_in(name) == 0]
+        with self._lock:
+            if not due or self._retrying:
+                return None
+            self._retrying = True
+
+        def retry():
+            try:
+                for name in due:
+                    self.get(name)
+            finally:
+                self._retrying = False
+
+        thread = threading.Thread(target=retry, name='model-retry', daemon=True)
+        thread.start()
+        return thread
+
+    def warm_up(self, background: bool = True) -> threading.Thread | None:
+        """Загружает все зарегистрированные модели: в фоновом потоке или в текущем."""
+        def load_all():
+            for name in self._factories:
+                self.get(name)
+            print(f"Прогрев моделей завершён через {time.time() - self.started_at:.2f} s после старта процесса")
+
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name='model-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def is_ready(self) -> bool:
+        """True, когда все зарегистрированные модели успешно загружены."""
+        return all(name in self._instances for name in self._factories)
+
+    def has_failures(self) -> bool:
+        """True, если последняя попытка загрузить какую-либо модель не удалась."""
+        return bool(self._errors)
+
+    def status(self) -> dict:
+        models = {}
+        for name in self._factories:
+            models[name] = {
+                "loaded": name in self._instances,
+                "load_seconds": round(self._load_seconds[name], 3) if name in self._load_seconds else None,
+                "error": self._errors[name][0] if name in self._errors else None,
+            }
+            if name in self._errors:
+                models[name]["retry_in"] = round(self._retry_in(name), 1)
+        return models
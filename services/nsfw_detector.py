@@ -1,5 +1,11 @@
 import base64
 import io
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
 from PIL import Image
 try:
     from PIL import UnidentifiedImageError
@@ -14,31 +20,63 @@ except ImportError:
 
 _Base64Error = binascii.Error if binascii else ValueError # Ошибка декодирования base64
 
-from transformers import pipeline
 import logging
 from typing import Union # Для type hints
 
 # Подавляем информационные сообщения от transformers
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
+QUEUE_PUT_TIMEOUT = 10  # сек ожидания места в очереди инференса, затем проверка считается неудачной
+RESULT_TIMEOUT = 30  # сек ожидания результата инференса (зависший батч), затем проверка считается неудачной
+
 class NsfwDetector:
     """
     Класс для определения NSFW контента на изображении.
     Принимает путь к файлу, PIL Image объект или строку base64.
+
+    Инференс выполняется одним фоновым потоком с микро-батчингом: вызывающие потоки
+    ставят изображения в очередь и получают Future, а поток собирает до batch_size
+    изображений (или ждёт не дольше max_wait_ms после первого) и прогоняет их
+    через модель одним батчем.
+
+    Бэкенды: 'transformers' (pipeline на PyTorch) или 'onnx' — та же модель, экспортированная
+    в onnx_dir (при первом запуске, опционально с int8 квантизацией), в onnxruntime
+    (services.nsfw_onnx). Контракт is_nsfw у обоих одинаковый.
     """
-    def __init__(self, model_name="Falconsai/nsfw_image_detection"):
+    def __init__(self, model_name="Falconsai/nsfw_image_detection", batch_size: int = 8,
+                 max_wait_ms: float = 10, queue_size: int = 256, backend: str = 'transformers',
+                 onnx_dir: str | None = None, onnx_quantize: bool = True, onnx_threads: int = 0):
         """
-        Инициализирует классификатор изображений.
+        Инициализирует классификатор изображений и поток батчевого инференса.
+        Ошибка загрузки модели пробрасывается: ModelRegistry засчитывает её как неудачную
+        загрузку (готовность, повтор после паузы), а не как загруженный детектор без модели.
         """
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.backend = backend
+        self._queue = queue.Queue(maxsize=queue_size)
         try:
-            self.classifier = pipeline(
-                "image-classification",
-                model=model_name,
-                use_fast=True
-            )
+            if backend == 'onnx':
+                # torch и transformers нужны только для экспорта, если модели ещё нет в onnx_dir
+                from services import nsfw_onnx
+                onnx_dir = onnx_dir or os.path.join('cache', 'nsfw_onnx')
+                nsfw_onnx.ensure_model(model_name, onnx_dir, onnx_quantize)
+                self.classifier = nsfw_onnx.OnnxImageClassifier(onnx_dir, quantized=onnx_quantize,
+                                                                threads=onnx_threads)
+            else:
+                # transformers (и torch) импортируются здесь, а не при импорте модуля:
+                # это несколько секунд, которые не должны задерживать старт процесса
+                from transformers import pipeline
+                self.classifier = pipeline(
+                    "image-classification",
+                    model=model_name,
+                    use_fast=True
+                )
         except Exception as e:
             print(f"Ошибка инициализации модели: {e}")
-            self.classifier = None
+            raise
+
+        threading.Thread(target=self._inference_loop, name='nsfw-batcher', daemon=True).start()
 
     def _load_image(self, image_input: Union[str, Image.Image]) -> Image.Image | None:
         """Вспомогательный метод для загрузки изображения из разных источников."""
@@ -95,6 +133,30 @@ class NsfwDetector:
         return img
 
 
+    def submit(self, image_input: Union[str, Image.Image]) -> Future:
+        """
+        Ставит изображение в очередь на проверку и сразу возвращает Future.
+        Результат Future — то же значение, что возвращает is_nsfw().
+        """
+        future = Future()
+        if not self.classifier:
+            print("Классификатор не был инициализирован.")
+            future.set_result(None)
+            return future
+
+        img = self._load_image(image_input)
+        if img is None:
+            # Сообщение об ошибке уже выведено в _load_image
+            future.set_result(None)
+            return future
+
+        try:
+            self._queue.put((img, future), timeout=QUEUE_PUT_TIMEOUT)
+        except queue.Full:
+            print(f"Очередь проверки NSFW переполнена ({self._queue.maxsize}).")
+            future.set_result(None)
+        return future
+
     def is_nsfw(self, image_input: Union[str, Image.Image]) -> bool | None:
         """
         Проверяет, является ли входное изображение NSFW.
@@ -108,20 +170,40 @@ class NsfwDetector:
             None, если произошла ошибка при обработке, модель не загружена,
                   или входные данные некорректны.
         """
-        if not self.classifier:
-            print("Классификатор не был инициализирован.")
-            return None
+        return self.wait_result(self.submit(image_input))
 
-        img = self._load_image(image_input)
-
-        if img is None:
-            # Сообщение об ошибке уже выведено в _load_image
+    @staticmethod
+    def wait_result(future: Future) -> bool | None:
+        """Результат Future из submit(), но не дольше RESULT_TIMEOUT; по таймауту — None, как при ошибке."""
+        try:
+            return future.result(timeout=RESULT_TIMEOUT)
+        except FutureTimeoutError:
+            print(f"Проверка NSFW не завершилась за {RESULT_TIMEOUT} s.")
             return None
 
-        try:
-            results = self.classifier(img)
-            best_result = max(results, key=lambda x: x["score"])
-            return best_result["label"] == "nsfw"
-        except Exception as e:
-            print(f"Ошибка классификации изображения: {e}")
-            return None
\ No newline at end of file
+    def _next_batch(self) -> list:
+        """Ждёт первое изображение, затем добирает батч до batch_size или до истечения max_wait."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _inference_loop(self):
+        while True:
+            batch = self._next_batch()
+            images = [img for img, _ in batch]
+            try:
+                results = self.classifier(images, batch_size=len(images))
+                verdicts = [max(result, key=lambda x: x["score"])["label"] == "nsfw" for result in results]
+            except Exception as e:
+                print(f"Ошибка классификации изображения: {e}")
+                verdicts = [None] * len(batch)
+            for (_, future), verdict in zip(batch, verdicts):
+                future.set_result(verdict)
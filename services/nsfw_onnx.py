@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+try:
+    from filelock import FileLock
+except ImportError:  # без filelock одновременный экспорт из нескольких воркеров не исключается
+    FileLock = None
+
+DEFAULT_MODEL = "Falconsai/nsfw_image_detection"
+MODEL_FILE = 'model.onnx'
+QUANTIZED_MODEL_FILE = 'model.int8.onnx'
+CONFIG_FILE = 'config.json'  # id2label, сохраняется из transformers
+PREPROCESSOR_FILE = 'preprocessor_config.json'  # size, resample, rescale, mean/std
+ONNX_OPSET = 17
+
+# ONNX бэкенд для NsfwDetector: экспорт классификатора transformers в ONNX (опционально с int8
+# квантизацией весов) и инференс в onnxruntime — без torch и transformers в процессе приложения.
+# Экспорт можно сделать заранее (иначе его выполнит первая загрузка NsfwDetector(backend='onnx')):
+#   python -m services.nsfw_onnx --output cache/nsfw_onnx
+
+
+def _input_size(preprocessor: dict) -> tuple[int, int]:
+    """(width, height) входа модели из preprocessor_config.json."""
+    size = preprocessor.get('size', 224)
+    if isinstance(size, int):
+        return size, size
+    if 'height' in size and 'width' in size:
+        return size['width'], size['height']
+    edge = size.get('shortest_edge', 224)
+    return edge, edge
+
+
+def model_path(model_dir: str, quantized: bool) -> str:
+    return os.path.join(model_dir, QUANTIZED_MODEL_FILE if quantized else MODEL_FILE)
+
+
+def export_model(model_name: str, output_dir: str, quantize: bool = True) -> str:
+    """
+    Экспортирует классификатор в output_dir: model.onnx (fp32), model.int8.onnx (если quantize)
+    и конфиги модели и препроцессора. Нужны torch и transformers, для квантизации — onnx.
+    Возвращает путь модели, которую следует запускать.
+    """
+    import torch
+    from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+    class LogitsOnly(torch.nn.Module):
+        # ONNX граф с одним выходом logits вместо ModelOutput
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model(pixel_values=pixel_values).logits
+
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"Экспорт NSFW модели {model_name} в ONNX: {output_dir}")
+    model = AutoModelForImageClassification.from_pretrained(model_name, attn_implementation='eager').eval()
+    processor = AutoImageProcessor.from_pretrained(model_name)
+    width, height = _input_size(processor.to_dict())
+
+    fp32_path = model_path(output_dir, quantized=False)
+    with torch.no_grad():
+        torch.onnx.export(LogitsOnly(model), (torch.zeros(1, 3, height, width),), fp32_path + '.tmp',
+                          input_names=['pixel_values'], output_names=['logits'],
+                          dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}},
+                          opset_version=ONNX_OPSET, dynamo=False)
+    os.replace(fp32_path + '.tmp', fp32_path)
+    model.config.save_pretrained(output_dir)
+    processor.save_pretrained(output_dir)
+
+    if not quantize:
+        return fp32_path
+    return quantize_model(fp32_path, model_path(output_dir, quantized=True))
+
+
+def quantize_model(fp32_path: str, int8_path: str) -> str:
+    """Динамическая int8 квантизация весов (MatMul/Gemm); активации остаются float32."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(fp32_path, int8_path + '.tmp', weight_type=QuantType.QInt8)
+    os.replace(int8_path + '.tmp', int8_path)
+    print(f"int8 модель: {int8_path} ({os.path.getsize(int8_path) // (1024 * 1024)} MB, "
+          f"fp32 {os.path.getsize(fp32_path) // (1024 * 1024)} MB)")
+    return int8_path
+
+
+def ensure_model(model_name: str, model_dir: str, quantize: bool = True) -> str:
+    """Путь к ONNX модели в model_dir; экспортирует её, если файла ещё нет (один воркер за раз)."""
+    path = model_path(model_dir, quantize)
+    if os.path.exists(path):
+        return path
+    os.makedirs(model_dir, exist_ok=True)
+    lock = FileLock(os.path.join(model_dir, '.export.lock')) if FileLock else None
+    if lock:
+        lock.acquire()
+    try:
+        if os.path.exists(path):  # экспортировал другой воркер, пока мы ждали блокировку
+            return path
+        fp32_path = model_path(model_dir, quantized=False)
+        if quantize and os.path.exists(fp32_path):
+            return quantize_model(fp32_path, path)
+        return export_model(model_name, model_dir, quantize)
+    finally:
+        if lock:
+            lock.release()
+
+
+class OnnxImageClassifier:
+    """
+    Классификатор изображений на onnxruntime с интерфейсом pipeline('image-classification'):
+    classifier(images, batch_size=...) -> для каждого изображения список {'label', 'score'}
+    по убыванию score (softmax). Препроцессинг фиксированный, из preprocessor_config.json:
+    resize до входа модели, rescale и нормализация сведены в одно умножение и сложение.
+    """
+    def __init__(self, model_dir: str, quantized: bool = True, threads: int = 0):
+        import onnxruntime as ort
+
+        self.model_path = model_path(model_dir, quantized)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(self.model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        with open(os.path.join(model_dir, CONFIG_FILE), 'r', encoding='utf-8') as f:
+            id2label = {int(index): label for index, label in json.load(f)['id2label'].items()}
+        self.labels = [id2label[index] for index in range(len(id2label))]
+        with open(os.path.join(model_dir, PREPROCESSOR_FILE), 'r', encoding='utf-8') as f:
+            preprocessor = json.load(f)
+        self.size = _input_size(preprocessor)
+        self.resample = Image.Resampling(preprocessor.get('resample', Image.Resampling.BILINEAR))
+        rescale = preprocessor.get('rescale_factor', 1 / 255) if preprocessor.get('do_rescale', True) else 1.0
+        if preprocessor.get('do_normalize', True):
+            mean = np.asarray(preprocessor.get('image_mean', [0.5, 0.5, 0.5]), dtype=np.float32)
+            std = np.asarray(preprocessor.get('image_std', [0.5, 0.5, 0.5]), dtype=np.float32)
+        else:
+            mean, std = np.zeros(3, dtype=np.float32), np.ones(3, dtype=np.float32)
+        # (x * rescale - mean) / std == x * scale + offset
+        self._scale = (rescale / std).astype(np.float32).reshape(3, 1, 1)
+        self._offset = (-mean / std).astype(np.float32).reshape(3, 1, 1)
+        print(f"ONNX классификатор: {self.model_path} ({len(self.labels)} классов, вход {self.size})")
+
+    def preprocess(self, images: list) -> np.ndarray:
+        width, height = self.size
+        batch = np.empty((len(images), 3, height, width), dtype=np.float32)
+        for index, image in enumerate(images):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            if image.size != self.size:
+                image = image.resize(self.size, self.resample)
+            batch[index] = np.asarray(image, dtype=np.float32).transpose(2, 0, 1)
+        batch *= self._scale
+        batch += self._offset
+        return batch
+
+    def __call__(self, images, batch_size: int | None = None):
+        single = isinstance(images, Image.Image)
+        images = [images] if single else list(images)
+        batch_size = batch_size or len(images)
+        results = []
+        for start in range(0, len(images), batch_size):
+            logits = self.session.run(None, {self.input_name: self.preprocess(images[start:start + batch_size])})[0]
+            logits = logits - logits.max(axis=1, keepdims=True)
+            probabilities = np.exp(logits)
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+            for row in probabilities:
+                order = np.argsort(row)[::-1]
+                results.append([{'label': self.labels[index], 'score': float(row[index])} for index in order])
+        return results[0] if single else results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Экспорт NSFW классификатора в ONNX (fp32 и int8).')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='модель transformers (имя на Hub или каталог)')
+    parser.add_argument('--output', default=os.path.join('cache', 'nsfw_onnx'), help='каталог для ONNX модели')
+    parser.add_argument('--no-quantize', action='store_true', help='только fp32, без int8 копии')
+    args = parser.parse_args()
+    print(f"Готово: {export_model(args.model, args.output, quantize=not args.no_quantize)}")
+
+
+if __name__ == '__main__':
+    main()
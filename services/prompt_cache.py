@@ -0,0 +1,89 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+
+from services.cache import DiskLRUCache, MemoryLRUCache
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Приводит промпт к каноническому виду для ключа кэша:
+    регистр (casefold), пунктуация и повторяющиеся пробелы не учитываются.
+    'Кошка!', '  кошка ' и 'КОШКА' дают один и тот же ключ.
+    """
+    prompt = unicodedata.normalize('NFKC', prompt).casefold()
+    prompt = ''.join(' ' if unicodedata.category(ch).startswith('P') else ch for ch in prompt)
+    return _WHITESPACE_RE.sub(' ', prompt).strip()
+
+
+class PromptCache:
+    """
+    Кэш улучшенных промптов. Ключ — нормализованный промпт пользователя плюс хэш
+    системного промпта и модели, поэтому смена PROMPT_SYSTEM или модели не отдаёт
+    старые ответы. Два уровня: LRU в памяти с бюджетом по байтам и (опционально)
+    каталог на диске, общий для всех воркеров. Оба уровня соблюдают один TTL.
+    """
+    def __init__(self, system_prompt: str, model: str, ttl: float, memory_bytes: int,
+                 disk_dir: str | None = None, disk_bytes: int = 0):
+        self.ttl = ttl
+        self._namespace = hashlib.sha256(f"{model}\0{system_prompt}".encode('utf-8')).hexdigest()
+        self._memory = MemoryLRUCache(memory_bytes, ttl=ttl)
+        self._disk = DiskLRUCache(disk_dir, disk_bytes) if disk_dir and disk_bytes else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        print(f"PromptCache инициализирован (ttl={ttl:.0f}s, memory={memory_bytes // 1024}KB, disk={disk_dir or 'off'})")
+
+    def key_for(self, prompt: str) -> str | None:
+        """Ключ кэша для промпта; None, если после нормализации промпт пустой."""
+        normalized = normalize_prompt(prompt)
+        if not normalized:
+            return None
+        return hashlib.sha256(f"{self._namespace}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        improved = self._memory.get(key)
+        if improved is None and self._disk:
+            improved = self._read_disk(key)
+            if improved is not None:
+                self._memory.put(key, improved, self._memory_size(improved))
+        with self._lock:
+            if improved is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return improved
+
+    def put(self, key: str, improved_prompt: str):
+        self._memory.put(key, improved_prompt, self._memory_size(improved_prompt))
+        if self._disk:
+            record = {"improved_prompt": improved_prompt, "created_at": time.time()}
+            self._disk.put(key, json.dumps(record, ensure_ascii=False).encode('utf-8'))
+
+    def _read_disk(self, key: str) -> str | None:
+        raw = self._disk.get(key)
+        if not raw:
+            return None
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            self._disk.delete(key)
+            return None
+        if time.time() - record.get('created_at', 0) > self.ttl:
+            self._disk.delete(key)
+            return None
+        # в памяти запись проживёт полный ttl — допустимо для кэша улучшений промптов
+        return record.get('improved_prompt')
+
+    @staticmethod
+    def _memory_size(improved_prompt: str) -> int:
+        return len(improved_prompt.encode('utf-8')) + 200  # + накладные расходы на ключ и запись
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._memory)}